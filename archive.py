@@ -0,0 +1,83 @@
+import json
+import tempfile
+from typing import IO, Dict, Iterable, Iterator, Tuple
+
+import ijson
+from ijson.common import ObjectBuilder
+
+# Exports above this size spill from memory to a temporary file on disk
+EXPORT_SPOOL_SIZE = 16 * 1024 * 1024
+
+def iter_export(projects: Iterable) -> Iterator[str]:
+    # Same JSON array layout as before, written one file at a time with "files" last so it
+    # can be imported again without holding a whole project in memory
+    yield "["
+    for project_index, project in enumerate(projects):
+        meta = {
+            "title": project.title,
+            "description": project.description,
+            "prompt": project.prompt,
+            "schema": project.schema.to_dict() if project.schema else None,
+            "state": project.state.value,
+            "batch_id": project.batch_id,
+            "routing_policy": project.routing_policy
+        }
+        yield ("," if project_index else "") + "\n" + json.dumps(meta, ensure_ascii=False)[:-1] + ', "files": ['
+        for file_index, file in enumerate(project.files):
+            yield ("," if file_index else "") + "\n" + json.dumps(file.to_dict(), ensure_ascii=False)
+        yield "\n]}"
+    yield "\n]\n"
+
+def spool(chunks: Iterable[str]) -> IO[bytes]:
+    output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    for chunk in chunks:
+        output.write(chunk.encode("utf-8"))
+    output.seek(0)
+    return output
+
+def write_export(projects: Iterable) -> IO[bytes]:
+    return spool(iter_export(projects))
+
+def iter_import(fileobj: IO) -> Iterator[Tuple[str, Dict]]:
+    # Streams an export as ("project", meta) when a project's files begin, ("file", data) for
+    # each file and ("end_project", meta) once the project has been read completely. Keys that
+    # follow "files" (as in older exports) are only present in the end_project meta.
+    meta = None
+    key = None
+    builder = None
+    depth = 0
+    target = None
+
+    for prefix, event, value in ijson.parse(fileobj, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if event in ("start_map", "start_array"):
+                depth += 1
+            elif event in ("end_map", "end_array"):
+                depth -= 1
+            if depth == 0:
+                if target == "file":
+                    yield "file", builder.value
+                else:
+                    meta[target] = builder.value
+                builder = None
+            continue
+
+        if prefix == "item" and event == "start_map":
+            meta = {}
+        elif prefix == "item" and event == "map_key":
+            key = value
+        elif prefix == "item" and event == "end_map":
+            yield "end_project", meta
+            meta = None
+        elif prefix == "item.files" and event == "start_array":
+            yield "project", dict(meta)
+        elif prefix == "item.files.item" and event == "start_map":
+            builder, depth, target = ObjectBuilder(), 1, "file"
+            builder.event(event, value)
+        elif prefix == f"item.{key}" and key != "files" and meta is not None:
+            if event in ("start_map", "start_array"):
+                builder, depth, target = ObjectBuilder(), 1, key
+                builder.event(event, value)
+            else:
+                meta[key] = value
@@ -0,0 +1,185 @@
+from collections import defaultdict
+import io
+import json
+import logging
+import os
+import time
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+import uuid
+
+from chunking import merge_items
+from model import LLMHelper
+from project import FileState, Project, ProjectState, TextFile
+from stub import placeholder_completion
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = os.getenv("OPENAI_BATCH_COMPLETION_WINDOW", "24h")
+BATCH_POLL_INTERVAL = float(os.getenv("OPENAI_BATCH_POLL_INTERVAL", "30"))
+
+# Batch statuses after which no more progress will be made
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+class BatchRunner:
+    def __init__(self, llm: LLMHelper, client=None):
+        self.llm = llm
+        self.client = client if client is not None else llm.client
+
+    def build_requests(self, project: Project, files: List[TextFile] | None = None) -> List[dict]:
+        # custom_id is "<file index>:<chunk index>" so output lines can be routed back to files
+        files = project.files if files is None else files
+        index = {id(file): i for i, file in enumerate(project.files)}
+        requests = []
+        for file in files:
+            for chunk_index, body in enumerate(self.llm.extraction_requests(project.prompt, file.contents, project.schema)):
+                requests.append({
+                    "custom_id": f"{index[id(file)]}:{chunk_index}",
+                    "method": "POST",
+                    "url": BATCH_ENDPOINT,
+                    "body": body
+                })
+        return requests
+
+    def submit(self, project: Project, files: List[TextFile] | None = None) -> str:
+        files = project.files if files is None else files
+        requests = self.build_requests(project, files)
+        payload = "".join(json.dumps(request, ensure_ascii=False) + "\n" for request in requests).encode("utf-8")
+
+        try:
+            input_file = self.client.files.create(file=("requests.jsonl", io.BytesIO(payload)), purpose="batch")
+            batch = self.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint=BATCH_ENDPOINT,
+                completion_window=BATCH_COMPLETION_WINDOW,
+                metadata={"project": project.title[:512]}
+            )
+        except Exception as e:
+            logger.error(f"Error submitting batch for project {project.title}: {str(e)}")
+            raise
+
+        logger.info(f"Submitted batch {batch.id} with {len(requests)} requests for project {project.title}")
+        project.batch_id = batch.id
+        project.state = ProjectState.RUNNING
+        for file in files:
+            file.state = FileState.RUNNING
+        return batch.id
+
+    def poll(self, project: Project):
+        # Checks the project's batch and loads its output once it has finished
+        if not project.batch_id:
+            return None
+        batch = self.client.batches.retrieve(project.batch_id)
+        if batch.status in BATCH_FINAL_STATUSES:
+            self.load_results(project, batch)
+        return batch
+
+    def wait(self, project: Project, poll_interval: float = BATCH_POLL_INTERVAL, timeout: float | None = None):
+        started = time.monotonic()
+        while True:
+            batch = self.poll(project)
+            if batch is None or batch.status in BATCH_FINAL_STATUSES:
+                return batch
+            if timeout is not None and time.monotonic() - started > timeout:
+                raise TimeoutError(f"Batch {project.batch_id} still {batch.status} after {timeout}s")
+            time.sleep(poll_interval)
+
+    def load_results(self, project: Project, batch):
+        chunk_items: Dict[int, Dict[int, List[dict]]] = defaultdict(dict)
+        failed = set()
+
+        for line in self.read_lines(batch.output_file_id):
+            file_index, chunk_index = (int(part) for part in line["custom_id"].split(":"))
+            response = line.get("response") or {}
+            try:
+                if line.get("error") or response.get("status_code") != 200:
+                    raise Exception(line.get("error") or response.get("body"))
+                message = response["body"]["choices"][0]["message"]
+                if message.get("refusal"):
+                    raise Exception(message["refusal"])
+                chunk_items[file_index][chunk_index] = json.loads(message["content"])["data_fields"]
+            except Exception as e:
+                logger.error(f"Error in batch result {line['custom_id']}: {str(e)}")
+                failed.add(file_index)
+
+        for line in self.read_lines(batch.error_file_id):
+            logger.error(f"Error in batch request {line['custom_id']}: {line.get('response') or line.get('error')}")
+            failed.add(int(line["custom_id"].split(":")[0]))
+
+        field_names = [field.name for field in project.schema.data_fields]
+        version = project.run_version
+        for file_index, file in enumerate(project.files):
+            if file.state != FileState.RUNNING:
+                continue
+            if file_index in failed or file_index not in chunk_items:
+                file.state = FileState.ERROR
+                continue
+            chunks = chunk_items[file_index]
+            items = merge_items([chunks[i] for i in sorted(chunks)], field_names)
+            file.results = self.llm.to_results(items, project.schema)
+            file.run_version = version
+            file.state = FileState.FINISHED
+
+        project.batch_id = None
+        if batch.status != "completed" or any(file.state == FileState.ERROR for file in project.files):
+            project.state = ProjectState.ERROR
+        else:
+            project.state = ProjectState.COMPLETE
+
+    def read_lines(self, file_id: str | None):
+        if not file_id:
+            return
+        for line in self.client.files.content(file_id).text.splitlines():
+            if line.strip():
+                yield json.loads(line)
+
+class LocalBatchClient:
+    # Stand-in for the files and batches endpoints of the OpenAI client. Batches run in-process
+    # as soon as they are created, answering each request with respond(body).
+    def __init__(self, respond: Callable[[dict], dict] = placeholder_completion):
+        self.respond = respond
+        self.stored_files: Dict[str, str] = {}
+        self.stored_batches: Dict[str, SimpleNamespace] = {}
+        self.files = SimpleNamespace(create=self.create_file, content=self.file_content)
+        self.batches = SimpleNamespace(create=self.create_batch, retrieve=self.retrieve_batch)
+
+    def create_file(self, file, purpose: str):
+        name, data = file
+        data = data.read() if hasattr(data, "read") else data
+        file_id = f"file-{uuid.uuid4().hex}"
+        self.stored_files[file_id] = data.decode("utf-8") if isinstance(data, bytes) else data
+        return SimpleNamespace(id=file_id, filename=name, purpose=purpose)
+
+    def file_content(self, file_id: str):
+        return SimpleNamespace(text=self.stored_files[file_id])
+
+    def create_batch(self, input_file_id: str, endpoint: str, completion_window: str, metadata: dict | None = None):
+        output_lines = []
+        error_lines = []
+        for line in self.stored_files[input_file_id].splitlines():
+            request = json.loads(line)
+            try:
+                response = {"status_code": 200, "request_id": uuid.uuid4().hex, "body": self.respond(request["body"])}
+                output_lines.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"], "response": response, "error": None})
+            except Exception as e:
+                error_lines.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"], "response": None, "error": {"message": str(e)}})
+
+        output_file = self.create_file(("output.jsonl", "".join(json.dumps(line) + "\n" for line in output_lines)), "batch_output")
+        error_file = self.create_file(("errors.jsonl", "".join(json.dumps(line) + "\n" for line in error_lines)), "batch_output") if error_lines else None
+        batch = SimpleNamespace(
+            id=f"batch_{uuid.uuid4().hex}",
+            status="completed",
+            endpoint=endpoint,
+            completion_window=completion_window,
+            metadata=metadata,
+            input_file_id=input_file_id,
+            output_file_id=output_file.id,
+            error_file_id=error_file.id if error_file else None,
+            request_counts=SimpleNamespace(total=len(output_lines) + len(error_lines), completed=len(output_lines), failed=len(error_lines))
+        )
+        self.stored_batches[batch.id] = batch
+        return batch
+
+    def retrieve_batch(self, batch_id: str):
+        return self.stored_batches[batch_id]
@@ -0,0 +1,171 @@
+# Offline throughput benchmark: runs a project over Examples/ (or a synthetic corpus scaled from
+# it) through the same runner the app uses, against the in-process stub backend.
+#
+#   python bench.py --files 10000 --workers 32 --latency-ms 200 --rate-limit-rate 0.02
+#   python bench.py --files 10000 --baseline bench.json --tolerance 0.1
+#
+# Results can be saved with --json and compared with --baseline to fail on throughput regressions.
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from routing import ROUTING_POLICIES
+
+DEFAULT_PROJECT = os.path.join("Examples", "Product Feedback Project.json")
+DEFAULT_INPUT = os.path.join("Examples", "Product Feedback")
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the extraction path against the offline stub backend.")
+    parser.add_argument("--project", default=DEFAULT_PROJECT, help="Exported projects JSON file providing the prompt and schema")
+    parser.add_argument("--input", default=DEFAULT_INPUT, help="Directory of sample files")
+    parser.add_argument("--files", type=int, default=0, help="Synthetic corpus size, cycling through the samples (default: the samples once)")
+    parser.add_argument("--workers", type=int, default=None, help="Concurrent files (default: EXTRACTION_MAX_WORKERS)")
+    parser.add_argument("--pack-tokens", type=int, default=0, help="Pack small files into shared requests of this many tokens")
+    parser.add_argument("--prompt-layout", choices=("prefix", "standard"), default=None, help="Request layout (default: PROMPT_LAYOUT)")
+    parser.add_argument("--routing-policy", choices=ROUTING_POLICIES, default=None,
+                        help="Model routing policy (default: ROUTING_POLICY)")
+    parser.add_argument("--dedupe-threshold", type=float, default=0,
+                        help="Reuse results for near-duplicate files at this similarity (default: off, so every file is extracted)")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Simulated latency of each request")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="Random +/- variation of the simulated latency")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests failing with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="Fraction of requests failing with a 429")
+    parser.add_argument("--rpm", type=int, default=0, help="Client-side requests per minute limit (0: unlimited)")
+    parser.add_argument("--tpm", type=int, default=0, help="Client-side tokens per minute limit (0: unlimited)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Earlier --json results; exit with an error if files/sec regressed")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed files/sec drop against the baseline")
+    return parser.parse_args(argv)
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def peak_memory_mb() -> float | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def build_corpus(input_dir: str, files: int):
+    from project import TextFile
+
+    samples = []
+    for path in sorted(glob.glob(os.path.join(input_dir, "*"))):
+        if os.path.isfile(path):
+            with open(path, encoding="utf-8", errors="replace") as f:
+                samples.append((os.path.basename(path), f.read()))
+    if not samples:
+        raise SystemExit(f"No sample files in {input_dir}")
+    if files <= 0:
+        return [TextFile(name, contents) for name, contents in samples]
+    # Each copy is made distinct so neither the stub nor any cache sees repeated requests
+    return [
+        TextFile(f"{i:06d}_{samples[i % len(samples)][0]}", f"{samples[i % len(samples)][1]}\n\nRef: {i}")
+        for i in range(files)
+    ]
+
+def run(args) -> dict:
+    # The benchmark measures the extraction path, not the on-disk cache
+    os.environ["EXTRACTION_CACHE_PATH"] = ""
+
+    from extract import load_project
+    from metrics import get_metrics
+    from model import PROMPT_LAYOUT, LLMHelper
+    from ratelimit import RateLimiter
+    from runner import DEFAULT_MAX_WORKERS, run_files
+    from stub import StubClient
+
+    class TimedLLMHelper(LLMHelper):
+        # Request latency as the runner sees it: rate limiter waits, retries and the response
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.latencies = []
+            self._latency_lock = threading.Lock()
+
+        def chat_completion(self, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return super().chat_completion(*args, **kwargs)
+            finally:
+                with self._latency_lock:
+                    self.latencies.append(time.perf_counter() - started)
+
+    project = load_project(args.project)
+    project.files = build_corpus(args.input, args.files)
+    if args.routing_policy:
+        project.routing_policy = args.routing_policy
+    client = StubClient(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+                        rate_limit_rate=args.rate_limit_rate, seed=args.seed)
+    llm = TimedLLMHelper(client=client, cache=None, rate_limiter=RateLimiter(rpm=args.rpm, tpm=args.tpm),
+                         prompt_layout=args.prompt_layout or PROMPT_LAYOUT)
+    workers = args.workers or DEFAULT_MAX_WORKERS
+
+    started = time.perf_counter()
+    failed = run_files(project, max_workers=workers, llm=llm, pack_tokens=args.pack_tokens, dedupe_threshold=args.dedupe_threshold)
+    elapsed = time.perf_counter() - started
+
+    stats = client.stats()
+    return {
+        "files": len(project.files),
+        "failed": len(failed),
+        "workers": workers,
+        "pack_tokens": args.pack_tokens,
+        "prompt_layout": llm.prompt_layout,
+        "elapsed_s": round(elapsed, 3),
+        "files_per_s": round(len(project.files) / elapsed, 2) if elapsed else 0.0,
+        "requests": len(llm.latencies),
+        "dedupe_reused": sum(file.duplicate_of is not None for file in project.files),
+        "p50_latency_ms": round(percentile(llm.latencies, 0.5) * 1000, 1),
+        "p99_latency_ms": round(percentile(llm.latencies, 0.99) * 1000, 1),
+        "mean_latency_ms": round(statistics.fmean(llm.latencies) * 1000, 1) if llm.latencies else 0.0,
+        "attempts": stats["requests"],
+        "server_errors": stats["errors"],
+        "rate_limited": stats["rate_limited"],
+        "prompt_tokens": stats["prompt_tokens"],
+        "cached_tokens": stats["cached_tokens"],
+        "cached_rate": round(stats["cached_tokens"] / stats["prompt_tokens"], 3) if stats["prompt_tokens"] else 0.0,
+        "completion_tokens": stats["completion_tokens"],
+        "peak_memory_mb": round(peak_memory_mb(), 1) if resource is not None else None,
+        # Calls and estimated cost per model tier
+        "models": {row["model"]: {"calls": row["calls"], "p50_s": row["p50_s"], "cost_usd": row["cost_usd"]}
+                   for row in get_metrics().summary(project.title, by=("model",))}
+    }
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    results = run(args)
+    width = max(len(key) for key in results)
+    for key, value in results.items():
+        print(f"{key:<{width}}  {value}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        floor = baseline["files_per_s"] * (1 - args.tolerance)
+        if results["files_per_s"] < floor:
+            print(f"Regression: {results['files_per_s']} files/s is below {floor:.2f} "
+                  f"(baseline {baseline['files_per_s']} - {args.tolerance:.0%})", file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+import logging
+import os
+import re
+import threading
+from typing import Dict, List
+
+import tiktoken
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+load_dotenv()
+
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "12000"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "300"))
+CHUNK_MAX_WORKERS = int(os.getenv("CHUNK_MAX_WORKERS", "4"))
+
+DEFAULT_ENCODING = "o200k_base"
+
+# Paragraphs, which is also how speaker turns are separated in transcripts
+PARAGRAPH_PATTERN = re.compile(r"(?<=\n)[ \t]*\n")
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+def get_encoding(model: str):
+    with _encodings_lock:
+        if model not in _encodings:
+            try:
+                try:
+                    _encodings[model] = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    _encodings[model] = tiktoken.get_encoding(DEFAULT_ENCODING)
+            except Exception as e:
+                # tiktoken downloads its BPE files on first use, so this fails when offline
+                logger.error(f"Error loading tiktoken encoding for {model}, estimating token counts: {str(e)}")
+                _encodings[model] = None
+        return _encodings[model]
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        # About four characters per token, rounded up so split_tokens' pieces count as max_tokens
+        return -(-len(text) // 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def split_tokens(text: str, max_tokens: int, model: str) -> List[str]:
+    encoding = get_encoding(model)
+    if encoding is None:
+        size = max_tokens * 4
+        return [text[i:i + size] for i in range(0, len(text), size)]
+    tokens = encoding.encode(text, disallowed_special=())
+    return [encoding.decode(tokens[i:i + max_tokens]) for i in range(0, len(tokens), max_tokens)]
+
+def split_segments(text: str, max_tokens: int, model: str) -> List[str]:
+    # Paragraphs first, then lines, then raw tokens for anything still too large.
+    # Segments keep their trailing whitespace so joining them restores the text.
+    segments = []
+    paragraphs = PARAGRAPH_PATTERN.split(text)
+    for i, paragraph in enumerate(paragraphs):
+        if i < len(paragraphs) - 1:
+            paragraph += "\n"
+        if count_tokens(paragraph, model) <= max_tokens:
+            segments.append(paragraph)
+            continue
+        for line in paragraph.splitlines(keepends=True):
+            if count_tokens(line, model) <= max_tokens:
+                segments.append(line)
+            else:
+                segments.extend(split_tokens(line, max_tokens, model))
+    return segments
+
+def split_text(text: str, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+               model: str = "gpt-4o-mini") -> List[str]:
+    if max_tokens <= 0 or count_tokens(text, model) <= max_tokens:
+        return [text]
+
+    overlap_tokens = min(overlap_tokens, max_tokens // 2)
+    chunks = []
+    current: List[tuple] = []
+    current_tokens = 0
+
+    for segment in split_segments(text, max_tokens - overlap_tokens, model):
+        tokens = count_tokens(segment, model)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("".join(s for s, _ in current))
+            # Carry the trailing segments that fit in the overlap into the next chunk
+            overlap = []
+            overlap_size = 0
+            for s, t in reversed(current):
+                if overlap_size + t > overlap_tokens:
+                    break
+                overlap.insert(0, (s, t))
+                overlap_size += t
+            current = overlap
+            current_tokens = overlap_size
+        current.append((segment, tokens))
+        current_tokens += tokens
+
+    if current:
+        chunks.append("".join(s for s, _ in current))
+    return chunks
+
+def normalize_value(value) -> str:
+    return " ".join(str(value).split()).casefold()
+
+def merge_items(chunk_items: List[List[Dict]], field_names: List[str]) -> List[Dict]:
+    # Items extracted from overlapping text show up in both neighbouring chunks;
+    # keep the first occurrence of each distinct item, in document order.
+    merged = []
+    seen = set()
+    for items in chunk_items:
+        for item in items:
+            key = tuple(normalize_value(item.get(name, "")) for name in field_names)
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append(item)
+    return merged
@@ -1,7 +1,14 @@
+import json
+import os
 import streamlit as st
-from util import Project, ProjectState, TextFile, projects_manager
-from model import LLMHelper
+from util import FileState, Project, ProjectState, TextFile, get_llm_helper, projects_manager, result_rows
 import pandas as pd
+from metrics import call_labels
+from ingest import extract_text
+from speculative import get_speculative_calls
+
+# Seconds between checks on the sample extraction while the schema is reviewed
+PREVIEW_POLL_INTERVAL = float(os.getenv("PREVIEW_POLL_INTERVAL", "1"))
 
 def create_project_workflow():
     st.title("Create New Project")
@@ -28,12 +35,44 @@ def goal_set_step():
     
     st.button("Next", on_click=setup_project, args=(user_input,))
 
+# Each wizard step starts the next step's LLM call in the background as soon as its inputs exist:
+# project setup when the goal is entered, the schema when the file is uploaded (chained on the
+# setup), and a sample extraction when the schema is shown. Calls are keyed by their inputs, so
+# going Back and giving the same input again reuses them.
+
 def setup_project(user_input):
-    with st.spinner("Setting up project..."):
-        project_setup = LLMHelper().project_setup(user_input)
-    st.session_state.temp_project = Project(project_setup.title, project_setup.description, project_setup.prompt)
+    key = ("project_setup", user_input)
+    get_speculative_calls().start(key, get_llm_helper().project_setup, user_input)
+    st.session_state.setup_key = key
     st.session_state.create_project_step = "FILE_UPLOAD"
 
+def wizard_project():
+    # The project once its setup call has finished; None (with the error shown) if it failed
+    if st.session_state.temp_project is None:
+        calls = get_speculative_calls()
+        goal = st.session_state.setup_key[1]
+        future = calls.start(st.session_state.setup_key, get_llm_helper().project_setup, goal)
+        try:
+            with st.spinner("Setting up project..."):
+                project_setup = future.result()
+        except Exception as e:
+            st.error(f"Error setting up project: {str(e)}")
+            st.button("Back", on_click=go_back_to_goal_set)
+            return None
+        st.session_state.temp_project = Project(project_setup.title, project_setup.description, project_setup.prompt)
+        st.session_state.temp_project.files = [st.session_state.wizard_file]
+    return st.session_state.temp_project
+
+def generate_schema(llm, setup_future, file_contents):
+    # Waits for the project setup (normally done already) so the schema can start on upload
+    project_setup = setup_future.result()
+    with call_labels(project=project_setup.title):
+        return llm.extract_schema(file_contents, project_setup.prompt)
+
+def generate_preview(llm, project_title, prompt, file_contents, schema):
+    with call_labels(project=project_title):
+        return llm.run_schema(prompt, file_contents, schema)
+
 def file_upload_step():
     st.write("Step 2: Upload File")
     st.file_uploader("Choose a file", key="new_project_file_upload", on_change=process_uploaded_file)
@@ -42,24 +81,59 @@ def file_upload_step():
 
 def process_uploaded_file():
     if st.session_state.new_project_file_upload:
-        file_contents = st.session_state.new_project_file_upload.read().decode("utf-8")
-        file = TextFile(st.session_state.new_project_file_upload.name, file_contents)
-        st.session_state.temp_project.files = [file]
+        upload = st.session_state.new_project_file_upload
+        document = extract_text(upload.name, upload.read())
+        if document.contents is None:
+            st.error(f"Could not read {upload.name}: {document.error}")
+            return
+        file = TextFile(upload.name, document.contents)
+        calls = get_speculative_calls()
+        llm = get_llm_helper()
+        setup_future = calls.start(st.session_state.setup_key, llm.project_setup, st.session_state.setup_key[1])
+        schema_key = ("extract_schema", st.session_state.setup_key, file.content_hash)
+        calls.start(schema_key, generate_schema, llm, setup_future, file.contents)
+        st.session_state.schema_key = schema_key
+        st.session_state.wizard_file = file
+        st.session_state.temp_project = None
         st.session_state.create_project_step = "SCHEMA_REVIEW"
 
 def go_back_to_goal_set():
+    # A schema call that hasn't started is dropped; a goal entered again reuses its setup call
+    if "schema_key" in st.session_state:
+        get_speculative_calls().cancel(st.session_state.pop("schema_key"))
+    st.session_state.pop("wizard_file", None)
+    st.session_state.temp_project = None
     st.session_state.create_project_step = "GOAL_SET"
 
 def schema_review_step():
     st.write("Step 3: Review Schema")
-    project = st.session_state.temp_project
-    
+    project = wizard_project()
+    if project is None:
+        return
+    calls = get_speculative_calls()
+    llm = get_llm_helper()
+    file = project.files[0]
+
     if 'schema_response' not in st.session_state:
-        with st.spinner("Generating Schema..."):
-            st.session_state.schema_response = LLMHelper().extract_schema(project.files[0].contents, project.prompt)
-    
-    schema_df = pd.DataFrame([vars(field) for field in st.session_state.schema_response.data_fields])
+        future = calls.start(st.session_state.schema_key, generate_schema, llm,
+                             calls.start(st.session_state.setup_key, llm.project_setup, st.session_state.setup_key[1]), file.contents)
+        try:
+            with st.spinner("Generating Schema..."):
+                st.session_state.schema_response = future.result()
+        except Exception as e:
+            st.error(f"Error generating schema: {str(e)}")
+            st.button("Back", on_click=go_back_to_file_upload)
+            return
+
+    schema = st.session_state.schema_response
+    schema_df = pd.DataFrame([vars(field) for field in schema.data_fields])
     st.table(schema_df)
+
+    # Sample extraction on the uploaded file, run while the schema is being reviewed
+    preview_key = ("run_schema", project.prompt, file.content_hash, json.dumps(schema.to_dict(), sort_keys=True))
+    calls.start(preview_key, generate_preview, llm, project.title, project.prompt, file.contents, schema)
+    st.session_state.preview_key = preview_key
+    schema_preview(preview_key)
     
     col1, col2 = st.columns(2)
     with col1:
@@ -67,7 +141,22 @@ def schema_review_step():
     with col2:
         st.button("Approve Schema", on_click=approve_schema)
 
+@st.fragment(run_every=PREVIEW_POLL_INTERVAL)
+def schema_preview(preview_key):
+    st.write(f"Sample extraction from {st.session_state.temp_project.files[0].file_name}")
+    future = get_speculative_calls().get(preview_key)
+    if future is None or not future.done():
+        st.caption("Extracting...")
+    elif future.exception() is not None:
+        st.caption(f"Sample extraction failed: {str(future.exception())}")
+    else:
+        st.dataframe(pd.DataFrame(result_rows([result.to_dict() for result in future.result()])), hide_index=True)
+
 def go_back_to_file_upload():
+    # The sample extraction is dropped if it hasn't started; the schema call is kept, so uploading
+    # the same file again reuses it
+    if "preview_key" in st.session_state:
+        get_speculative_calls().cancel(st.session_state.pop("preview_key"))
     st.session_state.create_project_step = "FILE_UPLOAD"
     st.session_state.pop('schema_response', None)
 
@@ -75,6 +164,14 @@ def approve_schema():
     project = st.session_state.temp_project
     project.schema = st.session_state.schema_response
     project.state = ProjectState.SCHEMA_APPROVED
+    # A finished sample extraction becomes the first file's results, so it isn't extracted again
+    future = get_speculative_calls().get(st.session_state.pop("preview_key", None))
+    if future is not None and future.done() and future.exception() is None:
+        file = project.files[0]
+        file.results = future.result()
+        file.run_version = project.run_version
+        file.state = FileState.FINISHED
+        project.state = ProjectState.EXAMPLE_GENERATED
     st.session_state.create_project_step = "COMPLETE"
     st.session_state.pop('schema_response', None)
 
@@ -93,16 +190,20 @@ def save_project():
     project = st.session_state.temp_project
     project.state = ProjectState.COMPLETE
     projects_manager.save_project(project)
+    st.session_state['selected_project'] = project.id
     st.session_state['current_view'] = 'project_details'
     cleanup_project_creation()
     st.success("Project created successfully!")
 
 def cancel_project_creation():
+    for key in ('schema_key', 'preview_key'):
+        if key in st.session_state:
+            get_speculative_calls().cancel(st.session_state[key])
     cleanup_project_creation()
 
 def cleanup_project_creation():
-    st.session_state.pop('create_project_step', None)
-    st.session_state.pop('temp_project', None)
+    for key in ('create_project_step', 'temp_project', 'setup_key', 'schema_key', 'preview_key', 'wizard_file'):
+        st.session_state.pop(key, None)
    
 
 if __name__ == "__main__":
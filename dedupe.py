@@ -0,0 +1,143 @@
+# Near-duplicate detection with MinHash signatures and an LSH index, so files that are almost the
+# same as one already extracted (forwarded emails, template submissions, re-uploads with
+# whitespace changes) can reuse its results instead of costing another extraction call
+from collections import defaultdict
+import hashlib
+import os
+import re
+from typing import Dict, Hashable, Iterable, List, Tuple
+
+from dotenv import load_dotenv
+import numpy as np
+
+load_dotenv()
+
+# Estimated Jaccard similarity of word shingles above which files count as near duplicates. Off (0) by
+# default: documents that differ only in a few values are still very similar, e.g. 0.9 or more.
+DEDUPE_THRESHOLD = float(os.getenv("DEDUPE_THRESHOLD", "0"))
+# Only reuse results whose values all appear in the duplicate too; otherwise it is extracted normally
+DEDUPE_VERIFY = os.getenv("DEDUPE_VERIFY", "1").lower() not in ("0", "false", "no")
+DEDUPE_SHINGLE_WORDS = int(os.getenv("DEDUPE_SHINGLE_WORDS", "3"))
+# Signature length; changing it invalidates stored signatures, which are then recomputed
+MINHASH_PERMUTATIONS = 128
+MINHASH_BLOCK = 4096
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64(0xFFFFFFFF)
+# Universal hashes (a*x + b) mod p over the 32-bit shingle hashes. a and b are below 2**32 too,
+# so a*x + b fits in 64 bits and the reduction is exact. Fixed seed: signatures are stored with
+# the files and compared across runs.
+_generator = np.random.default_rng(1)
+PERMUTATION_A = _generator.integers(1, 1 << 32, MINHASH_PERMUTATIONS, dtype=np.uint64)
+PERMUTATION_B = _generator.integers(0, 1 << 32, MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+WORD_PATTERN = re.compile(r"\w+")
+
+def normalize(text: str) -> str:
+    return " ".join(WORD_PATTERN.findall(text.lower()))
+
+def shingles(text: str, size: int = DEDUPE_SHINGLE_WORDS) -> set:
+    words = normalize(text).split()
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def minhash(text: str) -> bytes:
+    # MINHASH_PERMUTATIONS 32-bit minimums over the document's shingles, packed for storage
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little") for shingle in shingles(text)),
+        dtype=np.uint64
+    )
+    signature = np.full(MINHASH_PERMUTATIONS, MAX_HASH, dtype=np.uint64)
+    # In blocks, so a very long document doesn't need a shingles x permutations array at once
+    for start in range(0, len(hashes), MINHASH_BLOCK):
+        permuted = (np.outer(hashes[start:start + MINHASH_BLOCK], PERMUTATION_A) + PERMUTATION_B) % MERSENNE_PRIME & MAX_HASH
+        np.minimum(signature, permuted.min(axis=0), out=signature)
+    return signature.astype(np.uint32).tobytes()
+
+def similarity(first: bytes, second: bytes) -> float:
+    # Estimated Jaccard similarity: the share of matching signature positions
+    return float(np.mean(np.frombuffer(first, dtype=np.uint32) == np.frombuffer(second, dtype=np.uint32)))
+
+def lsh_bands(threshold: float, permutations: int = MINHASH_PERMUTATIONS) -> Tuple[int, int]:
+    # (bands, rows) whose S-curve threshold (1/bands)^(1/rows) is closest to, but not above, the
+    # similarity threshold, so few true duplicates are missed; candidates are checked exactly anyway
+    options = [(bands, permutations // bands) for bands in range(1, permutations + 1) if permutations % bands == 0]
+    below = [option for option in options if (1 / option[0]) ** (1 / option[1]) <= threshold]
+    return max(below or options[-1:], key=lambda option: (1 / option[0]) ** (1 / option[1]))
+
+class NearDuplicateIndex:
+    # LSH over MinHash signatures: keys whose signatures share any band are candidates, and
+    # candidates are kept when their estimated similarity reaches the threshold
+    def __init__(self, threshold: float = DEDUPE_THRESHOLD):
+        self.threshold = threshold
+        self.bands, self.rows = lsh_bands(threshold)
+        self.buckets: List[Dict[bytes, List[Hashable]]] = [defaultdict(list) for _ in range(self.bands)]
+        self.signatures: Dict[Hashable, bytes] = {}
+
+    def band_keys(self, signature: bytes) -> Iterable[bytes]:
+        width = self.rows * 4
+        return (signature[band * width:(band + 1) * width] for band in range(self.bands))
+
+    def add(self, key: Hashable, signature: bytes):
+        self.signatures[key] = signature
+        for bucket, band_key in zip(self.buckets, self.band_keys(signature)):
+            bucket[band_key].append(key)
+
+    def query(self, signature: bytes) -> List[Tuple[Hashable, float]]:
+        # Matching keys, most similar first
+        candidates = set()
+        for bucket, band_key in zip(self.buckets, self.band_keys(signature)):
+            candidates.update(bucket.get(band_key, ()))
+        matches = [(key, similarity(signature, self.signatures[key])) for key in candidates]
+        return sorted((match for match in matches if match[1] >= self.threshold), key=lambda match: -match[1])
+
+def near_duplicate_groups(references: Iterable[Tuple[Hashable, bytes]], candidates: Iterable[Tuple[Hashable, bytes]],
+                          threshold: float = DEDUPE_THRESHOLD) -> Dict[Hashable, List[Hashable]]:
+    # Assigns each candidate, in order, to the most similar reference (files already extracted)
+    # or earlier candidate it is a near duplicate of. Unmatched candidates become representatives
+    # for later ones. Returns {representative: [near duplicates]}.
+    index = NearDuplicateIndex(threshold)
+    for key, signature in references:
+        index.add(key, signature)
+    groups = defaultdict(list)
+    for key, signature in candidates:
+        matches = index.query(signature)
+        if matches:
+            groups[matches[0][0]].append(key)
+        else:
+            index.add(key, signature)
+    return dict(groups)
+
+def value_text(value) -> str | None:
+    # How a scalar value would be written in a document, normalized; None when it can't be looked
+    # up (booleans are inferred rather than quoted)
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return normalize(str(value))
+
+def occurrences(text: str, value: str) -> int:
+    return len(re.findall(rf"(?<!\S){re.escape(value)}(?!\S)", text))
+
+def values_supported(rows: Iterable[dict], contents: str, source: str, fields: Iterable[str]) -> bool:
+    # Cheap check that results extracted from source also hold for contents, a near duplicate of
+    # it: every value of the given fields must appear in contents at least as often as in source
+    # (ignoring case, punctuation and spacing). Counting catches a value that changed in one place
+    # but also appears elsewhere, like "Rating: 5" becoming "Rating: 1" in a text that mentions 5.
+    # Values that can't be found in the text fail the check, so the file is extracted normally.
+    text = normalize(contents)
+    source_text = normalize(source)
+    fields = tuple(fields)
+    for row in rows:
+        for value in (row.get(field) for field in fields):
+            for item in value if isinstance(value, list) else [value]:
+                if item is None or item == "":
+                    continue
+                item = value_text(item)
+                if item is None:
+                    return False
+                if item and occurrences(text, item) < max(1, occurrences(source_text, item)):
+                    return False
+    return True
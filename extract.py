@@ -0,0 +1,246 @@
+# Headless bulk extraction with a saved project's prompt and schema, for cron jobs and pipelines:
+#
+#   python extract.py --project projects.json --input docs/ --out results.parquet --workers 32
+#
+# Progress is checkpointed next to the output, so re-running the same command after a crash or
+# Ctrl-C only processes the files that are new, changed or failed.
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import glob
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+from typing import Dict, Iterator
+import uuid
+
+from routing import ROUTING_POLICIES
+
+logger = logging.getLogger("extract")
+
+# ResultsTable writers by output file extension
+OUTPUT_FORMATS = {
+    ".parquet": "write_parquet",
+    ".csv": "write_csv",
+    ".jsonl": "write_jsonl",
+    ".xlsx": "write_excel"
+}
+# Optional packages (see requirements-optional.txt) the output formats need
+OUTPUT_REQUIREMENTS = {
+    ".parquet": "pyarrow",
+    ".xlsx": "xlsxwriter"
+}
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run a saved extraction project over a directory or glob of text files.")
+    parser.add_argument("--project", required=True,
+                        help="Exported projects JSON file, or the title of a project in the project store")
+    parser.add_argument("--title", help="Project to use when the export holds several (default: the first)")
+    parser.add_argument("--input", required=True, help="Directory (searched recursively) or glob pattern of input files")
+    parser.add_argument("--out", required=True, help="Output file: .parquet, .csv, .jsonl or .xlsx")
+    parser.add_argument("--workers", type=int, default=None, help="Files processed concurrently (default: EXTRACTION_MAX_WORKERS)")
+    parser.add_argument("--routing-policy", choices=ROUTING_POLICIES,
+                        help="Model routing policy for this run (default: the project's, else ROUTING_POLICY)")
+    parser.add_argument("--checkpoint", help="Progress file used to resume runs (default: <out>.progress.jsonl)")
+    parser.add_argument("--restart", action="store_true", help="Ignore earlier progress and process every file again")
+    parser.add_argument("--verbose", action="store_true", help="Log progress for every file")
+    return parser.parse_args(argv)
+
+def iter_inputs(pattern: str) -> Iterator[str]:
+    # Paths are yielded as they are found, so large trees start processing straight away
+    if os.path.isdir(pattern):
+        for root, dirs, names in os.walk(pattern):
+            dirs.sort()
+            for name in sorted(names):
+                yield os.path.join(root, name)
+    else:
+        for path in glob.iglob(pattern, recursive=True):
+            if os.path.isfile(path):
+                yield path
+
+def load_project(name: str, title: str | None = None):
+    from archive import iter_import
+    from project import Project
+    from store import ProjectStore
+
+    if os.path.isfile(name):
+        with open(name, "rb") as f:
+            for kind, data in iter_import(f):
+                if kind == "end_project" and (title is None or data["title"] == title):
+                    return Project.from_dict(dict(data, files=[]))
+        raise SystemExit(f"No project {title!r} in {name}" if title else f"No projects in {name}")
+
+    # Looked up by title in the store, without loading every other project
+    store = ProjectStore()
+    rows = store.list_projects(title=title or name)
+    if rows:
+        return Project.from_row(rows[0], store)
+    raise SystemExit(f"No project titled {title or name!r} in the project store")
+
+class Checkpoint:
+    # Append-only JSON Lines record of every processed file; the last record for a path wins
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def load(self) -> Dict[str, dict]:
+        records = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A line cut short by a crash
+                        continue
+                    records[record["path"]] = record
+        return records
+
+    def append(self, record: dict):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def file_signature(path: str) -> dict:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+def extract_file(path: str, input_root: str, project, llm, run_id: str) -> dict:
+    from ingest import extract_text
+    from metrics import call_labels
+    from project import FileState, TextFile, result_rows
+    from runner import run_file
+
+    signature = file_signature(path)
+    file_name = os.path.relpath(path, input_root)
+    with open(path, "rb") as f:
+        document = extract_text(file_name, f.read())
+    if document.contents is None:
+        return dict(signature, path=path, file_name=file_name, state=FileState.ERROR.value, error=document.error)
+    file = TextFile(file_name, document.contents)
+    try:
+        with call_labels(run=run_id):
+            run_file(file, project, llm)
+    except Exception as e:
+        return dict(signature, path=path, file_name=file.file_name, state=FileState.ERROR.value, error=str(e))
+    return dict(signature, path=path, file_name=file.file_name, state=FileState.FINISHED.value,
+                run_version=project.run_version, rows=result_rows([result.to_dict() for result in file.results]))
+
+def write_output(out: str, records: Dict[str, dict], project):
+    from project import FileState
+    from results import ResultsTable
+
+    writer = OUTPUT_FORMATS[os.path.splitext(out)[1].lower()]
+    table = ResultsTable([field.to_dict() for field in project.schema.data_fields])
+    for path, record in sorted(records.items()):
+        if record["state"] == FileState.FINISHED.value:
+            table.append(path, record["file_name"], record["rows"])
+    output = getattr(table, writer)(include_file=True)
+    with output, open(out, "wb") as f:
+        shutil.copyfileobj(output, f)
+    return len(table)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    extension = os.path.splitext(args.out)[1].lower()
+    if extension not in OUTPUT_FORMATS:
+        raise SystemExit(f"Unsupported output format for {args.out}; use one of {', '.join(OUTPUT_FORMATS)}")
+    # Checked before any file is extracted, rather than failing when the output is written
+    requirement = OUTPUT_REQUIREMENTS.get(extension)
+    if requirement and importlib.util.find_spec(requirement) is None:
+        raise SystemExit(f"Writing {extension} output requires {requirement} (pip install {requirement})")
+
+    # Imported after argument parsing so --help and usage errors return immediately
+    from metrics import get_metrics
+    from model import LLMHelper
+    from project import FileState
+    from runner import DEFAULT_MAX_WORKERS
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    project = load_project(args.project, args.title)
+    if project.schema is None:
+        raise SystemExit(f"Project {project.title!r} has no approved schema")
+    if args.routing_policy:
+        project.routing_policy = args.routing_policy
+
+    workers = args.workers or DEFAULT_MAX_WORKERS
+    input_root = args.input if os.path.isdir(args.input) else os.path.dirname(args.input.split("*")[0]) or "."
+    checkpoint = Checkpoint(args.checkpoint or args.out + ".progress.jsonl")
+    if args.restart and os.path.exists(checkpoint.path):
+        os.remove(checkpoint.path)
+    records = checkpoint.load()
+    llm = LLMHelper()
+    run_id = uuid.uuid4().hex
+
+    # Files finished under another prompt or schema are extracted again
+    version = project.run_version
+    skipped = processed = failed = 0
+    pending = set()
+    interrupted = False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            def collect(done):
+                nonlocal processed, failed
+                for future in done:
+                    record = future.result()
+                    checkpoint.append(record)
+                    records[record["path"]] = record
+                    processed += 1
+                    if record["state"] == FileState.ERROR.value:
+                        failed += 1
+                        logger.error(f"Error processing file {record['path']}: {record['error']}")
+                    else:
+                        logger.info(f"Finished {record['path']} ({len(record['rows'])} rows)")
+
+            for path in iter_inputs(args.input):
+                previous = records.get(path)
+                if previous is not None and previous["state"] == FileState.FINISHED.value \
+                        and previous.get("run_version", version) == version \
+                        and {key: previous.get(key) for key in ("size", "mtime")} == file_signature(path):
+                    skipped += 1
+                    continue
+                # Only a bounded number of files are read ahead of the workers
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(extract_file, path, input_root, project, llm, run_id))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        except KeyboardInterrupt:
+            interrupted = True
+            for future in pending:
+                future.cancel()
+    checkpoint.close()
+
+    if interrupted:
+        print(f"Interrupted after {processed} files; run the same command again to resume.", file=sys.stderr)
+        return 130
+
+    rows = write_output(args.out, records, project)
+    print(f"{processed} files processed ({failed} failed), {skipped} unchanged files skipped; {rows} rows written to {args.out}",
+          file=sys.stderr)
+    for usage in get_metrics().summary(project.title, by=("run",)):
+        if usage["run"] == run_id:
+            print(f"{usage['calls']} calls ({usage['retries']} retries, {usage['cache_hits']} cache hits), "
+                  f"{usage['prompt_tokens']} prompt ({usage['cached_rate']:.0%} cached) / {usage['completion_tokens']} completion tokens, "
+                  f"~${usage['cost_usd']:.4f}", file=sys.stderr)
+    for usage in get_metrics().summary(project.title, by=("run", "model")):
+        if usage["run"] == run_id:
+            print(f"  {usage['model']}: {usage['calls']} calls, p50 {usage['p50_s']:.2f}s, ~${usage['cost_usd']:.4f}", file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,283 @@
+# Bulk file ingestion: streams uploads, zip/tar archives and server-side directories, turns each
+# document into text in a process pool (encoding detection, PDF, DOCX and HTML) and yields the
+# results in input order, holding only a bounded number of documents in memory at a time.
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from html.parser import HTMLParser
+import io
+import logging
+import multiprocessing
+import os
+import tarfile
+import threading
+from typing import IO, Iterable, Iterator, NamedTuple, Tuple
+import zipfile
+from xml.etree import ElementTree
+
+from dotenv import load_dotenv
+
+from dedupe import minhash
+
+try:
+    from charset_normalizer import from_bytes
+except ImportError:
+    from_bytes = None
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+logger = logging.getLogger(__name__)
+load_dotenv()
+
+# Processes converting documents to text (0 or 1 converts them in the calling thread)
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Documents read ahead of the workers
+INGEST_WINDOW = int(os.getenv("INGEST_WINDOW", "64"))
+# Larger documents (or archive members) are skipped
+INGEST_MAX_FILE_BYTES = int(os.getenv("INGEST_MAX_FILE_BYTES", str(50 * 1024 * 1024)))
+# Server-side directories can only be ingested from below this path; empty disables them in the app
+INGEST_ROOT = os.getenv("INGEST_ROOT", "")
+
+ZIP_EXTENSIONS = (".zip",)
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+HTML_EXTENSIONS = (".html", ".htm", ".xhtml")
+DOCX_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+class IngestedFile(NamedTuple):
+    file_name: str
+    # None when the document was skipped
+    contents: str | None
+    error: str | None = None
+    # MinHash signature for near-duplicate detection, when asked for
+    signature: bytes | None = None
+
+def is_archive(name: str) -> bool:
+    return name.lower().endswith(ZIP_EXTENSIONS + TAR_EXTENSIONS)
+
+def skip_member(name: str) -> bool:
+    # Folder metadata that archivers add alongside the real files
+    parts = name.replace("\\", "/").split("/")
+    return any(part.startswith(".") or part == "__MACOSX" for part in parts)
+
+def iter_archive(name: str, fileobj: IO[bytes]) -> Iterator[Tuple[str, bytes | None, str | None]]:
+    # (member name, data, error) for each file in a zip or tar archive, one member in memory at a time
+    if name.lower().endswith(ZIP_EXTENSIONS):
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or skip_member(info.filename):
+                    continue
+                if info.file_size > INGEST_MAX_FILE_BYTES:
+                    yield info.filename, None, f"larger than {INGEST_MAX_FILE_BYTES} bytes"
+                    continue
+                yield info.filename, archive.read(info), None
+    else:
+        # Stream mode reads the archive front to back, so it doesn't need to be seekable
+        with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+            for member in archive:
+                if not member.isfile() or skip_member(member.name):
+                    continue
+                if member.size > INGEST_MAX_FILE_BYTES:
+                    yield member.name, None, f"larger than {INGEST_MAX_FILE_BYTES} bytes"
+                    continue
+                yield member.name, archive.extractfile(member).read(), None
+
+def iter_uploads(uploads: Iterable) -> Iterator[Tuple[str, bytes | None, str | None]]:
+    # Streamlit UploadedFiles (or any named binary file objects); archives are expanded
+    for upload in uploads:
+        if is_archive(upload.name):
+            try:
+                yield from iter_archive(upload.name, upload)
+            except (zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+                yield upload.name, None, f"unreadable archive: {str(e)}"
+        elif getattr(upload, "size", 0) > INGEST_MAX_FILE_BYTES:
+            yield upload.name, None, f"larger than {INGEST_MAX_FILE_BYTES} bytes"
+        else:
+            yield upload.name, upload.read(), None
+
+def iter_directory(root: str) -> Iterator[Tuple[str, bytes | None, str | None]]:
+    # Files below root (archives included), named by their path relative to it
+    for directory, dirs, names in os.walk(root):
+        dirs[:] = sorted(name for name in dirs if not name.startswith("."))
+        for name in sorted(names):
+            path = os.path.join(directory, name)
+            relative = os.path.relpath(path, root).replace(os.sep, "/")
+            if skip_member(relative):
+                continue
+            try:
+                if is_archive(name):
+                    with open(path, "rb") as f:
+                        for member, data, error in iter_archive(name, f):
+                            yield f"{relative}/{member}", data, error
+                elif os.path.getsize(path) > INGEST_MAX_FILE_BYTES:
+                    yield relative, None, f"larger than {INGEST_MAX_FILE_BYTES} bytes"
+                else:
+                    with open(path, "rb") as f:
+                        yield relative, f.read(), None
+            except (OSError, zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+                yield relative, None, str(e)
+
+def looks_western(text: str) -> bool:
+    # Western European text has a few accented letters among mostly ASCII ones; other scripts
+    # read as cp1252 are almost all accented letters
+    letters = [char for char in text if char.isalpha()]
+    return not letters or sum(not char.isascii() for char in letters) <= len(letters) * 0.3
+
+def decode_text(data: bytes) -> str:
+    # UTF-8 (with or without a BOM) and UTF-16 with a BOM directly, then cp1252 when it reads as
+    # Western European text (detectors often mistake it for other code pages), otherwise the
+    # detected encoding, falling back to cp1252 so a stray byte never fails a whole upload
+    if data.startswith((b"\xff\xfe", b"\xfe\xff")):
+        return data.decode("utf-16")
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        pass
+    if b"\x00" in data[:8192]:
+        raise ValueError("binary file")
+    try:
+        text = data.decode("cp1252")
+        if looks_western(text):
+            return text
+    except UnicodeDecodeError:
+        pass
+    if from_bytes is not None:
+        match = from_bytes(data).best()
+        if match is not None:
+            return str(match)
+    return data.decode("cp1252", errors="replace")
+
+class HTMLText(HTMLParser):
+    # Visible text of an HTML document, one line per block
+    SKIP = {"script", "style", "head", "noscript", "template"}
+    BLOCKS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "section", "article", "table"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self.skipping += 1
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP and self.skipping:
+            self.skipping -= 1
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+    def text(self) -> str:
+        lines = (" ".join(line.split()) for line in "".join(self.parts).splitlines())
+        return "\n".join(line for line in lines if line)
+
+def html_text(data: bytes) -> str:
+    parser = HTMLText()
+    parser.feed(decode_text(data))
+    parser.close()
+    return parser.text()
+
+def docx_text(data: bytes) -> str:
+    # Paragraph text from word/document.xml; no dependency needed for plain text
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        root = ElementTree.fromstring(archive.read("word/document.xml"))
+    paragraphs = []
+    for paragraph in root.iter(f"{DOCX_NAMESPACE}p"):
+        paragraphs.append("".join(
+            (node.text or "") if node.tag == f"{DOCX_NAMESPACE}t" else "\t" if node.tag == f"{DOCX_NAMESPACE}tab" else "\n"
+            for node in paragraph.iter()
+            if node.tag in (f"{DOCX_NAMESPACE}t", f"{DOCX_NAMESPACE}tab", f"{DOCX_NAMESPACE}br")
+        ))
+    return "\n".join(paragraphs)
+
+def pdf_text(data: bytes) -> str:
+    if PdfReader is None:
+        raise ValueError("PDF support requires pypdf")
+    return "\n\n".join(page.extract_text() or "" for page in PdfReader(io.BytesIO(data)).pages)
+
+def extract_text(file_name: str, data: bytes, signature: bool = False) -> IngestedFile:
+    # Runs in the worker processes, so it takes and returns only picklable values
+    extension = os.path.splitext(file_name)[1].lower()
+    try:
+        if extension == ".pdf":
+            contents = pdf_text(data)
+        elif extension == ".docx":
+            contents = docx_text(data)
+        elif extension in HTML_EXTENSIONS:
+            contents = html_text(data)
+        else:
+            contents = decode_text(data)
+    except Exception as e:
+        return IngestedFile(file_name, None, str(e) or type(e).__name__)
+    if not contents.strip():
+        return IngestedFile(file_name, None, "no text")
+    return IngestedFile(file_name, contents, signature=minhash(contents) if signature else None)
+
+_executor: ProcessPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+def get_ingest_executor(workers: int = INGEST_WORKERS) -> ProcessPoolExecutor:
+    # One pool per process, started on first use and kept for later uploads. Workers are spawned
+    # rather than forked: the app's process has threads, connections and locks in use that a
+    # forked child would inherit in whatever state they were in.
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+def reset_ingest_executor(executor: ProcessPoolExecutor):
+    # Drops a pool whose worker died so the next ingest starts a new one
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+class Done:
+    # Stands in for a future whose result is already known
+    def __init__(self, result):
+        self._result = result
+
+    def result(self):
+        return self._result
+
+def ingest(documents: Iterable[Tuple[str, bytes | None, str | None]], workers: int = INGEST_WORKERS,
+           window: int = INGEST_WINDOW, executor: Executor | None = None) -> Iterator[IngestedFile]:
+    # Converts (name, data, error) documents to text and MinHash signatures, yielding results in
+    # input order. At most window documents are in flight, so memory stays flat however many there are.
+    if executor is None and workers <= 1:
+        for file_name, data, error in documents:
+            yield IngestedFile(file_name, None, error) if data is None else extract_text(file_name, data, True)
+        return
+
+    shared = executor is None
+    executor = executor if executor is not None else get_ingest_executor(workers)
+    pending = deque()
+    try:
+        for file_name, data, error in documents:
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            if data is None:
+                pending.append(Done(IngestedFile(file_name, None, error)))
+            else:
+                pending.append(executor.submit(extract_text, file_name, data, True))
+        while pending:
+            yield pending.popleft().result()
+    except BrokenProcessPool:
+        if shared:
+            reset_ingest_executor(executor)
+        raise
+    finally:
+        # Documents still queued when the caller stops early aren't converted for nothing
+        for future in pending:
+            if not isinstance(future, Done):
+                future.cancel()
@@ -0,0 +1,265 @@
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+import uuid
+
+from dotenv import load_dotenv
+
+from model import LLMHelper, ResponseSchemaResults
+from runner import DEFAULT_MAX_WORKERS, run_files
+from dedupe import DEDUPE_THRESHOLD
+from project import FileState, Project, ProjectsManager, ProjectState, TextFile
+
+logger = logging.getLogger(__name__)
+load_dotenv()
+
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", ".cache/jobs.sqlite")
+JOB_MAX_CONCURRENT = int(os.getenv("JOB_MAX_CONCURRENT", "2"))
+
+class JobState(Enum):
+    QUEUED = "Queued"
+    RUNNING = "Running"
+    COMPLETE = "Complete"
+    CANCELLED = "Cancelled"
+    ERROR = "Error"
+    INTERRUPTED = "Interrupted"
+
+# Jobs in these states can be resumed to process the files they did not finish
+RESUMABLE_STATES = {JobState.CANCELLED, JobState.ERROR, JobState.INTERRUPTED}
+
+class Job:
+    def __init__(self, project: Project, files: List[TextFile], max_workers: int = DEFAULT_MAX_WORKERS, pack_tokens: int = 0,
+                 dedupe_threshold: float = DEDUPE_THRESHOLD):
+        self.id = uuid.uuid4().hex
+        self.project = project
+        self.files = files
+        self.max_workers = max_workers
+        self.pack_tokens = pack_tokens
+        self.dedupe_threshold = dedupe_threshold
+        # Restored when the job is cancelled; a stale RUNNING (from an interrupted process) counts as COMPLETE
+        self.previous_state = ProjectState.COMPLETE if project.state == ProjectState.RUNNING else project.state
+        self.state = JobState.QUEUED
+        self.total = len(files)
+        self.done = 0
+        self.failed = 0
+        self.error = None
+        self.cancel_event = threading.Event()
+
+    @property
+    def active(self) -> bool:
+        return self.state in (JobState.QUEUED, JobState.RUNNING)
+
+class JobStore:
+    # Job and per-file progress records, so a run can be inspected and resumed after a restart
+    def __init__(self, path: str = JOBS_DB_PATH):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, project_title TEXT NOT NULL, state TEXT NOT NULL, total INTEGER NOT NULL, "
+                "done INTEGER NOT NULL, failed INTEGER NOT NULL, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_project ON jobs (project_title, created_at)")
+            # Jobs are looked up by project id (titles aren't unique and can change); the title is
+            # kept for reference, and for assigning ids to jobs recorded before the column
+            if "project_id" not in {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}:
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN project_id INTEGER")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_project_id ON jobs (project_id, created_at)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_files ("
+                "job_id TEXT NOT NULL, file_index INTEGER NOT NULL, file_name TEXT NOT NULL, state TEXT NOT NULL, "
+                "results TEXT, PRIMARY KEY (job_id, file_index))"
+            )
+            # The project version each finished file was extracted with and the contents it was
+            # extracted from, added after the table
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(job_files)")}
+            if "run_version" not in columns:
+                self._conn.execute("ALTER TABLE job_files ADD COLUMN run_version TEXT")
+            if "content_hash" not in columns:
+                self._conn.execute("ALTER TABLE job_files ADD COLUMN content_hash TEXT")
+            self._conn.commit()
+
+    def save_job(self, job: Job):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, project_id, project_title, state, total, done, failed, error, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET "
+                "project_title = excluded.project_title, state = excluded.state, done = excluded.done, failed = excluded.failed, "
+                "error = excluded.error, updated_at = excluded.updated_at",
+                (job.id, job.project.id, job.project.title, job.state.value, job.total, job.done, job.failed, job.error, now, now)
+            )
+            self._conn.commit()
+
+    def save_file(self, job: Job, file_index: int, file: TextFile):
+        results = json.dumps([result.to_dict() for result in file.results]) if file.state == FileState.FINISHED else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO job_files (job_id, file_index, file_name, state, results, run_version, content_hash) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job.id, file_index, file.file_name, file.state.value, results, file.run_version, file.content_hash)
+            )
+            self._conn.execute(
+                "UPDATE jobs SET done = ?, failed = ?, updated_at = ? WHERE id = ?",
+                (job.done, job.failed, time.time(), job.id)
+            )
+            self._conn.commit()
+
+    def assign_project_ids(self, project_ids: Dict[str, int]):
+        # Jobs recorded before project ids were kept, matched by title
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE jobs SET project_id = ? WHERE project_id IS NULL AND project_title = ?",
+                ((project_id, title) for title, project_id in project_ids.items())
+            )
+            self._conn.commit()
+
+    def latest_job(self, project_id: int) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, state, total, done, failed, error FROM jobs WHERE project_id = ? ORDER BY created_at DESC LIMIT 1",
+                (project_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"id": row[0], "state": JobState(row[1]), "total": row[2], "done": row[3], "failed": row[4], "error": row[5]}
+
+    def finished_files(self, project_id: int) -> Dict[int, dict]:
+        # Most recent finished result per file index across all of the project's jobs
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT f.file_index, f.file_name, f.results, f.run_version, f.content_hash FROM job_files f JOIN jobs j ON j.id = f.job_id "
+                "WHERE j.project_id = ? AND f.state = ? ORDER BY j.created_at",
+                (project_id, FileState.FINISHED.value)
+            ).fetchall()
+        return {
+            file_index: {"file_name": file_name, "results": json.loads(results), "run_version": run_version, "content_hash": content_hash}
+            for file_index, file_name, results, run_version, content_hash in rows
+        }
+
+    def mark_interrupted(self):
+        # Jobs left active by a previous process will never finish on their own
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, updated_at = ? WHERE state IN (?, ?)",
+                (JobState.INTERRUPTED.value, time.time(), JobState.QUEUED.value, JobState.RUNNING.value)
+            )
+            self._conn.commit()
+
+class JobManager:
+    def __init__(self, llm: LLMHelper | None = None, store: JobStore | None = None, max_concurrent: int = JOB_MAX_CONCURRENT,
+                 projects_manager: ProjectsManager | None = None):
+        self.llm = llm if llm is not None else LLMHelper()
+        self.store = store if store is not None else JobStore()
+        # When set, file progress is also written through to the project store as it happens
+        self.projects_manager = projects_manager
+        self.store.mark_interrupted()
+        if projects_manager is not None:
+            # Only titles that name a single project can be attributed
+            index = projects_manager.index
+            self.store.assign_project_ids({title: next(iter(ids)) for title, ids in index.by_title.items() if len(ids) == 1})
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="job")
+        self.jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, project: Project, files: List[TextFile] | None = None, max_workers: int = DEFAULT_MAX_WORKERS, pack_tokens: int = 0,
+               dedupe_threshold: float = DEDUPE_THRESHOLD) -> Job:
+        job = Job(project, project.files if files is None else files, max_workers, pack_tokens, dedupe_threshold)
+        for file in job.files:
+            file.state = FileState.NOT_STARTED
+        project.state = ProjectState.RUNNING
+        if self.projects_manager is not None:
+            self.projects_manager.save_project(project)
+        with self._lock:
+            self.jobs[job.id] = job
+        self.store.save_job(job)
+        self.executor.submit(self._run, job)
+        return job
+
+    def _run(self, job: Job):
+        if job.cancel_event.is_set():
+            self._finish(job, JobState.CANCELLED)
+            return
+
+        job.state = JobState.RUNNING
+        self.store.save_job(job)
+        index = {id(file): i for i, file in enumerate(job.project.files)}
+
+        def on_file_done(file, error):
+            job.done += 1
+            if error is not None:
+                job.failed += 1
+            self.store.save_file(job, index[id(file)], file)
+            if self.projects_manager is not None:
+                self.projects_manager.save_file(job.project, file)
+
+        try:
+            run_files(job.project, job.files, max_workers=job.max_workers, llm=self.llm, pack_tokens=job.pack_tokens,
+                      on_file_done=on_file_done, cancel_event=job.cancel_event, run_id=job.id, dedupe_threshold=job.dedupe_threshold)
+        except Exception as e:
+            logger.error(f"Error running job {job.id}: {str(e)}")
+            job.error = str(e)
+            self._finish(job, JobState.ERROR)
+            return
+
+        if job.cancel_event.is_set() and job.done < job.total:
+            self._finish(job, JobState.CANCELLED)
+        elif job.failed:
+            self._finish(job, JobState.ERROR)
+        else:
+            self._finish(job, JobState.COMPLETE)
+
+    def _finish(self, job: Job, state: JobState):
+        job.state = state
+        # Cancelling isn't a failure: the project goes back to how it was, and the job's state
+        # (shown as the last run) records the cancellation
+        if state == JobState.CANCELLED:
+            job.project.state = job.previous_state
+        else:
+            job.project.state = ProjectState.COMPLETE if state == JobState.COMPLETE else ProjectState.ERROR
+        self.store.save_job(job)
+        if self.projects_manager is not None:
+            self.projects_manager.save_project(job.project)
+
+    def cancel(self, job_id: str):
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel_event.set()
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def active_job(self, project: Project) -> Job | None:
+        with self._lock:
+            for job in self.jobs.values():
+                if job.project is project and job.active:
+                    return job
+        return None
+
+    def resume(self, project: Project, max_workers: int = DEFAULT_MAX_WORKERS, pack_tokens: int = 0) -> Job:
+        # Restore the results already saved for this project, then run only the files still
+        # pending. A result is only restored to a file that needs one and still has the contents
+        # it was extracted from; records from before hashes were kept are never restored.
+        version = project.run_version
+        for file_index, record in self.store.finished_files(project.id).items():
+            if file_index >= len(project.files):
+                continue
+            file = project.files[file_index]
+            if file.file_name != record["file_name"] or file.content_hash != record["content_hash"] or not project.needs_run(file, version):
+                continue
+            file.results = [ResponseSchemaResults.from_dict(result) for result in record["results"]]
+            file.state = FileState.FINISHED
+            # Jobs recorded before versions were kept count as extracted with the current one
+            file.run_version = record["run_version"] or version
+        return self.submit(project, project.pending_files(), max_workers, pack_tokens)
@@ -1,14 +1,27 @@
-import csv
+import os
 import streamlit as st
-from util import FileState, ProjectsManager, ProjectState, TextFile
+from util import FileState, ProjectsManager, ProjectState, get_llm_helper
 from create_project import create_project_workflow
-from model import LLMHelper
+from runner import DEFAULT_MAX_WORKERS, PACK_MAX_TOKENS
+from cache import get_extraction_cache
+from batch import BatchRunner, LocalBatchClient
+from jobs import RESUMABLE_STATES, JobManager
+from results import export_formats
+from metrics import get_metrics
+from routing import ROUTING_POLICIES, ROUTING_POLICY
+from ingest import INGEST_ROOT, ingest, iter_directory, iter_uploads
+from dedupe import DEDUPE_THRESHOLD
 import pandas as pd
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Seconds between status refreshes while a background run is in progress
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+# Rows of the project list, file table and results table sent to the browser per page
+UI_PAGE_SIZE = int(os.getenv("UI_PAGE_SIZE", "100"))
+
 projects_manager = ProjectsManager()
 
 def main():
@@ -30,11 +43,17 @@ def setup_sidebar():
     
     st.sidebar.button("Create New Project", on_click=set_current_view, args=('create_project',))
 
-    project_list = [p.title for p in projects_manager.projects]
+    state_filter = st.sidebar.selectbox(
+        "Show projects",
+        options=[None, *ProjectState],
+        format_func=lambda state: state.value if state else "All states",
+        key='project_state_filter'
+    )
+    # Options are project ids, so labels are looked up in the registry rather than by scanning it
     st.sidebar.selectbox(
         "Select a project:",
-        options=project_list,
-        format_func=lambda x: f"{x} ({next(p for p in projects_manager.projects if p.title == x).state.value})",
+        options=projects_manager.project_ids(state_filter),
+        format_func=project_label,
         key='selected_project',
         on_change=update_selected_project
     )
@@ -42,13 +61,43 @@ def setup_sidebar():
     st.sidebar.file_uploader("Import Projects", type="json", on_change=import_projects, key="project_import")
 
     if projects_manager.projects:
+        # Built only when the download is clicked, on Streamlit's download thread
         st.sidebar.download_button(
             label="Export Projects",
-            data=projects_manager.save_to_file(),
+            data=projects_manager.save_to_file,
             file_name="projects.json",
-            mime="application/json"
+            mime="application/json",
+            on_click="ignore"
         )
 
+    show_cache_stats()
+
+def show_cache_stats():
+    cache = get_extraction_cache()
+    if cache is None:
+        return
+    stats = cache.stats()
+    st.sidebar.caption(f"Extraction cache: {stats['hits']} hits / {stats['misses']} misses ({stats['entries']} entries)")
+    st.sidebar.button("Clear Cache", on_click=cache.clear)
+
+def project_label(project_id):
+    project = projects_manager.get(project_id)
+    return f"{project.title} ({project.state.value})" if project is not None else str(project_id)
+
+def paginate(total, key, label="Rows", page_size=UI_PAGE_SIZE):
+    # Start and stop of the rows on the chosen page, with a page picker once there is more than one
+    if total <= page_size:
+        return 0, total
+    pages = -(-total // page_size)
+    # The table may have shrunk since the page was picked
+    if st.session_state.get(key, 1) > pages:
+        st.session_state[key] = pages
+    page = st.number_input(f"{label} page (of {pages})", min_value=1, max_value=pages, value=1, key=key)
+    start = (int(page) - 1) * page_size
+    stop = min(start + page_size, total)
+    st.caption(f"{label} {start + 1}-{stop} of {total}")
+    return start, stop
+
 def set_current_view(view):
     st.session_state['current_view'] = view
     st.session_state.pop('confirm_delete', None)
@@ -63,25 +112,63 @@ def import_projects():
 
 def show_project_list():
     st.title("Projects")
-    for project in projects_manager.projects:
-        st.write(f"{project.title} ({project.state.value})")
-    
-    if st.session_state.get('selected_project'):
-        project = next(p for p in projects_manager.projects if p.title == st.session_state.selected_project)
+    project_ids = projects_manager.project_ids(st.session_state.get('project_state_filter'))
+    start, stop = paginate(len(project_ids), "project_list_page", "Projects")
+    page = [projects_manager.get(project_id) for project_id in project_ids[start:stop]]
+    st.dataframe(pd.DataFrame({
+        "title": [project.title for project in page],
+        "state": [project.state.value for project in page]
+    }), hide_index=True)
+
+    project = projects_manager.get(st.session_state.get('selected_project'))
+    if project is not None:
         show_project_details(project)
 
 def show_project_details(project):
     st.title(project.title)
     st.write(project.description)
     
+    run_mode = st.radio("Run mode", ["Interactive", "Batch API"], horizontal=True, key=f"run_mode_{project.id}")
+
+    if run_mode == "Interactive":
+        max_workers = st.number_input("Concurrent requests", min_value=1, max_value=64, value=DEFAULT_MAX_WORKERS, key=f"max_workers_{project.id}")
+        pack_small_files = st.checkbox("Pack small files into shared requests", value=PACK_MAX_TOKENS > 0, key=f"pack_files_{project.id}")
+        pack_tokens = PACK_MAX_TOKENS if pack_small_files else 0
+        policies = [None, *ROUTING_POLICIES]
+        st.selectbox(
+            "Model routing",
+            options=policies,
+            index=policies.index(project.routing_policy) if project.routing_policy in policies else 0,
+            format_func=lambda policy: policy or f"default ({ROUTING_POLICY})",
+            key=f"routing_policy_{project.id}",
+            on_change=save_routing_policy,
+            args=(project,)
+        )
+    elif project.batch_id:
+        st.info(f"Batch {project.batch_id} submitted")
+
+    pending = len(project.pending_files())
     col1, col2 = st.columns(2)
     with col1:
-        st.button("Run", key=f"run_project_{project.title}", on_click=run_project, args=(project,))
+        if run_mode == "Interactive":
+            running = get_job_manager().active_job(project) is not None
+            st.button(f"Run ({pending} pending)", key=f"run_project_{project.id}", on_click=run_project,
+                      args=(project, int(max_workers), pack_tokens), disabled=running or not pending)
+            st.button("Re-run all", key=f"rerun_project_{project.id}", on_click=run_project,
+                      args=(project, int(max_workers), pack_tokens, True), disabled=running or not project.files)
+            latest_job = get_job_manager().store.latest_job(project.id)
+            if not running and latest_job and latest_job["state"] in RESUMABLE_STATES:
+                st.button("Resume", key=f"resume_project_{project.id}", on_click=resume_project, args=(project, int(max_workers), pack_tokens))
+        elif project.batch_id:
+            st.button("Check Batch Status", key=f"poll_batch_{project.id}", on_click=poll_batch, args=(project,))
+        else:
+            st.button(f"Submit Batch ({pending} pending)", key=f"submit_batch_{project.id}", on_click=submit_batch, args=(project,),
+                      disabled=not pending)
     with col2:
-        st.button("Delete", key=f"delete_project_{project.title}", on_click=confirm_delete_project, args=(project,))
+        st.button("Delete", key=f"delete_project_{project.id}", on_click=confirm_delete_project, args=(project,))
     
     if st.session_state.get('confirm_delete'):
-        st.button("Confirm Delete", key=f"confirm_delete_{project.title}", on_click=delete_project, args=(project,))
+        st.button("Confirm Delete", key=f"confirm_delete_{project.id}", on_click=delete_project, args=(project,))
     
     new_title = st.text_input("Title", value=project.title, key="edit_project_title")
     new_description = st.text_area("Description", value=project.description, key="edit_project_description")
@@ -92,6 +179,11 @@ def show_project_details(project):
     display_schema(project)
     display_files(project)
     display_results(project)
+    show_usage_stats(project)
+
+def save_routing_policy(project):
+    project.routing_policy = st.session_state[f"routing_policy_{project.id}"]
+    projects_manager.save_project(project)
 
 def confirm_delete_project(project):
     st.session_state['confirm_delete'] = True
@@ -121,68 +213,196 @@ def display_schema(project):
 def display_files(project):
     st.subheader("Files")
 
-    st.file_uploader("Add files", accept_multiple_files=True, key="add_files", on_change=add_files_to_project, args=(project,))
+    st.file_uploader("Add files (text, PDF, DOCX, HTML, or zip/tar archives of them)", accept_multiple_files=True, key="add_files",
+                     on_change=add_files_to_project, args=(project,))
+    if INGEST_ROOT:
+        st.text_input(f"Add a folder on the server (under {INGEST_ROOT})", key=f"add_directory_{project.id}",
+                      on_change=add_directory_to_project, args=(project,))
 
     if project.files:
-        df = pd.DataFrame({"file_name": [file.file_name for file in project.files], "state": [file.state.value for file in project.files]})
+        version = project.run_version
+        start, stop = paginate(len(project.files), f"files_page_{project.id}", "Files")
+        files = project.files[start:stop]
+        df = pd.DataFrame({
+            "file_name": [file.file_name for file in files],
+            "state": [file.state.value for file in files],
+            "needs_run": [project.needs_run(file, version) for file in files],
+            "duplicate_of": [file.duplicate_of for file in files]
+        })
         st.dataframe(df, hide_index=True)
+        reused = sum(file.duplicate_of is not None and file.state == FileState.FINISHED for file in project.files)
+        if reused:
+            st.caption(f"{reused} near-duplicate file(s) reused the results of a similar file ({reused} extraction calls saved)")
 
 def add_files_to_project(project):
     if st.session_state.add_files:
-        for file in st.session_state.add_files:
-            file_contents = file.read().decode("utf-8")
-            new_file = TextFile(file.name, file_contents)
-            project.files.append(new_file)
+        add_documents(project, iter_uploads(st.session_state.add_files))
+
+def add_directory_to_project(project):
+    directory = st.session_state[f"add_directory_{project.id}"]
+    if not directory:
+        return
+    root = os.path.realpath(INGEST_ROOT)
+    path = os.path.realpath(os.path.join(root, directory))
+    if os.path.commonpath([root, path]) != root or not os.path.isdir(path):
+        st.error(f"{directory} is not a folder under {INGEST_ROOT}")
+        return
+    add_documents(project, iter_directory(path))
+
+def add_documents(project, documents):
+    # Documents are converted to text in worker processes and written to the store in batches
+    skipped = []
+
+    def texts():
+        for document in ingest(documents):
+            if document.contents is None:
+                skipped.append(document)
+            else:
+                yield document.file_name, document.contents, document.signature
+
+    with st.spinner("Adding files..."):
+        outcomes = projects_manager.add_files(project, texts())
         projects_manager.save_project(project)
-        st.success(f"{len(st.session_state.add_files)} file(s) added successfully!")
+    st.success(f"{outcomes['added']} file(s) added, {outcomes['updated']} updated, {outcomes['duplicate']} already in the project")
+    if skipped:
+        details = ", ".join(f"{document.file_name} ({document.error})" for document in skipped[:10])
+        st.warning(f"{len(skipped)} file(s) skipped: {details}{', ...' if len(skipped) > 10 else ''}")
 
 def display_results(project):
-    finished_files = [file for file in project.files if file.state.value == "Finished"]
+    if show_job_status(project):
+        return
+
+    table = project.results_table
     
-    if finished_files:
+    if len(table):
         st.subheader("Results")
         
-        all_results = []
-        for file in finished_files:
-            all_results.extend(file.results)
-        
-        df = pd.DataFrame([
-            {field.name: field.value for field in result.data_fields}
-            for result in all_results
-        ])
+        start, stop = paginate(len(table), f"results_page_{project.id}")
+        df = table.to_dataframe(start=start, stop=stop)
         
         st.dataframe(df, hide_index=True)
         
-        csvData = df.to_csv(index=False, quoting=csv.QUOTE_ALL, escapechar='\\',lineterminator=';',encoding='utf-8')
-        csvData = csvData.replace('\n', '\\n').replace('\r', '').replace(';', '\n')
+        formats = export_formats()
+        export_format = st.selectbox("Download format", options=list(formats), key=f"export_format_{project.id}")
+        writer, extension, mime = formats[export_format]
+        # The export is only built when the button is clicked, not on every rerun
         st.download_button(
-            label="Download data as CSV",
-            data=csvData,
-            file_name="extracted_data.csv",
-            mime="text/csv",
+            label=f"Download data as {export_format}",
+            data=getattr(table, writer),
+            file_name=f"extracted_data.{extension}",
+            mime=mime,
+            on_click="ignore"
         )
 
-def run_project(project):
-    project.state = ProjectState.RUNNING
+def show_usage_stats(project):
+    # Calls made by this process for the project: time, tokens and estimated cost per step and per run
+    metrics = get_metrics()
+    by_step = metrics.summary(project.title, by=("step",))
+    if not by_step:
+        return
+
+    with st.expander("Usage and cost"):
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Calls", sum(row["calls"] for row in by_step))
+        col2.metric("Tokens", sum(row["prompt_tokens"] + row["completion_tokens"] for row in by_step))
+        col3.metric("Cached tokens", sum(row["cached_tokens"] for row in by_step))
+        col4.metric("Estimated cost", f"${sum(row['cost_usd'] for row in by_step):.4f}")
+
+        st.caption("By step")
+        st.dataframe(pd.DataFrame(by_step), hide_index=True)
+        st.caption("By run")
+        st.dataframe(pd.DataFrame(metrics.summary(project.title, by=("run",))), hide_index=True)
+        st.caption("By model")
+        st.dataframe(pd.DataFrame(metrics.summary(project.title, by=("model",))), hide_index=True)
+        routes = metrics.route_summary(project.title)
+        if routes:
+            st.caption("Routing decisions")
+            st.dataframe(pd.DataFrame(routes), hide_index=True)
+
+        st.download_button(
+            label="Download Prometheus metrics",
+            data=metrics.prometheus_text,
+            file_name="metrics.prom",
+            mime="text/plain",
+            on_click="ignore",
+            key=f"download_metrics_{project.id}"
+        )
+
+@st.cache_resource
+def get_batch_runner() -> BatchRunner:
+    if os.getenv("OPENAI_BATCH_MOCK"):
+        return BatchRunner(get_llm_helper(), LocalBatchClient())
+    return BatchRunner(get_llm_helper())
+
+def submit_batch(project):
+    try:
+        get_batch_runner().submit(project, project.pending_files())
+    except Exception as e:
+        st.error(f"Error submitting batch: {str(e)}")
+        return
     projects_manager.save_project(project)
-    
-    for file in project.files:
-        try:
-            file = run_file(file, project)
-        except Exception as e:
-            logger.error(f"Error processing file {file.file_name}: {str(e)}")
-            project.state = ProjectState.ERROR
-            projects_manager.save_project(project)
-            return
-    
-    project.state = ProjectState.COMPLETE
+
+def poll_batch(project):
+    try:
+        batch = get_batch_runner().poll(project)
+    except Exception as e:
+        st.error(f"Error checking batch: {str(e)}")
+        return
     projects_manager.save_project(project)
+    if batch is not None and not project.batch_id:
+        st.success(f"Batch {batch.id} {batch.status}")
+    elif batch is not None:
+        st.info(f"Batch {batch.id} is {batch.status} ({batch.request_counts.completed}/{batch.request_counts.total} requests done)")
+
+@st.cache_resource
+def get_job_manager() -> JobManager:
+    # Process-wide, so jobs keep running across reruns and browser refreshes
+    return JobManager(get_llm_helper(), projects_manager=ProjectsManager())
+
+def run_project(project, max_workers=DEFAULT_MAX_WORKERS, pack_tokens=0, rerun_all=False):
+    # Only new, modified, failed and stale files run unless everything is asked for. Re-running
+    # everything extracts every file itself, so results reused from a near duplicate can be redone.
+    files = project.files if rerun_all else project.pending_files()
+    if not files:
+        st.info("All files are up to date")
+        return
+    get_job_manager().submit(project, files, max_workers=max_workers, pack_tokens=pack_tokens,
+                             dedupe_threshold=0 if rerun_all else DEDUPE_THRESHOLD)
+
+def resume_project(project, max_workers=DEFAULT_MAX_WORKERS, pack_tokens=0):
+    get_job_manager().resume(project, max_workers=max_workers, pack_tokens=pack_tokens)
+
+def cancel_job(job_id):
+    get_job_manager().cancel(job_id)
+
+def show_job_status(project):
+    job = get_job_manager().active_job(project)
+    if job is not None:
+        job_progress(job.id)
+        return True
+
+    latest_job = get_job_manager().store.latest_job(project.id)
+    if latest_job and latest_job["failed"]:
+        st.warning(f"Last run: {latest_job['failed']} of {latest_job['total']} file(s) failed")
+    if latest_job and latest_job["state"] in RESUMABLE_STATES:
+        st.info(f"Last run {latest_job['state'].value.lower()} after {latest_job['done']} of {latest_job['total']} file(s)")
+    return False
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def job_progress(job_id):
+    job = get_job_manager().get(job_id)
+    if job is None or not job.active:
+        st.rerun(scope="app")
+
+    st.subheader("Results")
+    progress = job.done / job.total if job.total else 1.0
+    st.progress(progress, text=f"{job.state.value}: {job.done}/{job.total} files processed ({job.failed} failed)")
+    st.button("Cancel Run", key=f"cancel_job_{job.id}", on_click=cancel_job, args=(job.id,), disabled=job.cancel_event.is_set())
 
-def run_file(file, project):
-    file.state = FileState.RUNNING
-    file.results = LLMHelper().run_schema(project.prompt, file.contents, project.schema)
-    file.state = FileState.FINISHED
-    return file
+    # The latest rows only; the whole table is paged through once the run is over
+    table = job.project.results_table
+    if len(table):
+        st.dataframe(table.to_dataframe(start=max(0, len(table) - UI_PAGE_SIZE)), hide_index=True)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,266 @@
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import contextvars
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterator, List
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+load_dotenv()
+
+# Every call is appended here as one JSON line when set
+METRICS_TRACE_PATH = os.getenv("METRICS_TRACE_PATH", "")
+# Serve Prometheus text metrics on this port when set
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Latency samples kept per aggregate for percentiles
+METRICS_SAMPLES = int(os.getenv("METRICS_SAMPLES", "1000"))
+
+# USD per million tokens: (prompt, cached prompt, completion)
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1": (2.00, 0.50, 8.00)
+}
+MODEL_PRICES.update(json.loads(os.getenv("MODEL_PRICES", "{}")))
+
+# project, run and file labels of the work in progress, set by whoever starts it
+_labels: contextvars.ContextVar[Dict[str, str]] = contextvars.ContextVar("metrics_labels", default={})
+
+@contextmanager
+def call_labels(**labels):
+    token = _labels.set({**_labels.get(), **{key: str(value) for key, value in labels.items() if value is not None}})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+def current_labels() -> Dict[str, str]:
+    return _labels.get()
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> float:
+    prices = next((MODEL_PRICES[name] for name in sorted(MODEL_PRICES, key=len, reverse=True) if model.startswith(name)), None)
+    if prices is None:
+        return 0.0
+    prompt_price, cached_price, completion_price = prices
+    return ((prompt_tokens - cached_tokens) * prompt_price + cached_tokens * cached_price + completion_tokens * completion_price) / 1_000_000
+
+class Aggregate:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.retries = 0
+        self.wall_s = 0.0
+        self.queue_wait_s = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.cost_usd = 0.0
+        self.latencies = deque(maxlen=METRICS_SAMPLES)
+
+    def add(self, record: dict):
+        if record["cache_hit"]:
+            self.cache_hits += 1
+            return
+        self.calls += 1
+        self.errors += record["error"] is not None
+        self.retries += record["retries"]
+        self.wall_s += record["wall_s"]
+        self.queue_wait_s += record["queue_wait_s"]
+        self.prompt_tokens += record["prompt_tokens"]
+        self.completion_tokens += record["completion_tokens"]
+        self.cached_tokens += record["cached_tokens"]
+        self.cost_usd += record["cost_usd"]
+        self.latencies.append(record["wall_s"])
+
+    def percentile(self, fraction: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "cache_hits": self.cache_hits,
+            "retries": self.retries,
+            "wall_s": round(self.wall_s, 3),
+            "queue_wait_s": round(self.queue_wait_s, 3),
+            "p50_s": round(self.percentile(0.5), 3),
+            "p95_s": round(self.percentile(0.95), 3),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            # Share of prompt tokens served from the provider's prompt cache
+            "cached_rate": round(self.cached_tokens / self.prompt_tokens, 3) if self.prompt_tokens else 0.0,
+            "cost_usd": round(self.cost_usd, 6)
+        }
+
+class MetricsRecorder:
+    # Per-call telemetry aggregated by (project, run, step, model), with an optional JSON Lines
+    # trace of every call. Aggregates live for the lifetime of the process.
+    def __init__(self, trace_path: str = METRICS_TRACE_PATH):
+        self.trace_path = trace_path
+        self.aggregates: Dict[tuple, Aggregate] = defaultdict(Aggregate)
+        # Model routing decisions counted by (project, run, step, model, reason)
+        self.routes: Dict[tuple, int] = defaultdict(int)
+        self._trace = None
+        self._lock = threading.Lock()
+
+    def record(self, step: str, model: str, wall_s: float = 0.0, queue_wait_s: float = 0.0, retries: int = 0,
+               usage=None, error: Exception | None = None, cache_hit: bool = False):
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        cached_tokens = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", 0) or 0
+        labels = current_labels()
+        record = {
+            "time": time.time(),
+            "project": labels.get("project", ""),
+            "run": labels.get("run", ""),
+            "file": labels.get("file", ""),
+            "step": step,
+            "model": model,
+            "cache_hit": cache_hit,
+            "wall_s": wall_s,
+            "queue_wait_s": queue_wait_s,
+            "retries": retries,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cached_tokens": cached_tokens,
+            "cost_usd": estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens),
+            "error": str(error) if error is not None else None
+        }
+        with self._lock:
+            self.aggregates[(record["project"], record["run"], step, model)].add(record)
+            if self.trace_path:
+                self.write_trace(record)
+
+    def record_route(self, step: str, model: str, tier: int, reason: str):
+        labels = current_labels()
+        record = {
+            "time": time.time(),
+            "project": labels.get("project", ""),
+            "run": labels.get("run", ""),
+            "file": labels.get("file", ""),
+            "step": step,
+            "route": reason,
+            "model": model,
+            "tier": tier
+        }
+        with self._lock:
+            self.routes[(record["project"], record["run"], step, model, reason)] += 1
+            if self.trace_path:
+                self.write_trace(record)
+
+    def write_trace(self, record: dict):
+        try:
+            if self._trace is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.trace_path)), exist_ok=True)
+                self._trace = open(self.trace_path, "a", encoding="utf-8")
+            self._trace.write(json.dumps(record) + "\n")
+            self._trace.flush()
+        except OSError as e:
+            logger.error(f"Error writing metrics trace {self.trace_path}: {str(e)}")
+            self.trace_path = ""
+
+    def summary(self, project: str | None = None, by: tuple = ("step",)) -> List[dict]:
+        # Aggregates for one project (or all), grouped by any of "project", "run", "step" and "model"
+        fields = ("project", "run", "step", "model")
+        grouped: Dict[tuple, Aggregate] = defaultdict(Aggregate)
+        with self._lock:
+            for key, aggregate in self.aggregates.items():
+                labels = dict(zip(fields, key))
+                if project is not None and labels["project"] != project:
+                    continue
+                merged = grouped[tuple(labels[field] for field in by)]
+                for attribute in ("calls", "errors", "cache_hits", "retries", "wall_s", "queue_wait_s",
+                                  "prompt_tokens", "completion_tokens", "cached_tokens", "cost_usd"):
+                    setattr(merged, attribute, getattr(merged, attribute) + getattr(aggregate, attribute))
+                merged.latencies.extend(aggregate.latencies)
+        return [dict(zip(by, key), **aggregate.to_dict()) for key, aggregate in sorted(grouped.items())]
+
+    def route_summary(self, project: str | None = None, by: tuple = ("model", "reason")) -> List[dict]:
+        # Routing decisions for one project (or all), grouped by any of "project", "run", "step", "model" and "reason"
+        fields = ("project", "run", "step", "model", "reason")
+        grouped: Dict[tuple, int] = defaultdict(int)
+        with self._lock:
+            for key, count in self.routes.items():
+                labels = dict(zip(fields, key))
+                if project is not None and labels["project"] != project:
+                    continue
+                grouped[tuple(labels[field] for field in by)] += count
+        return [dict(zip(by, key), decisions=count) for key, count in sorted(grouped.items())]
+
+    def iter_prometheus(self) -> Iterator[str]:
+        # Prometheus text exposition format; labelled by project, step and model to keep cardinality bounded
+        totals = self.summary(by=("project", "step", "model"))
+        series = (
+            ("llm_calls_total", "counter", "Chat completion calls", "calls"),
+            ("llm_call_errors_total", "counter", "Chat completion calls that failed after retries", "errors"),
+            ("llm_cache_hits_total", "counter", "Requests answered from the extraction cache", "cache_hits"),
+            ("llm_retries_total", "counter", "Retried chat completion attempts", "retries"),
+            ("llm_call_seconds_total", "counter", "Wall time spent in chat completion calls", "wall_s"),
+            ("llm_queue_wait_seconds_total", "counter", "Time spent waiting on the rate limiter", "queue_wait_s"),
+            ("llm_prompt_tokens_total", "counter", "Prompt tokens", "prompt_tokens"),
+            ("llm_completion_tokens_total", "counter", "Completion tokens", "completion_tokens"),
+            ("llm_cached_tokens_total", "counter", "Prompt tokens served from the prompt cache", "cached_tokens"),
+            ("llm_cost_usd_total", "counter", "Estimated cost in US dollars", "cost_usd")
+        )
+        for name, kind, help_text, field in series:
+            yield f"# HELP {name} {help_text}\n# TYPE {name} {kind}\n"
+            for row in totals:
+                labels = ",".join(f'{label}="{escape_label(row[label])}"' for label in ("project", "step", "model"))
+                yield f"{name}{{{labels}}} {row[field]}\n"
+
+        yield "# HELP llm_route_decisions_total Extraction calls routed to each model, by reason\n# TYPE llm_route_decisions_total counter\n"
+        for row in self.route_summary(by=("project", "step", "model", "reason")):
+            labels = ",".join(f'{label}="{escape_label(row[label])}"' for label in ("project", "step", "model", "reason"))
+            yield f"llm_route_decisions_total{{{labels}}} {row['decisions']}\n"
+
+    def prometheus_text(self) -> str:
+        return "".join(self.iter_prometheus())
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+_metrics: MetricsRecorder | None = None
+_metrics_lock = threading.Lock()
+
+def get_metrics() -> MetricsRecorder:
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = MetricsRecorder()
+            if METRICS_PORT:
+                start_metrics_server(_metrics, METRICS_PORT)
+        return _metrics
+
+def start_metrics_server(recorder: MetricsRecorder, port: int) -> ThreadingHTTPServer | None:
+    # Minimal /metrics endpoint for Prometheus to scrape
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = recorder.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer(("", port), Handler)
+    except OSError as e:
+        logger.error(f"Error starting metrics server on port {port}: {str(e)}")
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -1,15 +1,77 @@
-from typing import Any, List, Type
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from functools import lru_cache
+from typing import Any, List, NamedTuple, Tuple, Type
 import openai
+import httpx
 import logging
+import os
+import threading
+import time
 from dotenv import load_dotenv
 import json
 from pydantic import BaseModel, Field, create_model
 
+from cache import ExtractionCache, get_extraction_cache
+from ratelimit import RETRY_MAX_ATTEMPTS, RateLimiter, backoff_delay, estimate_request_tokens, get_rate_limiter, retry_after
+from chunking import CHUNK_MAX_TOKENS, CHUNK_MAX_WORKERS, CHUNK_OVERLAP_TOKENS, count_tokens, merge_items, split_text
+from metrics import get_metrics
+from routing import Router
+from validation import FIELD_TYPES, FieldSpec, compile_validator, field_schema
+
 # Set up logging
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger(__name__)
 load_dotenv()
 
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "64"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "32"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+# Retries are handled by LLMHelper.chat_completion so they go through the rate limiter
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "0"))
+# "openai", or "stub" to answer every request locally (see stub.py) for offline runs and benchmarks
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+# "prefix" keeps everything but the file contents in a byte-identical leading system message so
+# the provider's prompt cache can reuse it across files; "standard" is the original layout
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "prefix")
+PACK_MAX_FILES = int(os.getenv("EXTRACTION_PACK_MAX_FILES", "20"))
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_openai_client(max_connections: int = OPENAI_MAX_CONNECTIONS,
+                      max_keepalive_connections: int = OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                      timeout: float = OPENAI_TIMEOUT) -> openai.OpenAI:
+    # One client (and so one keep-alive connection pool) per configuration, shared by the whole process.
+    # The OpenAI client is thread-safe, so worker threads can share it.
+    key = (max_connections, max_keepalive_connections, timeout)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            http_client = openai.DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_keepalive_connections,
+                    keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+                ),
+                timeout=httpx.Timeout(timeout, connect=OPENAI_CONNECT_TIMEOUT)
+            )
+            client = openai.OpenAI(http_client=http_client, max_retries=OPENAI_MAX_RETRIES)
+            _clients[key] = client
+        return client
+
+def get_llm_client(backend: str = LLM_BACKEND):
+    # Anything exposing chat.completions.with_raw_response.create and
+    # beta.chat.completions.with_raw_response.parse can stand in for the OpenAI client
+    if backend == "stub":
+        from stub import get_stub_client
+        return get_stub_client()
+    if backend != "openai":
+        raise ValueError(f"Unknown LLM_BACKEND {backend!r}")
+    return get_openai_client()
+
 class ProjectSetupResponse(BaseModel):
     title: str
     description: str 
@@ -19,12 +81,18 @@ class SchemaField(BaseModel):
     name: str
     description: str
     data_type: str
+    # Allowed values of an Enum field
+    enum_values: List[str] | None = None
+    # The field holds a list of values of data_type
+    array: bool | None = None
 
     def to_dict(self):
         return {
             "name": self.name,
             "data_type": self.data_type,
-            "description": self.description
+            "description": self.description,
+            "enum_values": self.enum_values,
+            "array": bool(self.array)
         }
 
     @classmethod
@@ -32,14 +100,20 @@ class SchemaField(BaseModel):
         return cls(
             name=data["name"], 
             description=data["description"], 
-            data_type=data["data_type"]
+            data_type=data["data_type"],
+            enum_values=data.get("enum_values"),
+            array=data.get("array", False)
         )
+
+    def spec(self) -> FieldSpec:
+        return (self.name, self.data_type, tuple(self.enum_values) if self.enum_values else None, bool(self.array))
     
 class SchemaFieldResults(BaseModel):
     name: str
     description: str
     data_type: str
-    value: str 
+    # Coerced to data_type: str, float, int, bool, ISO date string, a list of those, or None
+    value: Any
 
     def to_dict(self):
         return {
@@ -55,7 +129,7 @@ class SchemaFieldResults(BaseModel):
             name=data["name"], 
             description=data["description"], 
             data_type=data["data_type"],
-            value=data["value"]
+            value=data.get("value", "")
         )
     
 class ResponseSchema(BaseModel):
@@ -92,52 +166,178 @@ class ResponseSchemaResults(BaseModel):
             confirmation_message=data["confirmation_message"]
         )
 
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+SOURCE_ID_FIELD = "source_id"
+DEFAULT_TEMPERATURE = 0.2
+
+class CompiledFormat(NamedTuple):
+    # A strict response_format built once per schema and reused for every file. The dict is
+    # shared between requests and must not be modified.
+    json: dict
+    # Stands in for the full schema in cache keys
+    fingerprint: str
+    # Prompt tokens the schema adds to each request, for the rate limiter
+    tokens: int
+
+@lru_cache(maxsize=256)
+def compile_response_format(fields: Tuple[FieldSpec, ...], source_ids: Tuple[str, ...] | None, model: str) -> CompiledFormat:
+    properties = {}
+    required_fields = []
+
+    if source_ids is not None:
+        # Packed requests tag each item with the document it was extracted from
+        properties[SOURCE_ID_FIELD] = {"type": "string", "enum": list(source_ids)}
+        required_fields.append(SOURCE_ID_FIELD)
+
+    for name, data_type, enum_values, array in fields:
+        properties[name] = field_schema(data_type, enum_values, array)
+        required_fields.append(name)
+
+    response_format_json = {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "schema_response",
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "data_fields": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": properties,
+                            "required": required_fields,
+                            "additionalProperties": False
+                        }
+                    }
+                },
+                "required": ["data_fields"],
+                "additionalProperties": False
+            },
+            "strict": True
+        }
+    }
+
+    return CompiledFormat(
+        json=response_format_json,
+        fingerprint=ExtractionCache.make_key(response_format_json),
+        tokens=count_tokens(json.dumps(response_format_json), model)
+    )
+
+@lru_cache(maxsize=256)
+def extraction_prefix(prompt: str, fields: Tuple[Tuple[str, str, str, Tuple[str, ...], bool], ...]) -> str:
+    # Static part of every extraction request for a project, built once so each request starts
+    # with exactly the same bytes: instructions, then the goal, then the fields to extract
+    lines = [
+        "You are an AI assistant that extracts structured data from text. Please return a list of extracted data items.",
+        "",
+        f"Goal: {prompt}",
+        "",
+        "Fields to extract for each item:"
+    ]
+    for name, data_type, description, enum_values, array in fields:
+        details = data_type + (", list" if array else "") + (f"; one of: {', '.join(enum_values)}" if enum_values else "")
+        lines.append(f"- {name} ({details}): {description}")
+    lines += ["", "The input to extract from is in the user message."]
+    return "\n".join(lines)
+
+@lru_cache(maxsize=256)
+def prefix_cache_key(prefix: str) -> str:
+    # Sent as prompt_cache_key so requests sharing a prefix are routed to the same prompt cache
+    return ExtractionCache.make_key(prefix)[:32]
+
 class LLMHelper:
-    def __init__(self):
+    def __init__(self, client: openai.OpenAI | None = None, cache: ExtractionCache | None = None, rate_limiter: RateLimiter | None = None,
+                 prompt_layout: str = PROMPT_LAYOUT, router: Router | None = None):
         try:
-            self.client = openai.OpenAI()
-            self.model = "gpt-4o-mini"
+            self.client = client if client is not None else get_llm_client()
+            self.cache = cache if cache is not None else get_extraction_cache()
+            self.router = router if router is not None else Router()
+            # The cheapest tier; used for schema design and anything else that isn't routed
+            self.model = self.router.tiers[0]
+            # A limiter passed in covers every model; otherwise each model gets its own
+            self._shared_rate_limiter = rate_limiter
+            self.rate_limiter = self.rate_limiter_for(self.model)
+            self.prompt_layout = prompt_layout
         except Exception as e:
             logger.error(f"Error initializing OpenAI client: {str(e)}")
             raise
 
-    def chat_completion(self, messages, temperature=0.2, response_format=None, response_format_json=None):
+    def rate_limiter_for(self, model: str) -> RateLimiter:
+        return self._shared_rate_limiter if self._shared_rate_limiter is not None else get_rate_limiter(model)
+
+    def chat_completion(self, messages, temperature=DEFAULT_TEMPERATURE, response_format=None, response_format_json=None, format_tokens=None,
+                        step="chat_completion", prompt_cache_key=None, model=None):
+        started = time.perf_counter()
+        queue_wait = 0.0
+        retries = 0
+        model = model or self.model
+        rate_limiter = self.rate_limiter_for(model)
         try:
             kwargs = {
-                "model": self.model,
+                "model": model,
                 "messages": messages,
                 "temperature": temperature,
             }
-
-            try:
-                logger.debug(f"OpenAI client request: {json.dumps(kwargs, indent=2)}")
-            except TypeError:
-                logger.error(f"OpenAI client request (non-serializable): {kwargs}")
-
-            # Make the API call
-            if response_format is not None:
-                logger.info("Running OpenAI Query with response format")
-                response = self.client.beta.chat.completions.parse(
-                    **kwargs,
-                    response_format=response_format
-                )
-            elif response_format_json is not None:
-                logger.info("Running OpenAI Query with response format json")
-                response = self.client.chat.completions.create(**kwargs, response_format=response_format_json)
-            else:
-                logger.debug("Running OpenAI Query")
-                response = self.client.chat.completions.create(**kwargs)
-
-            try:
-                logger.debug(f"OpenAI client response: {json.dumps(response.model_dump(), indent=2)}")
-            except TypeError:
-                logger.error(f"OpenAI client response (non-serializable): {response}")
-
+            if prompt_cache_key is not None:
+                kwargs["prompt_cache_key"] = prompt_cache_key
+
+            # The request includes the file contents, so only serialize it when it will be logged
+            if logger.isEnabledFor(logging.DEBUG):
+                try:
+                    logger.debug(f"OpenAI client request: {json.dumps(kwargs, indent=2)}")
+                except TypeError:
+                    logger.error(f"OpenAI client request (non-serializable): {kwargs}")
+
+            estimated_tokens = estimate_request_tokens(messages, response_format_json, model, format_tokens)
+            for attempt in range(RETRY_MAX_ATTEMPTS):
+                queue_wait += rate_limiter.acquire(estimated_tokens)
+                try:
+                    raw_response = self.send_request(kwargs, response_format, response_format_json)
+                except RETRYABLE_ERRORS as e:
+                    headers = e.response.headers if isinstance(e, openai.APIStatusError) else None
+                    rate_limiter.release(headers, rate_limited=isinstance(e, openai.RateLimitError))
+                    if attempt == RETRY_MAX_ATTEMPTS - 1 or getattr(e, "code", None) == "insufficient_quota":
+                        raise
+                    delay = retry_after(headers) or backoff_delay(attempt)
+                    logger.warning(f"OpenAI request failed ({str(e)}), retrying in {delay:.1f}s")
+                    time.sleep(delay)
+                    retries += 1
+                    continue
+                except Exception:
+                    rate_limiter.release()
+                    raise
+                rate_limiter.release(raw_response.headers)
+                response = raw_response.parse()
+                break
+
+            if logger.isEnabledFor(logging.DEBUG):
+                try:
+                    logger.debug(f"OpenAI client response: {json.dumps(response.model_dump(), indent=2)}")
+                except TypeError:
+                    logger.error(f"OpenAI client response (non-serializable): {response}")
+
+            get_metrics().record(step, model, time.perf_counter() - started, queue_wait, retries, getattr(response, "usage", None))
             return response
         except Exception as e:
             logger.error(f"Error in chat completion: {str(e)}")
+            get_metrics().record(step, model, time.perf_counter() - started, queue_wait, retries, error=e)
             raise
 
+    def send_request(self, kwargs, response_format=None, response_format_json=None):
+        # Raw responses expose the rate limit headers; .parse() gives the usual completion object
+        if response_format is not None:
+            logger.info("Running OpenAI Query with response format")
+            return self.client.beta.chat.completions.with_raw_response.parse(
+                **kwargs,
+                response_format=response_format
+            )
+        elif response_format_json is not None:
+            logger.info("Running OpenAI Query with response format json")
+            return self.client.chat.completions.with_raw_response.create(**kwargs, response_format=response_format_json)
+        else:
+            logger.debug("Running OpenAI Query")
+            return self.client.chat.completions.with_raw_response.create(**kwargs)
+
     def project_setup(self, goal) -> ProjectSetupResponse:
         try:
             messages = [
@@ -148,7 +348,8 @@ class LLMHelper:
 
             project_setup_response = self.chat_completion(
                 messages=messages,
-                response_format=ProjectSetupResponse
+                response_format=ProjectSetupResponse,
+                step="project_setup"
             )
             if project_setup_response.choices[0].message.refusal:
                 raise Exception(project_setup_response.choices[0].message.refusal)
@@ -162,91 +363,219 @@ class LLMHelper:
     def extract_schema(self, file_contents, prompt) -> ResponseSchema:
         try:
             messages = [
-                {"role": "system", "content": "You are an AI assistant designed to create JSON schemas for structured data extraction. Limit data types to String. Do not use nested structures (Object or Array)."},
+                {"role": "system", "content": f"You are an AI assistant designed to create JSON schemas for structured data extraction. Use one of these data types for each field: {', '.join(FIELD_TYPES)}. Use Date for calendar dates, Number or Integer for quantities and amounts, Boolean for yes/no facts, and Enum with enum_values when a field only takes a small fixed set of values; otherwise use String. Set array to true only when a single item can have several values for the field. Do not use nested structures (Object)."},
                 {"role": "user", "content": f"Create a JSON schema for extracting the following information: {prompt}\n\nHere's an example of the input:\n\n{file_contents}"}
             ]
 
+            cache_key = self.cache_key("extract_schema", messages, ResponseSchema.model_json_schema())
+            cached = self.cache.get(cache_key) if self.cache else None
+            if cached is not None:
+                get_metrics().record("extract_schema", self.model, cache_hit=True)
+                return ResponseSchema.from_dict(cached)
+
             extract_schema_response = self.chat_completion(
                 messages=messages,
-                response_format=ResponseSchema
+                response_format=ResponseSchema,
+                step="extract_schema"
             )
             if extract_schema_response.choices[0].message.refusal:
                 raise Exception(extract_schema_response.choices[0].message.refusal)
 
             parsed_response = extract_schema_response.choices[0].message.parsed
+            if self.cache:
+                self.cache.set(cache_key, parsed_response.to_dict())
             return parsed_response 
         except Exception as e:
             logger.error(f"Error generating schema: {str(e)}")
             raise
 
-    def create_dynamic_model(self, schema: ResponseSchema) -> dict:
-        properties = {}
-        required_fields = []
-
-        for data_field in schema.data_fields:
-            properties[data_field.name] = {"type": data_field.data_type.lower()}
-            required_fields.append(data_field.name)
-
-        response_format_json = {
-            "type": "json_schema",
-            "json_schema": {
-                "name": "schema_response",
-                "schema": {
-                    "type": "object",
-                    "properties": {
-                        "data_fields": {
-                            "type": "array",
-                            "items": {
-                                "type": "object",
-                                "properties": properties,
-                                "required": required_fields,
-                                "additionalProperties": False
-                            }
-                        }
-                    },
-                    "required": ["data_fields"],
-                    "additionalProperties": False
-                },
-                "strict": True
-            }
-        }
+    def cache_key(self, step: str, messages: list, response_format: dict | str, model: str | None = None) -> str:
+        # Covers model, prompt, schema and file contents (the latter two via the messages)
+        return ExtractionCache.make_key(step, model or self.model, messages, response_format)
+
+    def create_dynamic_model(self, schema: ResponseSchema, source_ids: List[str] | None = None) -> dict:
+        return self.compiled_format(schema, source_ids).json
 
-        return response_format_json
+    def compiled_format(self, schema: ResponseSchema, source_ids: List[str] | None = None) -> CompiledFormat:
+        # Memoized on the field names and types, so every file of a run shares one compiled schema
+        fields = tuple(data_field.spec() for data_field in schema.data_fields)
+        return compile_response_format(fields, tuple(source_ids) if source_ids is not None else None, self.model)
 
-    def run_schema(self, prompt: str, file_contents: str, schema: str) -> List[ResponseSchemaResults]:
+    def run_schema(self, prompt: str, file_contents: str, schema: str, policy: str | None = None) -> List[ResponseSchemaResults]:
+        # policy is the project's routing policy; None uses the router's default
         try:
-            messages = [
-                {"role": "system", "content": f"You are an AI assistant that extracts structured data from text. Your goal is {prompt}. Please return a list of extracted data items."},
+            chunks = split_text(file_contents, CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, self.model)
+            # Chunks of a file are routed on the size of the whole file
+            tokens = count_tokens(file_contents, self.model)
+            if len(chunks) == 1:
+                items = self.extract_items(prompt, file_contents, schema, policy, tokens)
+            else:
+                logger.info(f"Extracting from {len(chunks)} chunks")
+                with ThreadPoolExecutor(max_workers=min(CHUNK_MAX_WORKERS, len(chunks))) as executor:
+                    # Each chunk runs in its own copy of this thread's context so its calls keep the file's metrics labels
+                    contexts = [contextvars.copy_context() for _ in chunks]
+                    chunk_items = list(executor.map(
+                        lambda context, chunk: context.run(self.extract_items, prompt, chunk, schema, policy, tokens), contexts, chunks
+                    ))
+                items = merge_items(chunk_items, [field.name for field in schema.data_fields])
+
+            return self.to_results(items, schema)
+
+        except Exception as e:
+            logger.error(f"Error generating example: {str(e)}")
+            raise
+
+    def extraction_messages(self, prompt: str, file_contents: str, schema: ResponseSchema | None = None) -> list:
+        if self.prompt_layout == "prefix" and schema is not None:
+            return [
+                {"role": "system", "content": self.extraction_prefix(prompt, schema)},
                 {"role": "user", "content": f"Extract for this input:\n\n{file_contents}"}
             ]
+        return [
+            {"role": "system", "content": f"You are an AI assistant that extracts structured data from text. Your goal is {prompt}. Please return a list of extracted data items."},
+            {"role": "user", "content": f"Extract for this input:\n\n{file_contents}"}
+        ]
+
+    def extraction_prefix(self, prompt: str, schema: ResponseSchema) -> str:
+        fields = tuple(
+            (field.name, field.data_type, field.description, tuple(field.enum_values or ()), bool(field.array))
+            for field in schema.data_fields
+        )
+        return extraction_prefix(prompt, fields)
+
+    def prompt_cache_key(self, messages: list) -> str | None:
+        return prefix_cache_key(messages[0]["content"]) if self.prompt_layout == "prefix" else None
+
+    def extraction_requests(self, prompt: str, file_contents: str, schema: ResponseSchema) -> List[dict]:
+        # Chat completion request bodies for one file, one per chunk, for callers that send them
+        # outside chat_completion (e.g. the Batch API). Not routed: a batch only takes one model.
+        response_format_json = self.create_dynamic_model(schema)
+        requests = []
+        for chunk in split_text(file_contents, CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, self.model):
+            messages = self.extraction_messages(prompt, chunk, schema)
+            body = {
+                "model": self.model,
+                "messages": messages,
+                "temperature": DEFAULT_TEMPERATURE,
+                "response_format": response_format_json
+            }
+            if self.prompt_cache_key(messages) is not None:
+                body["prompt_cache_key"] = self.prompt_cache_key(messages)
+            requests.append(body)
+        return requests
+
+    def extract_items(self, prompt: str, file_contents: str, schema: ResponseSchema, policy: str | None = None,
+                      tokens: int | None = None) -> List[dict]:
+        messages = self.extraction_messages(prompt, file_contents, schema)
+        tokens = tokens if tokens is not None else count_tokens(file_contents, self.model)
+        return self.routed_items("run_schema", messages, self.compiled_format(schema), schema, tokens, policy)
+
+    def run_schema_packed(self, prompt: str, documents: List[str], schema: ResponseSchema,
+                          policy: str | None = None) -> List[List[ResponseSchemaResults]]:
+        # Extract several small documents in one request; returns one result list per document
+        try:
+            source_ids = [str(i + 1) for i in range(len(documents))]
+            packed_contents = "\n\n".join(
+                f'<document id="{source_id}">\n{contents}\n</document>'
+                for source_id, contents in zip(source_ids, documents)
+            )
+            packing = f"The input contains several independent documents, each wrapped in a <document> tag. Extract items from each document separately and set {SOURCE_ID_FIELD} to the id of the document the item came from."
+            if self.prompt_layout == "prefix":
+                # The packing note goes after the shared prefix, and the id enum always lists the
+                # same ids, so packs of any size share the prefix with single-file requests
+                messages = [
+                    {"role": "system", "content": self.extraction_prefix(prompt, schema)},
+                    {"role": "user", "content": f"{packing}\n\nExtract for this input:\n\n{packed_contents}"}
+                ]
+                response_format = self.compiled_format(schema, [str(i + 1) for i in range(max(len(documents), PACK_MAX_FILES))])
+            else:
+                messages = [
+                    {"role": "system", "content": f"You are an AI assistant that extracts structured data from text. Your goal is {prompt}. Please return a list of extracted data items. {packing}"},
+                    {"role": "user", "content": f"Extract for this input:\n\n{packed_contents}"}
+                ]
+                response_format = self.compiled_format(schema, source_ids)
+
+            items = self.routed_items("run_schema_packed", messages, response_format, schema,
+                                      count_tokens(packed_contents, self.model), policy)
 
+            items_by_source = {source_id: [] for source_id in source_ids}
+            for item in items:
+                source_id = str(item.pop(SOURCE_ID_FIELD, ""))
+                if source_id in items_by_source:
+                    items_by_source[source_id].append(item)
+                else:
+                    logger.warning(f"Dropping extracted item with unknown {SOURCE_ID_FIELD} {source_id!r}")
+
+            return [self.to_results(items_by_source[source_id], schema) for source_id in source_ids]
+
+        except Exception as e:
+            logger.error(f"Error running packed extraction: {str(e)}")
+            raise
+
+    def routed_items(self, step: str, messages: list, response_format: CompiledFormat, schema: ResponseSchema,
+                     tokens: int, policy: str | None = None) -> List[dict]:
+        # Sends the request to the tier the router picks for its size and, under the cascade
+        # policy, again to the next tier up for as long as the output is empty or has values
+        # that fail validation. Every decision is recorded in the metrics.
+        decision = self.router.route(tokens, len(schema.data_fields), policy)
+        cascade = self.router.resolve(policy) == "cascade"
+        validate = compile_validator(tuple(field.spec() for field in schema.data_fields))
+        while True:
+            get_metrics().record_route(step, decision.model, decision.tier, decision.reason)
+            items = self.request_items(step, messages, response_format, decision.model)
+            if not cascade:
+                return items
+            invalid = validate(items)[1] if items else 0
+            if items and not invalid:
+                return items
+            escalated = self.router.escalate(decision, policy, empty=not items)
+            if escalated is None:
+                return items
+            logger.info(f"Escalating {step} from {decision.model} to {escalated.model}: "
+                        f"{'empty output' if not items else f'{invalid} invalid values'}")
+            decision = escalated
+
+    def request_items(self, step: str, messages: list, response_format: CompiledFormat, model: str | None = None) -> List[dict]:
+        model = model or self.model
+        cache_key = self.cache_key(step, messages, response_format.fingerprint, model)
+        parsed_items = self.cache.get(cache_key) if self.cache else None
+
+        if parsed_items is not None:
+            get_metrics().record(step, model, cache_hit=True)
+        else:
             extraction_response = self.chat_completion(
                 messages=messages,
-                response_format_json=self.create_dynamic_model(schema)
+                response_format_json=response_format.json,
+                format_tokens=response_format.tokens,
+                step=step,
+                prompt_cache_key=self.prompt_cache_key(messages),
+                model=model
             )
 
             if extraction_response.choices[0].message.refusal:
                 raise Exception(extraction_response.choices[0].message.refusal)
 
             parsed_items = json.loads(extraction_response.choices[0].message.content)
-
-            # Convert the parsed items to ResponseSchemaResults objects
-            return [
-                ResponseSchemaResults(
-                    data_fields=[
-                        SchemaFieldResults(
-                            name=field.name,
-                            description=field.description,
-                            data_type=field.data_type,
-                            value=str(item.get(field.name, ''))
-                        )
-                        for field in schema.data_fields
-                    ],
-                    confirmation_message=schema.confirmation_message
-                )
-                for item in parsed_items['data_fields']
-            ]
-
-        except Exception as e:
-            logger.error(f"Error generating example: {str(e)}")
-            raise
+            if self.cache:
+                self.cache.set(cache_key, parsed_items)
+
+        return parsed_items['data_fields']
+
+    def to_results(self, items: List[dict], schema: ResponseSchema) -> List[ResponseSchemaResults]:
+        # Coerce the parsed items to their field types in one pass, then wrap them as ResponseSchemaResults
+        rows, _ = compile_validator(tuple(field.spec() for field in schema.data_fields))(items)
+        return [
+            ResponseSchemaResults(
+                data_fields=[
+                    SchemaFieldResults(
+                        name=field.name,
+                        description=field.description,
+                        data_type=field.data_type,
+                        value=value
+                    )
+                    for field, value in zip(schema.data_fields, row)
+                ],
+                confirmation_message=schema.confirmation_message
+            )
+            for row in rows
+        ]
@@ -0,0 +1,550 @@
+# Projects, files and their persistence, without any UI dependencies so they can be used from
+# scripts and the command line as well as the Streamlit app
+from enum import Enum
+import hashlib
+import json
+import threading
+import os
+import weakref
+from typing import Dict, Iterable, List, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+from model import ResponseSchema, ResponseSchemaResults
+from store import ProjectStore
+from archive import iter_import, write_export
+from results import ResultsTable, pack_results, unpack_results
+from dedupe import minhash
+
+# Files written to the store per transaction when adding files in bulk
+ADD_FILES_BATCH_SIZE = int(os.getenv("ADD_FILES_BATCH_SIZE", "500"))
+
+class ProjectState(Enum):
+    GOAL_SET = "Goal Set"
+    FILE_UPLOADED = "File Uploaded"
+    SCHEMA_RETURNED = "Schema Returned"
+    SCHEMA_APPROVED = "Schema Approved"
+    EXAMPLE_GENERATED = "Example Generated"
+    COMPLETE = "Complete"
+    RUNNING = "Running"
+    ERROR = "Error"
+
+class FileState(Enum):
+    NOT_STARTED = "Not Started"
+    RUNNING = "Running"
+    FINISHED = "Finished"
+    ERROR = "Error"
+
+def result_rows(results: List[Dict]) -> List[Dict]:
+    return [{field["name"]: field["value"] for field in result["data_fields"]} for result in results]
+
+def content_hash(contents: str) -> str:
+    return hashlib.sha256(contents.encode("utf-8")).hexdigest()
+
+class TextFile:
+    def __init__(self, file_name: str, contents: str | None, results: List[ResponseSchemaResults] | None = None, state: FileState = FileState.NOT_STARTED):
+        self.file_name = file_name
+        self._contents = contents
+        self._results = results if results is not None else []
+        self._state = state
+        # Set once the file is saved; contents and results are then read from the store on demand
+        self.id = None
+        self.store = None
+        self.dirty = True
+        self._content_hash = None
+        # Project.run_version the results were extracted with; None until the file finishes.
+        # Finished files from before versions were recorded are stamped with their project's
+        # version when loaded or imported.
+        self.run_version = None
+        self._minhash = None
+        # Name of the near-duplicate file whose results this file reused, if it wasn't extracted itself
+        self.duplicate_of = None
+
+    @property
+    def contents(self) -> str:
+        # Not kept in memory for stored files, so large projects only hold what is in use
+        if self._contents is None and self.store is not None:
+            return self.store.load_contents(self.id)
+        return self._contents
+
+    @property
+    def content_hash(self) -> str:
+        if self._content_hash is None:
+            self._content_hash = content_hash(self.contents)
+        return self._content_hash
+
+    @property
+    def minhash(self) -> bytes:
+        # Signature for near-duplicate detection; files stored before signatures get theirs on first use
+        if self._minhash is None:
+            self._minhash = minhash(self.contents)
+            if self.store is not None and self.id is not None:
+                self.store.set_minhash(self.id, self._minhash)
+        return self._minhash
+
+    @property
+    def results(self) -> List[ResponseSchemaResults]:
+        if self._results is None and self.store is not None:
+            self._results = [ResponseSchemaResults.from_dict(result) for result in unpack_results(self.store.load_results(self.id) or [])]
+        return self._results
+
+    @results.setter
+    def results(self, results: List[ResponseSchemaResults]):
+        self._results = results
+        self.dirty = True
+
+    @property
+    def state(self) -> FileState:
+        return self._state
+
+    @state.setter
+    def state(self, state: FileState):
+        self._state = state
+        self.dirty = True
+
+    def to_dict(self):
+        # Reads stored results straight from the store so exporting doesn't pull them all into memory
+        if self._results is None and self.store is not None:
+            results = unpack_results(self.store.load_results(self.id) or [])
+        else:
+            results = [result.to_dict() for result in self._results]
+        return {
+            "file_name": self.file_name,
+            "contents": self.contents,
+            "results": results,
+            "state": self.state.value,
+            "run_version": self.run_version,
+            "duplicate_of": self.duplicate_of
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        file = cls(
+            file_name=data["file_name"],
+            contents=data["contents"],
+            results=[ResponseSchemaResults.from_dict(result) for result in data.get("results", [])],
+            state=FileState(data.get("state", FileState.NOT_STARTED.value))
+        )
+        file.run_version = data.get("run_version")
+        file.duplicate_of = data.get("duplicate_of")
+        return file
+
+    @classmethod
+    def from_row(cls, row, store: ProjectStore):
+        file = cls(row["file_name"], None, state=FileState(row["state"]))
+        file._results = None
+        file._content_hash = row.get("content_hash")
+        file.run_version = row.get("run_version")
+        file._minhash = row.get("minhash")
+        file.duplicate_of = row.get("duplicate_of")
+        file.id = row["id"]
+        file.store = store
+        file.dirty = False
+        return file
+
+class Project:
+    def __init__(self, title: str, description: str, prompt: str):
+        self.title = title
+        self.description = description
+        self.prompt = prompt
+        self._files: List[TextFile] | None = []
+        self.schema = None
+        self.state = ProjectState.GOAL_SET
+        self.batch_id = None
+        # Model routing policy for extraction calls (see routing.py); None uses ROUTING_POLICY
+        self.routing_policy = None
+        self.id = None
+        self.store = None
+        self._results_table: ResultsTable | None = None
+
+    @property
+    def files(self) -> List[TextFile]:
+        if self._files is None and self.store is not None:
+            self._files = [TextFile.from_row(row, self.store) for row in self.store.list_files(self.id)]
+        return self._files
+
+    @files.setter
+    def files(self, files: List[TextFile]):
+        self._files = files
+
+    @property
+    def run_version(self) -> str:
+        # Changes whenever the prompt or schema does, making every earlier result stale
+        data = {"prompt": self.prompt, "schema": self.schema.to_dict() if self.schema else None}
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+    def needs_run(self, file: TextFile, version: str | None = None) -> bool:
+        # New, modified and failed files, and results extracted with an older prompt or schema
+        if file.state != FileState.FINISHED:
+            return True
+        return file.run_version != (version or self.run_version)
+
+    def stamp_run_version(self, files: Iterable[TextFile]):
+        # Finished files without a recorded version (exports and stores from before versions
+        # existed) are taken to match the current prompt and schema; later changes make them stale
+        version = self.run_version
+        for file in files:
+            if file.state == FileState.FINISHED and file.run_version is None:
+                file.run_version = version
+
+    def pending_files(self) -> List[TextFile]:
+        version = self.run_version
+        return [file for file in self.files if self.needs_run(file, version)]
+
+    @property
+    def results_table(self) -> ResultsTable:
+        # Rows of every finished file, built once and then kept up to date as files are saved
+        if self._results_table is None:
+            fields = [field.to_dict() for field in self.schema.data_fields] if self.schema else []
+            table = ResultsTable(fields)
+            if self.store is not None and self.id is not None:
+                for row in self.store.load_project_results(self.id, FileState.FINISHED.value):
+                    table.append(row["id"], row["file_name"], result_rows(unpack_results(row["results"])))
+            else:
+                for file in self.files:
+                    if file.state == FileState.FINISHED:
+                        table.append(id(file), file.file_name, result_rows([result.to_dict() for result in file.results]))
+            self._results_table = table
+        return self._results_table
+
+    def update_results_table(self, file, results: List[ResponseSchemaResults] | None = None):
+        if self._results_table is None:
+            return
+        if file.state == FileState.FINISHED:
+            results = results if results is not None else file.results
+            self._results_table.replace_file(file.id, file.file_name, result_rows([result.to_dict() for result in results]))
+        else:
+            self._results_table.drop_file(file.id)
+
+    def to_dict(self):
+        return {
+            "title": self.title,
+            "description": self.description,
+            "prompt": self.prompt,
+            "files": [file.to_dict() for file in self.files],
+            "schema": self.schema.to_dict() if self.schema else None,
+            "state": self.state.value,
+            "batch_id": self.batch_id,
+            "routing_policy": self.routing_policy
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        project = cls(data["title"], data["description"], data["prompt"])
+        project.files = [TextFile.from_dict(file_data) for file_data in data["files"]]
+        project.schema = ResponseSchema.from_dict(data["schema"]) if data["schema"] else None
+        project.state = ProjectState(data["state"])
+        project.batch_id = data.get("batch_id")
+        project.routing_policy = data.get("routing_policy")
+        project.stamp_run_version(project.files)
+        return project
+
+    @classmethod
+    def from_row(cls, row, store: ProjectStore):
+        project = cls(row["title"], row["description"], row["prompt"])
+        project._files = None
+        project.schema = ResponseSchema.from_dict(row["schema"]) if row["schema"] else None
+        project.state = ProjectState(row["state"])
+        project.batch_id = row["batch_id"]
+        project.routing_policy = row["routing_policy"]
+        project.id = row["id"]
+        project.store = store
+        return project
+
+class ProjectIndex:
+    # Saved projects keyed by their store id, with lookups by title and by state. Titles and
+    # states are re-indexed whenever a project is saved, so lookups see the saved values.
+    def __init__(self, projects: Iterable[Project] = ()):
+        self.by_id: Dict[int, Project] = {}
+        # Ids in id order per title / state; titles aren't unique, the first project wins
+        self.by_title: Dict[str, Dict[int, None]] = {}
+        self.by_state: Dict[ProjectState, Dict[int, None]] = {}
+        self._keys: Dict[int, Tuple[str, ProjectState]] = {}
+        for project in projects:
+            self.add(project)
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def __contains__(self, project_id) -> bool:
+        return project_id in self.by_id
+
+    def add(self, project: Project):
+        self.remove(project.id)
+        self.by_id[project.id] = project
+        self._keys[project.id] = (project.title, project.state)
+        self.by_title.setdefault(project.title, {})[project.id] = None
+        self.by_state.setdefault(project.state, {})[project.id] = None
+
+    def remove(self, project_id: int):
+        if project_id not in self._keys:
+            return
+        title, state = self._keys.pop(project_id)
+        del self.by_id[project_id]
+        for index, key in ((self.by_title, title), (self.by_state, state)):
+            del index[key][project_id]
+            if not index[key]:
+                del index[key]
+
+    def ids(self, state: ProjectState | None = None) -> List[int]:
+        return list(self.by_id if state is None else self.by_state.get(state, {}))
+
+    def find(self, title: str) -> Project | None:
+        ids = self.by_title.get(title)
+        return self.by_id[next(iter(ids))] if ids else None
+
+# Loaded projects per store. Everything using the same store (in the app, every session and
+# background job share one) sees and saves the same objects; managers on other stores get their own.
+_loaded: "weakref.WeakKeyDictionary[ProjectStore, Tuple[List[Project], ProjectIndex]]" = weakref.WeakKeyDictionary()
+_projects_lock = threading.RLock()
+
+class ProjectsManager:
+    def __init__(self, store: ProjectStore | None = None):
+        self.store = store if store is not None else ProjectStore()
+
+    def load(self) -> Tuple[List[Project], ProjectIndex]:
+        with _projects_lock:
+            loaded = _loaded.get(self.store)
+            if loaded is None:
+                projects = [Project.from_row(row, self.store) for row in self.store.list_projects()]
+                index = ProjectIndex(projects)
+                # Finished files stored before versions were recorded get their project's version
+                for project_id in self.store.unversioned_projects():
+                    if project_id in index:
+                        self.store.stamp_run_version(project_id, index.by_id[project_id].run_version)
+                loaded = _loaded[self.store] = (projects, index)
+            return loaded
+
+    @property
+    def projects(self) -> List[Project]:
+        return self.load()[0]
+
+    @property
+    def index(self) -> ProjectIndex:
+        return self.load()[1]
+
+    def get(self, project_id: int) -> Project | None:
+        return self.index.by_id.get(project_id)
+
+    def find(self, title: str) -> Project | None:
+        # The first project with the given title
+        return self.index.find(title)
+
+    def project_ids(self, state: ProjectState | None = None) -> List[int]:
+        # Ids of every project, or of those in the given state, in creation order
+        return self.index.ids(state)
+
+    def save_project(self, project):
+        with _projects_lock:
+            # Loaded before the insert, so a first save doesn't also load the new row as a second project
+            index = self.index
+            if project.id is None:
+                # Any table built before the first save is keyed by objects rather than file ids
+                project._results_table = None
+            project.id = self.store.save_project({
+                "id": project.id,
+                "title": project.title,
+                "description": project.description,
+                "prompt": project.prompt,
+                "schema": project.schema.to_dict() if project.schema else None,
+                "state": project.state.value,
+                "batch_id": project.batch_id,
+                "routing_policy": project.routing_policy
+            })
+            project.store = self.store
+            if project._files is not None:
+                for position, file in enumerate(project._files):
+                    self.save_file(project, file, position)
+            if index.by_id.get(project.id) is not project:
+                self.projects.append(project)
+            # Picks up title and state changes
+            index.add(project)
+
+    def save_file(self, project, file, position: int | None = None):
+        if file.id is None:
+            position = position if position is not None else project.files.index(file)
+            results = file.results
+            file.id = self.store.insert_file(
+                project.id, position, file.file_name, file.contents, file.state.value,
+                pack_results(results) if results else None, file.run_version, file.minhash, file.duplicate_of
+            )
+            file.store = self.store
+            file._contents = None
+            file._results = None
+            project.update_results_table(file, results)
+        elif file.dirty:
+            self.store.update_file(
+                file.id, file.state.value,
+                pack_results(file._results) if file._results is not None else None,
+                file.run_version, file.duplicate_of
+            )
+            project.update_results_table(file)
+        file.dirty = False
+
+    def delete_project(self, project):
+        with _projects_lock:
+            if self.index.by_id.get(project.id) is project:
+                self.projects.remove(project)
+                self.index.remove(project.id)
+                self.store.delete_project(project.id)
+
+    def save_to_file(self):
+        if self.projects:
+            return write_export(list(self.projects))
+
+    def load_from_file(self, uploaded_file) -> List[Project]:
+        # Streams the upload and merges it into the existing projects: projects are matched by
+        # title and files by name, anything else is added. Returns the imported projects.
+        imported = []
+        with _projects_lock:
+            project = None
+            files_by_name = {}
+            # Finished files without a recorded version, stamped once the project's final prompt
+            # and schema are known: older exports only give the schema after the files
+            unversioned = []
+            for kind, data in iter_import(uploaded_file):
+                if kind == "project":
+                    project = self.merge_project(data)
+                    files_by_name = {file.file_name: file for file in project.files}
+                elif kind == "file":
+                    file = self.merge_file(project, files_by_name, TextFile.from_dict(data))
+                    if file.state == FileState.FINISHED and file.run_version is None:
+                        unversioned.append(file)
+                elif kind == "end_project":
+                    project = self.merge_project(data) if project is None else self.merge_project(data, project)
+                    if unversioned:
+                        project.stamp_run_version(unversioned)
+                        self.store.stamp_run_version(project.id, project.run_version)
+                    imported.append(project)
+                    project = None
+                    unversioned = []
+        return imported
+
+    def merge_project(self, data, project=None):
+        if project is None:
+            project = self.find(data["title"])
+        if project is None:
+            project = Project(data["title"], data["description"], data["prompt"])
+        project.description = data.get("description", project.description)
+        project.prompt = data.get("prompt", project.prompt)
+        if data.get("schema"):
+            project.schema = ResponseSchema.from_dict(data["schema"])
+            # The table's columns come from the schema, so it is rebuilt on next use
+            project._results_table = None
+        if "state" in data:
+            project.state = ProjectState(data["state"])
+        project.batch_id = data.get("batch_id", project.batch_id)
+        project.routing_policy = data.get("routing_policy", project.routing_policy)
+        self.save_project(project)
+        return project
+
+    def merge_file(self, project, files_by_name, file) -> TextFile:
+        # Returns the project's file the import was merged into
+        existing = files_by_name.get(file.file_name)
+        if existing is None:
+            project.files.append(file)
+            self.save_file(project, file, len(project.files) - 1)
+            files_by_name[file.file_name] = file
+            return file
+        self.store.replace_file(existing.id, file.contents, file.state.value, pack_results(file.results), file.run_version)
+        existing._state = file.state
+        existing._results = None
+        existing._content_hash = None
+        existing._minhash = None
+        existing.run_version = file.run_version
+        existing.duplicate_of = None
+        existing.dirty = False
+        # After the state is updated: the table adds or drops the file's rows by its new state
+        project.update_results_table(existing, file.results)
+        return existing
+
+    def add_file(self, project, file_name: str, contents: str, signature: bytes | None = None) -> str:
+        # Adds an uploaded file unless the project already holds the same contents. A file with
+        # the same name but different contents is replaced and will run again. signature is the
+        # file's MinHash when the caller already has it.
+        # Returns "added", "updated" or "duplicate".
+        with _projects_lock:
+            new_hash = content_hash(contents)
+            existing = next((file for file in project.files if file.file_name == file_name), None)
+            if existing is not None and existing.content_hash == new_hash:
+                return "duplicate"
+            if existing is None and any(file.content_hash == new_hash for file in project.files):
+                return "duplicate"
+
+            if existing is None:
+                file = TextFile(file_name, contents)
+                file._minhash = signature
+                project.files.append(file)
+                if project.id is not None:
+                    self.save_file(project, file, len(project.files) - 1)
+                return "added"
+
+            signature = signature or minhash(contents)
+            if existing.id is not None:
+                self.store.replace_file(existing.id, contents, FileState.NOT_STARTED.value, None, minhash=signature)
+                existing._contents = None
+            else:
+                existing._contents = contents
+            existing._state = FileState.NOT_STARTED
+            existing._results = None if existing.id is not None else []
+            existing._content_hash = new_hash
+            existing._minhash = signature
+            existing.run_version = None
+            existing.duplicate_of = None
+            existing.dirty = existing.id is None
+            project.update_results_table(existing)
+            return "updated"
+
+    def add_files(self, project, files: Iterable[Tuple[str, str, bytes | None]], batch_size: int = ADD_FILES_BATCH_SIZE) -> Dict[str, int]:
+        # Bulk form of add_file for (file_name, contents, MinHash or None) from an ingestion pipeline.
+        # New files of a saved project are written to the store batch_size at a time and not kept
+        # in memory. Returns how many were "added", "updated" and "duplicate".
+        outcomes = {"added": 0, "updated": 0, "duplicate": 0}
+        if project.id is None:
+            for file_name, contents, signature in files:
+                outcomes[self.add_file(project, file_name, contents, signature)] += 1
+            return outcomes
+
+        # files is usually a live ingestion pipeline, so documents are drawn from it outside the
+        # process-wide lock, which is only taken to write each batch
+        with _projects_lock:
+            hashes = {file.content_hash for file in project.files}
+            names = {file.file_name for file in project.files}
+        batch = []
+
+        def flush():
+            if not batch:
+                return
+            with _projects_lock:
+                start = len(project.files)
+                rows = [
+                    (start + i, file_name, contents, FileState.NOT_STARTED.value, signature)
+                    for i, (file_name, contents, _, signature) in enumerate(batch)
+                ]
+                for (file_name, _, new_hash, signature), file_id in zip(batch, self.store.insert_files(project.id, rows)):
+                    project.files.append(TextFile.from_row(
+                        {"id": file_id, "file_name": file_name, "state": FileState.NOT_STARTED.value, "content_hash": new_hash,
+                         "minhash": signature},
+                        self.store
+                    ))
+            batch.clear()
+
+        for file_name, contents, signature in files:
+            new_hash = content_hash(contents)
+            if new_hash in hashes:
+                outcomes["duplicate"] += 1
+            elif file_name in names:
+                # Changed contents under an existing name go through the single-file path
+                flush()
+                outcomes[self.add_file(project, file_name, contents, signature)] += 1
+                hashes.add(new_hash)
+            else:
+                batch.append((file_name, contents, new_hash, signature or minhash(contents)))
+                hashes.add(new_hash)
+                names.add(file_name)
+                outcomes["added"] += 1
+                if len(batch) >= batch_size:
+                    flush()
+        flush()
+        return outcomes
@@ -0,0 +1,172 @@
+from collections import deque
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from typing import Mapping
+
+from dotenv import load_dotenv
+
+from chunking import count_tokens
+
+logger = logging.getLogger(__name__)
+load_dotenv()
+
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "200000"))
+RATE_LIMIT_MAX_CONCURRENCY = int(os.getenv("RATE_LIMIT_MAX_CONCURRENCY", "64"))
+# Fraction of the limits we allow ourselves to use, leaving room for other clients of the org
+RATE_LIMIT_HEADROOM = float(os.getenv("RATE_LIMIT_HEADROOM", "0.9"))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "6"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "1"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "60"))
+# Completion tokens budgeted per request when estimating token usage up front
+RATE_LIMIT_COMPLETION_TOKENS = int(os.getenv("RATE_LIMIT_COMPLETION_TOKENS", "1000"))
+
+WINDOW = 60.0
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+def parse_duration(value: str | None) -> float | None:
+    # Rate limit reset headers look like "1s", "6m0s" or "20ms"
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    matches = DURATION_PATTERN.findall(value)
+    if not matches:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in matches)
+
+def retry_after(headers: Mapping[str, str] | None) -> float | None:
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    return parse_duration(headers.get("retry-after"))
+
+def estimate_request_tokens(messages: list, response_format_json: dict | None = None, model: str = "gpt-4o-mini",
+                            format_tokens: int | None = None) -> int:
+    # A few tokens of framing per message, the messages, the schema and the expected completion.
+    # format_tokens skips re-counting a schema whose size is already known.
+    tokens = sum(4 + count_tokens(str(message.get("content", "")), model) for message in messages)
+    if format_tokens is not None:
+        tokens += format_tokens
+    elif response_format_json is not None:
+        tokens += count_tokens(json.dumps(response_format_json), model)
+    return tokens + RATE_LIMIT_COMPLETION_TOKENS
+
+def backoff_delay(attempt: int, base: float = RETRY_BASE_DELAY, maximum: float = RETRY_MAX_DELAY) -> float:
+    # Full jitter exponential backoff
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+class RateLimiter:
+    # Sliding one-minute window over requests and tokens, plus an adaptive cap on requests in flight:
+    # halved on every 429, raised by one after a run of successes at the current level.
+    def __init__(self, rpm: int = OPENAI_RPM_LIMIT, tpm: int = OPENAI_TPM_LIMIT,
+                 max_concurrency: int = RATE_LIMIT_MAX_CONCURRENCY, headroom: float = RATE_LIMIT_HEADROOM):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.headroom = headroom
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.throttled = 0
+        self._successes = 0
+        self._requests = deque()
+        self._tokens = deque()
+        self._token_total = 0
+        self._cond = threading.Condition()
+
+    def _prune(self, now: float):
+        while self._requests and now - self._requests[0] >= WINDOW:
+            self._requests.popleft()
+        while self._tokens and now - self._tokens[0][0] >= WINDOW:
+            self._token_total -= self._tokens.popleft()[1]
+
+    def _wait_time(self, tokens: int, now: float) -> float:
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.in_flight >= self.concurrency:
+            return WINDOW
+        if self.rpm > 0 and len(self._requests) >= self.rpm * self.headroom:
+            return self._requests[0] + WINDOW - now
+        # A request bigger than the whole budget is let through on an empty window rather than never
+        if self.tpm > 0 and self._tokens and self._token_total + tokens > self.tpm * self.headroom:
+            return self._tokens[0][0] + WINDOW - now
+        return 0.0
+
+    def acquire(self, tokens: int) -> float:
+        # Blocks until the request fits the budgets; returns the time spent waiting
+        started = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._prune(now)
+                wait = self._wait_time(tokens, now)
+                if wait <= 0:
+                    break
+                self._cond.wait(timeout=wait)
+            self._requests.append(now)
+            self._tokens.append((now, tokens))
+            self._token_total += tokens
+            self.in_flight += 1
+        return time.monotonic() - started
+
+    def release(self, headers: Mapping[str, str] | None = None, rate_limited: bool = False):
+        with self._cond:
+            self.in_flight -= 1
+            if headers:
+                self.update_from_headers(headers)
+            if rate_limited:
+                self.throttled += 1
+                self._successes = 0
+                self.concurrency = max(1, self.concurrency // 2)
+                delay = retry_after(headers)
+                if delay:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+                logger.warning(f"Rate limited, concurrency reduced to {self.concurrency}")
+            else:
+                self._successes += 1
+                if self._successes >= self.concurrency and self.concurrency < self.max_concurrency:
+                    self.concurrency += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+    def update_from_headers(self, headers: Mapping[str, str]):
+        # The response headers carry the org's real limits and how much of them is left
+        for header, attribute in (("x-ratelimit-limit-requests", "rpm"), ("x-ratelimit-limit-tokens", "tpm")):
+            try:
+                if headers.get(header):
+                    setattr(self, attribute, int(headers[header]))
+            except ValueError:
+                pass
+
+        for remaining_header, reset_header in (("x-ratelimit-remaining-requests", "x-ratelimit-reset-requests"),
+                                               ("x-ratelimit-remaining-tokens", "x-ratelimit-reset-tokens")):
+            try:
+                remaining = int(headers.get(remaining_header, ""))
+            except ValueError:
+                continue
+            reset = parse_duration(headers.get(reset_header))
+            if remaining <= 0 and reset:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + reset)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(model: str) -> RateLimiter:
+    # OpenAI rate limits apply per model, so each model gets its own process-wide limiter
+    with _limiters_lock:
+        if model not in _limiters:
+            _limiters[model] = RateLimiter()
+        return _limiters[model]
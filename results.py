@@ -0,0 +1,232 @@
+import csv
+import io
+import json
+import tempfile
+import threading
+from typing import IO, Dict, Iterator, List
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+from archive import EXPORT_SPOOL_SIZE, spool
+
+FILE_COLUMN = "source_file"
+CSV_CHUNK_ROWS = 10000
+# Nullable pandas dtypes for typed fields, so missing values don't turn integers into floats
+PANDAS_DTYPES = {"number": "Float64", "integer": "Int64", "boolean": "boolean"}
+
+def pack_results(results) -> Dict:
+    # Compact stored form of a file's results: field metadata once, then one list of values per item
+    if not results:
+        return {"fields": [], "confirmation_message": "", "rows": []}
+    first = results[0]
+    return {
+        "fields": [{"name": field.name, "description": field.description, "data_type": field.data_type} for field in first.data_fields],
+        "confirmation_message": first.confirmation_message,
+        "rows": [[field.value for field in result.data_fields] for result in results]
+    }
+
+def unpack_results(data) -> List[Dict]:
+    # Expands the compact form back into ResponseSchemaResults dicts; older stores hold those directly
+    if isinstance(data, list):
+        return data
+    return [
+        {
+            "data_fields": [dict(field, value=value) for field, value in zip(data["fields"], row)],
+            "confirmation_message": data["confirmation_message"]
+        }
+        for row in data["rows"]
+    ]
+
+# Marks the rows of a dropped file until the table is compacted
+_DROPPED = object()
+
+class ResultsTable:
+    # A project's extracted rows held column-wise: one list per schema field plus the source
+    # file name, with the schema metadata kept once instead of on every value
+    def __init__(self, fields: List[Dict]):
+        self.fields = fields
+        self.columns: Dict[str, list] = {FILE_COLUMN: []}
+        for field in fields:
+            self.columns.setdefault(field["name"], [])
+        # Which file each row came from; file names alone aren't unique within a project
+        self.keys: list = []
+        # Row positions of each file, so replacing a file's rows doesn't scan the whole table
+        self.file_rows: Dict[object, List[int]] = {}
+        # Rows of dropped files are marked in keys and only removed from the columns by compact()
+        self.dropped = 0
+        self._lock = threading.RLock()
+
+    @property
+    def field_names(self) -> List[str]:
+        return [field["name"] for field in self.fields]
+
+    def __len__(self) -> int:
+        return len(self.keys) - self.dropped
+
+    def append(self, key, file_name: str, rows: List[Dict]):
+        with self._lock:
+            positions = self.file_rows.setdefault(key, [])
+            for row in rows:
+                positions.append(len(self.keys))
+                self.keys.append(key)
+                self.columns[FILE_COLUMN].append(file_name)
+                for name in self.field_names:
+                    self.columns[name].append(row.get(name, ""))
+
+    def drop_file(self, key):
+        with self._lock:
+            positions = self.file_rows.pop(key, ())
+            for position in positions:
+                self.keys[position] = _DROPPED
+            self.dropped += len(positions)
+            # Dropped rows are kept until they outnumber the live ones
+            if self.dropped > len(self):
+                self.compact()
+
+    def replace_file(self, key, file_name: str, rows: List[Dict]):
+        with self._lock:
+            self.drop_file(key)
+            self.append(key, file_name, rows)
+
+    def compact(self):
+        # Removes dropped rows; new lists replace the old ones, so earlier snapshots stay valid
+        with self._lock:
+            if not self.dropped:
+                return
+            keep = [i for i, row_key in enumerate(self.keys) if row_key is not _DROPPED]
+            self.keys = [self.keys[i] for i in keep]
+            for name, column in self.columns.items():
+                self.columns[name] = [column[i] for i in keep]
+            self.file_rows = {}
+            for position, row_key in enumerate(self.keys):
+                self.file_rows.setdefault(row_key, []).append(position)
+            self.dropped = 0
+
+    def scalar_type(self, name: str) -> str | None:
+        # Data type of a field holding single values; None for the file column and array fields
+        for field in self.fields:
+            if field["name"] == name and not field.get("array"):
+                return field.get("data_type", "").lower()
+        return None
+
+    def to_dataframe(self, include_file: bool = False, start: int = 0, stop: int | None = None) -> "pd.DataFrame":
+        # Rows start to stop (all by default), so a page of a large table can be shown without
+        # converting the rest. pandas is imported here so headless runs that never build a
+        # DataFrame don't pay for it.
+        import pandas as pd
+
+        with self._lock:
+            self.compact()
+            names = ([FILE_COLUMN] if include_file else []) + self.field_names
+            columns = {name: self.columns[name][start:stop] for name in names}
+        for name in names:
+            data_type = self.scalar_type(name)
+            if data_type == "date":
+                columns[name] = pd.to_datetime(pd.Series(columns[name], dtype=object), errors="coerce")
+            elif data_type in PANDAS_DTYPES:
+                try:
+                    columns[name] = pd.array(columns[name], dtype=PANDAS_DTYPES[data_type])
+                except (TypeError, ValueError):
+                    pass
+        return pd.DataFrame(columns, columns=names)
+
+    def to_arrow(self, include_file: bool = True):
+        if pa is None:
+            raise ImportError("pyarrow is required for Arrow and Parquet export")
+        with self._lock:
+            self.compact()
+            names = ([FILE_COLUMN] if include_file else []) + self.field_names
+            columns = {name: pa.array(self.columns[name]) for name in names}
+        for name in names:
+            if self.scalar_type(name) == "date" and pa.types.is_string(columns[name].type):
+                try:
+                    columns[name] = columns[name].cast(pa.date32())
+                except pa.ArrowInvalid:
+                    pass
+        return pa.table(columns)
+
+    def write_parquet(self, include_file: bool = True) -> IO[bytes]:
+        output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+        pq.write_table(self.to_arrow(include_file), output)
+        output.seek(0)
+        return output
+
+    def snapshot(self, include_file: bool = False):
+        # Column names, columns and row count as of now; later appends are not included
+        with self._lock:
+            self.compact()
+            names = ([FILE_COLUMN] if include_file else []) + self.field_names
+            return names, [self.columns[name] for name in names], len(self)
+
+    def iter_rows(self, include_file: bool = False, chunk_rows: int = CSV_CHUNK_ROWS, flat: bool = False) -> Iterator[list]:
+        # Row tuples a chunk at a time, without materializing the whole table row-wise. flat
+        # writes array values as JSON text, for formats whose cells hold a single value.
+        names, columns, total = self.snapshot(include_file)
+        for start in range(0, total, chunk_rows):
+            end = min(start + chunk_rows, total)
+            rows = zip(*(column[start:end] for column in columns))
+            if flat:
+                yield [tuple(json.dumps(value, ensure_ascii=False) if isinstance(value, list) else value for value in row) for row in rows]
+            else:
+                yield list(rows)
+
+    def iter_jsonl(self, include_file: bool = False, chunk_rows: int = CSV_CHUNK_ROWS) -> Iterator[str]:
+        names = self.snapshot(include_file)[0]
+        for rows in self.iter_rows(include_file, chunk_rows):
+            yield "".join(json.dumps(dict(zip(names, row)), ensure_ascii=False) + "\n" for row in rows)
+
+    def write_csv(self, include_file: bool = False) -> IO[bytes]:
+        return spool(self.iter_csv(include_file))
+
+    def write_jsonl(self, include_file: bool = False) -> IO[bytes]:
+        return spool(self.iter_jsonl(include_file))
+
+    def write_excel(self, include_file: bool = False) -> IO[bytes]:
+        # constant_memory makes xlsxwriter flush each row to disk as soon as it is written
+        output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+        workbook = xlsxwriter.Workbook(output, {"constant_memory": True, "strings_to_numbers": False})
+        worksheet = workbook.add_worksheet("Results")
+        worksheet.write_row(0, 0, self.snapshot(include_file)[0])
+        row_index = 1
+        for rows in self.iter_rows(include_file, flat=True):
+            for row in rows:
+                worksheet.write_row(row_index, 0, row)
+                row_index += 1
+        workbook.close()
+        output.seek(0)
+        return output
+
+    def iter_csv(self, include_file: bool = False, chunk_rows: int = CSV_CHUNK_ROWS) -> Iterator[str]:
+        names = self.snapshot(include_file)[0]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        writer.writerow(names)
+        for rows in self.iter_rows(include_file, chunk_rows, flat=True):
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+
+def export_formats() -> Dict[str, tuple]:
+    # Label -> (writer method name, file extension, mime type) for the formats available here
+    formats = {
+        "CSV": ("write_csv", "csv", "text/csv"),
+        "JSON Lines": ("write_jsonl", "jsonl", "application/jsonl")
+    }
+    if xlsxwriter is not None:
+        formats["Excel"] = ("write_excel", "xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    if pa is not None:
+        formats["Parquet"] = ("write_parquet", "parquet", "application/vnd.apache.parquet")
+    return formats
@@ -0,0 +1,59 @@
+import json
+import os
+from typing import List, NamedTuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Models extraction calls can be routed to, cheapest first
+MODEL_TIERS = json.loads(os.getenv("MODEL_TIERS", '["gpt-4o-mini", "gpt-4o"]'))
+# "fixed": every call goes to the first tier (the original behaviour)
+# "size": inputs or schemas above the thresholds below go straight to the next tier
+# "cascade": routed by size, then escalated a tier at a time while the output fails validation or is empty
+ROUTING_POLICIES = ("fixed", "size", "cascade")
+ROUTING_POLICY = os.getenv("ROUTING_POLICY", "fixed")
+ROUTING_LARGE_TOKENS = int(os.getenv("ROUTING_LARGE_TOKENS", "8000"))
+ROUTING_LARGE_FIELDS = int(os.getenv("ROUTING_LARGE_FIELDS", "15"))
+
+class RouteDecision(NamedTuple):
+    model: str
+    tier: int
+    # Why the tier was picked: "fixed", "small", "tokens", "fields", or "escalated_empty" /
+    # "escalated_invalid" for cascade steps
+    reason: str
+
+class Router:
+    # Picks the model tier for an extraction call from its input size, the number of schema
+    # fields and the routing policy (the project's, or ROUTING_POLICY)
+    def __init__(self, tiers: List[str] | None = None, policy: str = ROUTING_POLICY,
+                 large_tokens: int = ROUTING_LARGE_TOKENS, large_fields: int = ROUTING_LARGE_FIELDS):
+        self.tiers = list(tiers or MODEL_TIERS)
+        if not self.tiers:
+            raise ValueError("At least one model tier is required")
+        if policy not in ROUTING_POLICIES:
+            raise ValueError(f"Unknown routing policy {policy!r}; use one of {', '.join(ROUTING_POLICIES)}")
+        self.policy = policy
+        self.large_tokens = large_tokens
+        self.large_fields = large_fields
+
+    def resolve(self, policy: str | None = None) -> str:
+        # Projects without a policy of their own use the router's
+        return policy if policy in ROUTING_POLICIES else self.policy
+
+    def route(self, tokens: int, field_count: int, policy: str | None = None) -> RouteDecision:
+        policy = self.resolve(policy)
+        if policy == "fixed" or len(self.tiers) == 1:
+            return RouteDecision(self.tiers[0], 0, "fixed")
+        if tokens > self.large_tokens:
+            return RouteDecision(self.tiers[1], 1, "tokens")
+        if field_count > self.large_fields:
+            return RouteDecision(self.tiers[1], 1, "fields")
+        return RouteDecision(self.tiers[0], 0, "small")
+
+    def escalate(self, decision: RouteDecision, policy: str | None, empty: bool) -> RouteDecision | None:
+        # The next tier up after an output that failed, or None when there is nothing to escalate to
+        if self.resolve(policy) != "cascade" or decision.tier + 1 >= len(self.tiers):
+            return None
+        tier = decision.tier + 1
+        return RouteDecision(self.tiers[tier], tier, "escalated_empty" if empty else "escalated_invalid")
@@ -0,0 +1,172 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextvars
+import logging
+import os
+import threading
+from typing import Callable, List
+
+from chunking import count_tokens
+from dedupe import DEDUPE_THRESHOLD, DEDUPE_VERIFY, near_duplicate_groups, values_supported
+from metrics import call_labels
+from model import PACK_MAX_FILES, LLMHelper, ResponseSchemaResults
+from project import FileState, Project, TextFile, result_rows
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = int(os.getenv("EXTRACTION_MAX_WORKERS", "8"))
+PACK_MAX_TOKENS = int(os.getenv("EXTRACTION_PACK_TOKENS", "6000"))
+
+def run_file(file: TextFile, project: Project, llm: LLMHelper) -> List[TextFile]:
+    file.state = FileState.RUNNING
+    try:
+        with call_labels(project=project.title, file=file.file_name):
+            file.results = llm.run_schema(project.prompt, file.contents, project.schema, project.routing_policy)
+    except Exception:
+        file.state = FileState.ERROR
+        raise
+    file.run_version = project.run_version
+    file.duplicate_of = None
+    file.state = FileState.FINISHED
+    return [file]
+
+def run_pack(files: List[TextFile], project: Project, llm: LLMHelper) -> List[TextFile]:
+    for file in files:
+        file.state = FileState.RUNNING
+    try:
+        with call_labels(project=project.title, file=f"{files[0].file_name} (+{len(files) - 1} packed)"):
+            results = llm.run_schema_packed(project.prompt, [file.contents for file in files], project.schema, project.routing_policy)
+    except Exception:
+        for file in files:
+            file.state = FileState.ERROR
+        raise
+    version = project.run_version
+    for file, file_results in zip(files, results):
+        file.results = file_results
+        file.run_version = version
+        file.duplicate_of = None
+        file.state = FileState.FINISHED
+    return files
+
+def pack_files(files: List[TextFile], max_tokens: int = PACK_MAX_TOKENS, max_files: int = PACK_MAX_FILES,
+               model: str = "gpt-4o-mini") -> List[List[TextFile]]:
+    # Groups small files into packs of up to max_tokens of content; files too big to share a
+    # request get a pack of their own.
+    if max_tokens <= 0 or max_files <= 1:
+        return [[file] for file in files]
+
+    packs = []
+    current = []
+    current_tokens = 0
+    for file in files:
+        tokens = count_tokens(file.contents, model)
+        if tokens > max_tokens // 2:
+            packs.append([file])
+            continue
+        if current and (current_tokens + tokens > max_tokens or len(current) >= max_files):
+            packs.append(current)
+            current = []
+            current_tokens = 0
+        current.append(file)
+        current_tokens += tokens
+    if current:
+        packs.append(current)
+    return packs
+
+def near_duplicates(project: Project, files: List[TextFile], threshold: float = DEDUPE_THRESHOLD):
+    # {representative: [near duplicates]} for the files of a run. Representatives are files of
+    # the project that were extracted under the current prompt and schema, or files of the run
+    # itself, which then run first.
+    version = project.run_version
+    run = set(map(id, files))
+    references = [
+        (file, file.minhash) for file in project.files
+        if id(file) not in run and file.state == FileState.FINISHED and not project.needs_run(file, version) and file.duplicate_of is None
+    ]
+    return near_duplicate_groups(references, ((file, file.minhash) for file in files), threshold)
+
+def reuse_results(file: TextFile, representative: TextFile, project: Project, verify: bool = DEDUPE_VERIFY) -> bool:
+    # Gives a near duplicate a copy of its representative's results instead of extracting it.
+    # With verify, only when every extracted value also appears in the duplicate.
+    if representative.state != FileState.FINISHED:
+        return False
+    results = [result.to_dict() for result in representative.results]
+    if verify:
+        fields = [field.name for field in project.schema.data_fields]
+        if not values_supported(result_rows(results), file.contents, representative.contents, fields):
+            return False
+    file.results = [ResponseSchemaResults.from_dict(result) for result in results]
+    file.run_version = project.run_version
+    file.duplicate_of = representative.file_name
+    file.state = FileState.FINISHED
+    return True
+
+def run_files(project: Project, files: List[TextFile] | None = None, max_workers: int = DEFAULT_MAX_WORKERS,
+              llm: LLMHelper | None = None, pack_tokens: int = 0,
+              on_file_done: Callable[[TextFile, Exception | None], None] | None = None,
+              cancel_event: threading.Event | None = None, run_id: str | None = None,
+              dedupe_threshold: float = DEDUPE_THRESHOLD) -> List[TextFile]:
+    # Returns the files that failed. A failed file is marked FileState.ERROR and does not
+    # stop the rest of the run. on_file_done is called from the calling thread as files finish.
+    # With pack_tokens set, small files share requests of up to that many content tokens.
+    # Setting cancel_event stops dispatching; files that never started stay FileState.NOT_STARTED.
+    # run_id labels the run's calls in the metrics.
+    # Files at least dedupe_threshold similar to one already extracted (or extracted earlier in
+    # the run) reuse its results; those that can't are extracted after the rest.
+    files = project.files if files is None else files
+    llm = llm if llm is not None else LLMHelper()
+    if not files:
+        return []
+
+    for file in files:
+        file.state = FileState.NOT_STARTED
+
+    groups = near_duplicates(project, files, dedupe_threshold) if dedupe_threshold > 0 else {}
+    duplicates = {id(file) for group in groups.values() for file in group}
+    failed = dispatch_files(project, [file for file in files if id(file) not in duplicates], max_workers, llm, pack_tokens,
+                            on_file_done, cancel_event, run_id)
+    if not groups or (cancel_event is not None and cancel_event.is_set()):
+        return failed
+
+    remaining = []
+    for representative, group in groups.items():
+        for file in group:
+            if reuse_results(file, representative, project):
+                if on_file_done is not None:
+                    on_file_done(file, None)
+            else:
+                remaining.append(file)
+    reused = len(duplicates) - len(remaining)
+    if reused:
+        logger.info(f"Reused near-duplicate results for {reused} file(s)")
+    return failed + dispatch_files(project, remaining, max_workers, llm, pack_tokens, on_file_done, cancel_event, run_id)
+
+def dispatch_files(project: Project, files: List[TextFile], max_workers: int, llm: LLMHelper, pack_tokens: int,
+                   on_file_done: Callable[[TextFile, Exception | None], None] | None,
+                   cancel_event: threading.Event | None, run_id: str | None) -> List[TextFile]:
+    failed = []
+    if not files:
+        return failed
+
+    packs = pack_files(files, pack_tokens, model=llm.model)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(packs)))) as executor, call_labels(run=run_id):
+        # Workers run in copies of this context so their calls carry the run label
+        futures = {}
+        for pack in packs:
+            task, target = (run_file, pack[0]) if len(pack) == 1 else (run_pack, pack)
+            futures[executor.submit(contextvars.copy_context().run, task, target, project, llm)] = pack
+        for future in as_completed(futures):
+            if cancel_event is not None and cancel_event.is_set():
+                for pending in futures:
+                    pending.cancel()
+            if future.cancelled():
+                continue
+            pack = futures[future]
+            error = future.exception()
+            for file in pack:
+                if error is not None:
+                    logger.error(f"Error processing file {file.file_name}: {str(error)}")
+                    failed.append(file)
+                if on_file_done is not None:
+                    on_file_done(file, error)
+
+    return failed
@@ -0,0 +1,69 @@
+# Background LLM calls started as soon as their inputs exist, so a result is usually ready by
+# the time it is needed. Calls are keyed by their inputs: asking again for the same key reuses
+# the call in flight (or its result) instead of starting another one.
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextvars
+import logging
+import os
+import threading
+from typing import Callable, Hashable
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+load_dotenv()
+
+SPECULATIVE_MAX_WORKERS = int(os.getenv("SPECULATIVE_MAX_WORKERS", "4"))
+# Finished calls kept for reuse
+SPECULATIVE_MAX_RESULTS = int(os.getenv("SPECULATIVE_MAX_RESULTS", "64"))
+
+class SpeculativeCalls:
+    def __init__(self, max_workers: int = SPECULATIVE_MAX_WORKERS, max_results: int = SPECULATIVE_MAX_RESULTS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speculative")
+        self.max_results = max_results
+        self.futures: OrderedDict[Hashable, Future] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, key: Hashable, fn: Callable, *args, **kwargs) -> Future:
+        # Runs fn in the background unless a call for key is already running or has succeeded.
+        # Failed and cancelled calls are started again.
+        with self._lock:
+            future = self.futures.get(key)
+            if future is not None and not future.cancelled() and not (future.done() and future.exception() is not None):
+                self.futures.move_to_end(key)
+                return future
+            future = self.executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+            self.futures[key] = future
+            self.evict()
+            return future
+
+    def get(self, key: Hashable) -> Future | None:
+        with self._lock:
+            return self.futures.get(key)
+
+    def cancel(self, key: Hashable) -> bool:
+        # Calls that haven't started are dropped. A request already sent can't be recalled, so it
+        # is left to finish and its result kept for reuse.
+        with self._lock:
+            future = self.futures.get(key)
+            if future is not None and future.cancel():
+                del self.futures[key]
+                return True
+            return False
+
+    def evict(self):
+        # Oldest finished calls beyond max_results; calls still running are kept
+        finished = [key for key, future in self.futures.items() if future.done()]
+        for key in finished[:max(0, len(finished) - self.max_results)]:
+            del self.futures[key]
+
+_calls: SpeculativeCalls | None = None
+_calls_lock = threading.Lock()
+
+def get_speculative_calls() -> SpeculativeCalls:
+    global _calls
+    with _calls_lock:
+        if _calls is None:
+            _calls = SpeculativeCalls()
+        return _calls
@@ -0,0 +1,223 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, List
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+load_dotenv()
+
+PROJECTS_DB_PATH = os.getenv("PROJECTS_DB_PATH", "data/projects.sqlite")
+# FileState.FINISHED's stored value, written into the partial index below
+FINISHED_STATE = "Finished"
+
+class ProjectStore:
+    # Row-level persistence for projects, files and results. File contents and results are
+    # only read when asked for, so listing projects and files stays cheap however large they get.
+    def __init__(self, path: str = PROJECTS_DB_PATH):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA foreign_keys=ON")
+            self._conn.executescript(
+                "CREATE TABLE IF NOT EXISTS projects ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT NOT NULL, description TEXT NOT NULL, prompt TEXT NOT NULL, "
+                "schema TEXT, state TEXT NOT NULL, batch_id TEXT);"
+                "CREATE TABLE IF NOT EXISTS files ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, project_id INTEGER NOT NULL REFERENCES projects (id) ON DELETE CASCADE, "
+                "position INTEGER NOT NULL, file_name TEXT NOT NULL, state TEXT NOT NULL, size INTEGER NOT NULL, contents BLOB NOT NULL);"
+                "CREATE INDEX IF NOT EXISTS files_project ON files (project_id, position);"
+                "CREATE INDEX IF NOT EXISTS projects_title ON projects (title);"
+                "CREATE INDEX IF NOT EXISTS projects_state ON projects (state);"
+                "CREATE TABLE IF NOT EXISTS results ("
+                "file_id INTEGER PRIMARY KEY REFERENCES files (id) ON DELETE CASCADE, results TEXT NOT NULL);"
+            )
+            self.migrate()
+            self._conn.commit()
+
+    def migrate(self):
+        # Content hashes and the prompt/schema version each file was last run against, added to
+        # stores created before dirty tracking. Existing files get their hash computed once; their
+        # version stays NULL until ProjectsManager stamps finished ones with their project's version.
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(files)")}
+        if "content_hash" not in columns:
+            self._conn.execute("ALTER TABLE files ADD COLUMN content_hash TEXT")
+            rows = self._conn.execute("SELECT id, contents FROM files").fetchall()
+            self._conn.executemany(
+                "UPDATE files SET content_hash = ? WHERE id = ?",
+                ((hashlib.sha256(bytes(contents)).hexdigest(), file_id) for file_id, contents in rows)
+            )
+        if "run_version" not in columns:
+            self._conn.execute("ALTER TABLE files ADD COLUMN run_version TEXT")
+        # Finished files still without a version; the version depends on the project's prompt and
+        # schema, so ProjectsManager stamps them when it loads the projects
+        self._conn.execute(
+            f"CREATE INDEX IF NOT EXISTS files_unversioned ON files (project_id) WHERE run_version IS NULL AND state = '{FINISHED_STATE}'"
+        )
+        # MinHash signature for near-duplicate detection (computed on first use for older files)
+        # and the file whose results a near duplicate reused
+        if "minhash" not in columns:
+            self._conn.execute("ALTER TABLE files ADD COLUMN minhash BLOB")
+        if "duplicate_of" not in columns:
+            self._conn.execute("ALTER TABLE files ADD COLUMN duplicate_of TEXT")
+        # MinHash signatures from before the hash family was fixed (version 1) don't match new ones;
+        # they are cleared and recomputed on first use
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+            self._conn.execute("UPDATE files SET minhash = NULL")
+            self._conn.execute("PRAGMA user_version = 1")
+        # Per-project model routing policy; NULL uses ROUTING_POLICY
+        if "routing_policy" not in {row[1] for row in self._conn.execute("PRAGMA table_info(projects)")}:
+            self._conn.execute("ALTER TABLE projects ADD COLUMN routing_policy TEXT")
+
+    def list_projects(self, title: str | None = None, state: str | None = None) -> List[Dict]:
+        # Every project, or only those with the given title and/or state (both indexed)
+        conditions = [(column, value) for column, value in (("title", title), ("state", state)) if value is not None]
+        where = " WHERE " + " AND ".join(f"{column} = ?" for column, _ in conditions) if conditions else ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, title, description, prompt, schema, state, batch_id, routing_policy FROM projects{where} ORDER BY id",
+                tuple(value for _, value in conditions)
+            ).fetchall()
+        return [
+            {"id": row[0], "title": row[1], "description": row[2], "prompt": row[3],
+             "schema": json.loads(row[4]) if row[4] else None, "state": row[5], "batch_id": row[6], "routing_policy": row[7]}
+            for row in rows
+        ]
+
+    def save_project(self, data: Dict) -> int:
+        values = (data["title"], data["description"], data["prompt"],
+                  json.dumps(data["schema"]) if data["schema"] else None, data["state"], data.get("batch_id"), data.get("routing_policy"))
+        with self._lock:
+            if data.get("id") is None:
+                cursor = self._conn.execute(
+                    "INSERT INTO projects (title, description, prompt, schema, state, batch_id, routing_policy) VALUES (?, ?, ?, ?, ?, ?, ?)", values
+                )
+                project_id = cursor.lastrowid
+            else:
+                project_id = data["id"]
+                self._conn.execute(
+                    "UPDATE projects SET title = ?, description = ?, prompt = ?, schema = ?, state = ?, batch_id = ?, routing_policy = ? WHERE id = ?",
+                    values + (project_id,)
+                )
+            self._conn.commit()
+        return project_id
+
+    def delete_project(self, project_id: int):
+        with self._lock:
+            self._conn.execute("DELETE FROM projects WHERE id = ?", (project_id,))
+            self._conn.commit()
+
+    def list_files(self, project_id: int) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, file_name, state, size, content_hash, run_version, minhash, duplicate_of FROM files "
+                "WHERE project_id = ? ORDER BY position", (project_id,)
+            ).fetchall()
+        return [
+            {"id": row[0], "file_name": row[1], "state": row[2], "size": row[3], "content_hash": row[4], "run_version": row[5],
+             "minhash": bytes(row[6]) if row[6] is not None else None, "duplicate_of": row[7]}
+            for row in rows
+        ]
+
+    def insert_file(self, project_id: int, position: int, file_name: str, contents: str, state: str, results: Dict | None = None,
+                    run_version: str | None = None, minhash: bytes | None = None, duplicate_of: str | None = None) -> int:
+        data = contents.encode("utf-8")
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO files (project_id, position, file_name, state, size, contents, content_hash, run_version, minhash, duplicate_of) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (project_id, position, file_name, state, len(data), data, hashlib.sha256(data).hexdigest(), run_version, minhash, duplicate_of)
+            )
+            if results:
+                self._conn.execute("INSERT INTO results (file_id, results) VALUES (?, ?)", (cursor.lastrowid, json.dumps(results)))
+            self._conn.commit()
+        return cursor.lastrowid
+
+    def insert_files(self, project_id: int, files: List[tuple]) -> List[int]:
+        # Bulk insert of (position, file_name, contents, state, minhash) rows in a single transaction
+        ids = []
+        with self._lock:
+            for position, file_name, contents, state, minhash in files:
+                data = contents.encode("utf-8")
+                cursor = self._conn.execute(
+                    "INSERT INTO files (project_id, position, file_name, state, size, contents, content_hash, minhash) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (project_id, position, file_name, state, len(data), data, hashlib.sha256(data).hexdigest(), minhash)
+                )
+                ids.append(cursor.lastrowid)
+            self._conn.commit()
+        return ids
+
+    def update_file(self, file_id: int, state: str, results: Dict | None = None, run_version: str | None = None,
+                    duplicate_of: str | None = None):
+        # results=None leaves the stored results untouched
+        with self._lock:
+            self._conn.execute(
+                "UPDATE files SET state = ?, run_version = ?, duplicate_of = ? WHERE id = ?", (state, run_version, duplicate_of, file_id)
+            )
+            if results is not None:
+                self._conn.execute("INSERT OR REPLACE INTO results (file_id, results) VALUES (?, ?)", (file_id, json.dumps(results)))
+            self._conn.commit()
+
+    def replace_file(self, file_id: int, contents: str, state: str, results: Dict | None, run_version: str | None = None,
+                     minhash: bytes | None = None):
+        # results=None removes the stored results
+        data = contents.encode("utf-8")
+        with self._lock:
+            self._conn.execute(
+                "UPDATE files SET contents = ?, size = ?, state = ?, content_hash = ?, run_version = ?, minhash = ?, duplicate_of = NULL "
+                "WHERE id = ?",
+                (data, len(data), state, hashlib.sha256(data).hexdigest(), run_version, minhash, file_id)
+            )
+            if results is None:
+                self._conn.execute("DELETE FROM results WHERE file_id = ?", (file_id,))
+            else:
+                self._conn.execute("INSERT OR REPLACE INTO results (file_id, results) VALUES (?, ?)", (file_id, json.dumps(results)))
+            self._conn.commit()
+
+    def set_minhash(self, file_id: int, minhash: bytes):
+        with self._lock:
+            self._conn.execute("UPDATE files SET minhash = ? WHERE id = ?", (minhash, file_id))
+            self._conn.commit()
+
+    def unversioned_projects(self) -> List[int]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT DISTINCT project_id FROM files WHERE run_version IS NULL AND state = '{FINISHED_STATE}'"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def stamp_run_version(self, project_id: int, run_version: str):
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE files SET run_version = ? WHERE project_id = ? AND run_version IS NULL AND state = '{FINISHED_STATE}'",
+                (run_version, project_id)
+            )
+            self._conn.commit()
+
+    def load_contents(self, file_id: int) -> str:
+        with self._lock:
+            row = self._conn.execute("SELECT contents FROM files WHERE id = ?", (file_id,)).fetchone()
+        return bytes(row[0]).decode("utf-8") if row else ""
+
+    def load_project_results(self, project_id: int, state: str) -> List[Dict]:
+        # Results of every file of a project in the given state, in file order, in one query
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT f.id, f.file_name, r.results FROM files f JOIN results r ON r.file_id = f.id "
+                "WHERE f.project_id = ? AND f.state = ? ORDER BY f.position",
+                (project_id, state)
+            ).fetchall()
+        return [{"id": row[0], "file_name": row[1], "results": json.loads(row[2])} for row in rows]
+
+    def load_results(self, file_id: int) -> Dict | List[Dict] | None:
+        with self._lock:
+            row = self._conn.execute("SELECT results FROM results WHERE file_id = ?", (file_id,)).fetchone()
+        return json.loads(row[0]) if row else None
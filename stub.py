@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Dict, Type
+import uuid
+
+from dotenv import load_dotenv
+import httpx
+import openai
+from openai.lib._pydantic import to_strict_json_schema
+from openai.types.chat import ChatCompletion, ParsedChatCompletion
+from pydantic import BaseModel
+
+from model import SOURCE_ID_FIELD
+
+load_dotenv()
+
+# Offline stand-in for the chat completions part of the OpenAI client (LLM_BACKEND=stub)
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "0"))
+STUB_LATENCY_JITTER_MS = float(os.getenv("STUB_LATENCY_JITTER_MS", "0"))
+# Fraction of requests answered with a 500 / a 429
+STUB_ERROR_RATE = float(os.getenv("STUB_ERROR_RATE", "0"))
+STUB_RATE_LIMIT_RATE = float(os.getenv("STUB_RATE_LIMIT_RATE", "0"))
+STUB_RETRY_AFTER_MS = int(os.getenv("STUB_RETRY_AFTER_MS", "100"))
+STUB_SEED = int(os.getenv("STUB_SEED", "0"))
+# Items returned for each array in a response schema
+STUB_ITEMS = int(os.getenv("STUB_ITEMS", "1"))
+
+# Prompt caching as the API does it: prefixes of at least 1024 tokens, matched in 128 token steps.
+# Tokens are approximated as 4 characters.
+PROMPT_CACHE_MIN_CHARS = 1024 * 4
+PROMPT_CACHE_STEP_CHARS = 128 * 4
+# Prompt prefixes remembered for caching, least recently used dropped first
+STUB_PREFIX_CACHE_ENTRIES = int(os.getenv("STUB_PREFIX_CACHE_ENTRIES", "100000"))
+
+STUB_REQUEST = httpx.Request("POST", "https://stub.local/v1/chat/completions")
+
+def placeholder_value(definition: dict, defs: Dict[str, dict] | None = None, items: int = 1, name: str = ""):
+    # Deterministic value that satisfies a strict JSON schema definition
+    if "$ref" in definition:
+        return placeholder_value((defs or {})[definition["$ref"].split("/")[-1]], defs, items, name)
+    if "anyOf" in definition:
+        return placeholder_value(definition["anyOf"][0], defs, items, name)
+    if "enum" in definition:
+        return definition["enum"][0]
+    json_type = definition.get("type")
+    if isinstance(json_type, list):
+        json_type = json_type[0]
+    if json_type == "object":
+        return {key: placeholder_value(value, defs, items, key) for key, value in definition.get("properties", {}).items()}
+    if json_type == "array":
+        item = definition.get("items", {})
+        if "$ref" in item:
+            item = (defs or {})[item["$ref"].split("/")[-1]]
+        # Items of a packed request are spread over every document id that was sent
+        ids = item.get("properties", {}).get(SOURCE_ID_FIELD, {}).get("enum") or [None]
+        values = []
+        for source_id in ids:
+            for _ in range(items):
+                value = placeholder_value(item, defs, items, name)
+                if source_id is not None:
+                    value[SOURCE_ID_FIELD] = source_id
+                values.append(value)
+        return values
+    if json_type == "string" and "date" in definition.get("description", "").lower():
+        return "2024-01-01"
+    return {"string": name, "number": 0, "integer": 0, "boolean": False}.get(json_type, "")
+
+def placeholder_content(schema: dict, items: int = 1) -> str:
+    return json.dumps(placeholder_value(schema, schema.get("$defs"), items))
+
+def placeholder_completion(body: dict, items: int = 1, cached_tokens: int = 0) -> dict:
+    # Schema-conformant chat completion with placeholder items, for offline runs
+    content = placeholder_content(body["response_format"]["json_schema"]["schema"], items)
+    prompt_tokens = (len(json.dumps(body["response_format"])) + len(json.dumps(body["messages"]))) // 4
+    completion_tokens = len(content) // 4
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body["model"],
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content, "refusal": None},
+            "finish_reason": "stop"
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": min(cached_tokens, prompt_tokens)}
+        }
+    }
+
+class StubClient:
+    # Answers chat completions in-process with schema-conformant placeholders after a simulated
+    # latency, failing a configurable fraction of requests with 500s and 429s. Faults and latency
+    # are derived from the request and how often it has been sent, so a run behaves the same
+    # however its requests are scheduled across threads.
+    def __init__(self, latency_ms: float = STUB_LATENCY_MS, jitter_ms: float = STUB_LATENCY_JITTER_MS,
+                 error_rate: float = STUB_ERROR_RATE, rate_limit_rate: float = STUB_RATE_LIMIT_RATE,
+                 retry_after_ms: int = STUB_RETRY_AFTER_MS, seed: int = STUB_SEED, items: int = STUB_ITEMS):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after_ms = retry_after_ms
+        self.seed = seed
+        self.items = items
+        self.requests = 0
+        self.cached_tokens = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._attempts: Dict[str, int] = {}
+        self._cached_prefixes: OrderedDict[bytes, None] = OrderedDict()
+        self._lock = threading.Lock()
+        completions = SimpleNamespace(with_raw_response=SimpleNamespace(create=self.create))
+        self.chat = SimpleNamespace(completions=completions)
+        beta_completions = SimpleNamespace(with_raw_response=SimpleNamespace(parse=self.parse))
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=beta_completions))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "rate_limited": self.rate_limited,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "completion_tokens": self.completion_tokens
+            }
+
+    def create(self, **kwargs):
+        body = self.respond(kwargs, kwargs["response_format"]["json_schema"]["schema"] if "response_format" in kwargs else None)
+        return SimpleNamespace(headers=httpx.Headers(), parse=lambda: ChatCompletion.model_validate(body))
+
+    def parse(self, response_format: Type[BaseModel], **kwargs):
+        body = self.respond(kwargs, to_strict_json_schema(response_format))
+        message = body["choices"][0]["message"]
+        message["parsed"] = response_format.model_validate_json(message["content"])
+        return SimpleNamespace(headers=httpx.Headers(), parse=lambda: ParsedChatCompletion[response_format].model_validate(body))
+
+    def respond(self, kwargs: dict, schema: dict | None) -> dict:
+        key = hashlib.sha256(json.dumps(kwargs["messages"], sort_keys=True).encode("utf-8")).hexdigest()
+        with self._lock:
+            attempt = self._attempts.get(key, 0)
+            self._attempts[key] = attempt + 1
+            self.requests += 1
+        rng = random.Random(f"{self.seed}:{key}:{attempt}")
+
+        delay = self.latency_ms + rng.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        fault = rng.random()
+        if fault < self.rate_limit_rate:
+            with self._lock:
+                self.rate_limited += 1
+            response = httpx.Response(429, headers={"retry-after-ms": str(self.retry_after_ms)}, request=STUB_REQUEST)
+            raise openai.RateLimitError("Stub rate limit reached", response=response, body=None)
+        if fault < self.rate_limit_rate + self.error_rate:
+            with self._lock:
+                self.errors += 1
+            raise openai.InternalServerError("Stub server error", response=httpx.Response(500, request=STUB_REQUEST), body=None)
+
+        # Plain completions get a JSON string as their text
+        body = placeholder_completion({"model": kwargs["model"], "messages": kwargs["messages"],
+                                       "response_format": {"json_schema": {"schema": schema or {"type": "string"}}}},
+                                      self.items, self.cached_prefix_tokens(kwargs, schema))
+        usage = body["usage"]
+        with self._lock:
+            self.prompt_tokens += usage["prompt_tokens"]
+            self.cached_tokens += usage["prompt_tokens_details"]["cached_tokens"]
+            self.completion_tokens += usage["completion_tokens"]
+        return body
+
+    def cached_prefix_tokens(self, kwargs: dict, schema: dict | None) -> int:
+        # Longest prefix of this prompt (schema first, then the messages) seen by an earlier request.
+        # One running hash over the prompt gives every prefix's digest in a single pass.
+        prompt = json.dumps(schema) + "".join(f"{message['role']}:{message['content']}" for message in kwargs["messages"])
+        running = hashlib.sha256(prompt[:PROMPT_CACHE_MIN_CHARS].encode("utf-8"))
+        hashes = []
+        for end in range(PROMPT_CACHE_MIN_CHARS, len(prompt) + 1, PROMPT_CACHE_STEP_CHARS):
+            if end > PROMPT_CACHE_MIN_CHARS:
+                running.update(prompt[end - PROMPT_CACHE_STEP_CHARS:end].encode("utf-8"))
+            hashes.append(running.digest())
+        with self._lock:
+            cached = 0
+            for index, digest in enumerate(hashes):
+                if digest not in self._cached_prefixes:
+                    break
+                cached = (PROMPT_CACHE_MIN_CHARS + index * PROMPT_CACHE_STEP_CHARS) // 4
+            for digest in hashes:
+                self._cached_prefixes[digest] = None
+                self._cached_prefixes.move_to_end(digest)
+            while len(self._cached_prefixes) > STUB_PREFIX_CACHE_ENTRIES:
+                self._cached_prefixes.popitem(last=False)
+        return cached
+
+_stub_client: StubClient | None = None
+_stub_lock = threading.Lock()
+
+def get_stub_client() -> StubClient:
+    global _stub_client
+    with _stub_lock:
+        if _stub_client is None:
+            _stub_client = StubClient()
+        return _stub_client
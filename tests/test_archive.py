@@ -0,0 +1,38 @@
+import io
+import json
+
+from archive import iter_import, write_export
+from model import ResponseSchema
+from project import Project, TextFile
+
+def test_import_streams_files_between_project_and_end():
+    # Older exports list the schema after the files
+    data = [
+        {"title": "First", "prompt": "Extract names", "files": [{"file_name": "a.txt"}, {"file_name": "b.txt"}],
+         "schema": {"data_fields": [{"name": "name"}]}, "state": "COMPLETE"},
+        {"title": "Second", "files": [], "prompt": "Extract dates"}
+    ]
+    events = list(iter_import(io.BytesIO(json.dumps(data).encode("utf-8"))))
+
+    assert [kind for kind, _ in events] == ["project", "file", "file", "end_project", "project", "end_project"]
+    project, first, second, end = events[:4]
+    assert project[1] == {"title": "First", "prompt": "Extract names"}
+    assert [first[1]["file_name"], second[1]["file_name"]] == ["a.txt", "b.txt"]
+    assert end[1]["schema"] == {"data_fields": [{"name": "name"}]}
+    assert end[1]["state"] == "COMPLETE"
+    assert "files" not in end[1]
+    # Keys after the files are only in the end_project meta
+    assert events[4][1] == {"title": "Second"}
+    assert events[5][1]["prompt"] == "Extract dates"
+
+def test_export_writes_files_last():
+    project = Project("Reviews", "Customer reviews", "Extract the reviewer")
+    project.schema = ResponseSchema.from_dict({"data_fields": [{"name": "reviewer", "description": "Name", "data_type": "String"}],
+                                               "confirmation_message": "ok"})
+    project.files = [TextFile("a.txt", "Reviewed by Ann"), TextFile("b.txt", "Reviewed by Bo")]
+    events = list(iter_import(write_export([project])))
+
+    assert [kind for kind, _ in events] == ["project", "file", "file", "end_project"]
+    # Everything but the files is known before the first file arrives
+    assert events[0][1]["schema"]["data_fields"][0]["name"] == "reviewer"
+    assert [data["contents"] for kind, data in events if kind == "file"] == ["Reviewed by Ann", "Reviewed by Bo"]
@@ -0,0 +1,46 @@
+from chunking import count_tokens, merge_items, split_text
+
+PARAGRAPH = "Order {n} was shipped to the customer on time and arrived without any damage to the packaging.\n"
+
+def document(paragraphs):
+    return "\n".join(PARAGRAPH.format(n=n) for n in range(paragraphs))
+
+def test_short_text_is_one_chunk():
+    text = document(2)
+    assert split_text(text, max_tokens=1000, overlap_tokens=50) == [text]
+
+def test_split_respects_limit_and_overlaps():
+    text = document(40)
+    chunks = split_text(text, max_tokens=200, overlap_tokens=40)
+    assert len(chunks) > 1
+    assert all(count_tokens(chunk) <= 200 for chunk in chunks)
+    # Every paragraph is in some chunk, and neighbouring chunks share their boundary paragraph
+    for n in range(40):
+        assert any(PARAGRAPH.format(n=n) in chunk for chunk in chunks)
+    for first, second in zip(chunks, chunks[1:]):
+        last = first.strip().splitlines()[-1]
+        assert last in second
+
+def test_split_without_overlap_restores_text():
+    text = document(40)
+    assert "".join(split_text(text, max_tokens=200, overlap_tokens=0)) == text
+
+def test_oversized_line_is_split_by_tokens():
+    text = "word " * 2000
+    chunks = split_text(text, max_tokens=100, overlap_tokens=0)
+    assert all(count_tokens(chunk) <= 100 for chunk in chunks)
+    assert "".join(chunks) == text
+
+def test_merge_drops_items_repeated_in_the_overlap():
+    chunk_items = [
+        [{"order": "1", "status": "Shipped"}, {"order": "2", "status": "Shipped"}],
+        [{"order": "2", "status": " shipped "}, {"order": "3", "status": "Lost"}]
+    ]
+    merged = merge_items(chunk_items, ["order", "status"])
+    assert [item["order"] for item in merged] == ["1", "2", "3"]
+    # The first occurrence is kept as extracted
+    assert merged[1]["status"] == "Shipped"
+
+def test_merge_keeps_items_that_differ_in_any_field():
+    chunk_items = [[{"order": "1", "status": "Shipped"}], [{"order": "1", "status": "Returned"}]]
+    assert len(merge_items(chunk_items, ["order", "status"])) == 2
@@ -0,0 +1,57 @@
+from dedupe import minhash, similarity, values_supported
+from model import ResponseSchema, ResponseSchemaResults
+from project import FileState, Project, TextFile
+from runner import reuse_results
+
+REVIEW = (
+    "Customer review submitted through the feedback form on the company website. "
+    "Reviewer: Jordan Ellis. Product: Model 5 espresso machine, purchased in March from the online store. "
+    "Rating: {rating}. "
+    "The machine arrived well packed and was easy to set up. The instructions were clear and the first "
+    "shot was pulled within ten minutes of unboxing. The steam wand heats milk quickly and the drip tray "
+    "is large enough for a full day of use. Cleaning takes a few minutes each evening, mostly rinsing the "
+    "portafilter and wiping the group head. The grinder is loud but consistent, and the dose can be "
+    "adjusted in small steps. Customer support answered a question about descaling within a day. The "
+    "water tank is easy to remove and refill, and the cup warmer on top is a nice touch for cold mornings. "
+    "Overall the reviewer would describe the experience in the rating above and may buy the matching grinder "
+    "later in the year if the price drops during the summer sale."
+)
+
+SCHEMA = {
+    "data_fields": [
+        {"name": "reviewer", "description": "Name of the reviewer", "data_type": "String"},
+        {"name": "rating", "description": "Rating out of 5", "data_type": "Integer"}
+    ],
+    "confirmation_message": "ok"
+}
+
+def results(rating):
+    fields = [dict(field, value=value) for field, value in zip(SCHEMA["data_fields"], ["Jordan Ellis", rating])]
+    return [ResponseSchemaResults.from_dict({"data_fields": fields, "confirmation_message": "ok"})]
+
+def test_changed_number_is_not_reused():
+    first, second = REVIEW.format(rating=5), REVIEW.format(rating=1)
+    # Near duplicates by any sensible threshold, differing only in the rating
+    assert similarity(minhash(first), minhash(second)) >= 0.9
+
+    project = Project("Reviews", "", "")
+    project.schema = ResponseSchema.from_dict(SCHEMA)
+    representative = TextFile("first.txt", first, results(5), FileState.FINISHED)
+    duplicate = TextFile("second.txt", second)
+    project.files = [representative, duplicate]
+
+    assert not values_supported([{"reviewer": "Jordan Ellis", "rating": 5}], second, first, ["reviewer", "rating"])
+    assert not reuse_results(duplicate, representative, project)
+    assert duplicate.state == FileState.NOT_STARTED and duplicate.duplicate_of is None
+
+def test_unchanged_values_are_reused():
+    first = REVIEW.format(rating=5)
+    project = Project("Reviews", "", "")
+    project.schema = ResponseSchema.from_dict(SCHEMA)
+    representative = TextFile("first.txt", first, results(5), FileState.FINISHED)
+    duplicate = TextFile("second.txt", first.replace("well packed", "well  packed,"))
+    project.files = [representative, duplicate]
+
+    assert reuse_results(duplicate, representative, project)
+    assert duplicate.duplicate_of == "first.txt"
+    assert duplicate.results[0].data_fields[1].value == 5
@@ -0,0 +1,69 @@
+import time
+
+from cache import ExtractionCache
+from jobs import JobManager, JobState, JobStore
+from model import LLMHelper, ResponseSchema
+from project import FileState, Project, ProjectsManager, ProjectState, TextFile
+from ratelimit import RateLimiter
+from store import ProjectStore
+from stub import StubClient
+
+SCHEMA = {
+    "data_fields": [{"name": "product", "description": "Product mentioned", "data_type": "String"}],
+    "confirmation_message": "ok"
+}
+
+def wait(job, timeout=10):
+    deadline = time.monotonic() + timeout
+    while job.active:
+        assert time.monotonic() < deadline, "job did not finish"
+        time.sleep(0.01)
+
+def test_resume_runs_only_pending_and_changed_files():
+    client = StubClient()
+    llm = LLMHelper(client=client, cache=ExtractionCache(":memory:"), rate_limiter=RateLimiter())
+    projects = ProjectsManager(ProjectStore(":memory:"))
+    jobs = JobManager(llm, JobStore(":memory:"), projects_manager=projects)
+
+    project = Project("Feedback", "", "Extract the products mentioned")
+    project.schema = ResponseSchema.from_dict(SCHEMA)
+    project.files = [TextFile(f"{i}.txt", f"Customer {i} wrote about the green kettle.") for i in range(4)]
+    projects.save_project(project)
+
+    job = jobs.submit(project, max_workers=2)
+    wait(job)
+    assert job.state == JobState.COMPLETE and client.requests == 4
+
+    # As after a crash that lost the project's progress: the job store still has the results,
+    # one file has been edited since and one never finished
+    for file in project.files:
+        file.state = FileState.NOT_STARTED
+        file.results = []
+    project.files[1] = TextFile("1.txt", "Customer 1 now writes about the toaster instead.")
+    project.files[3].state = FileState.ERROR
+    jobs.store.save_file(job, 3, project.files[3])
+
+    resumed = jobs.resume(project)
+    assert [file.file_name for file in resumed.files] == ["1.txt", "3.txt"]
+    wait(resumed)
+    assert resumed.state == JobState.COMPLETE
+    # The edited file is extracted again; the failed one is unchanged and comes from the cache
+    assert client.requests == 5 and llm.cache.hits == 1
+    assert all(file.state == FileState.FINISHED and file.results for file in project.files)
+    assert project.state == ProjectState.COMPLETE
+
+def test_jobs_belong_to_projects_not_titles():
+    llm = LLMHelper(client=StubClient(), cache=ExtractionCache(":memory:"), rate_limiter=RateLimiter())
+    projects = ProjectsManager(ProjectStore(":memory:"))
+    jobs = JobManager(llm, JobStore(":memory:"), projects_manager=projects)
+
+    first, second = Project("Same", "", "Extract products"), Project("Same", "", "Extract products")
+    for project in (first, second):
+        project.schema = ResponseSchema.from_dict(SCHEMA)
+        project.files = [TextFile("a.txt", "The blue kettle.")]
+        projects.save_project(project)
+
+    wait(jobs.submit(first))
+    assert jobs.store.latest_job(first.id)["state"] == JobState.COMPLETE
+    assert jobs.store.latest_job(second.id) is None
+    assert jobs.store.finished_files(second.id) == {}
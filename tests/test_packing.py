@@ -0,0 +1,58 @@
+from cache import ExtractionCache
+from model import LLMHelper, ResponseSchema
+from project import FileState, Project, TextFile
+from ratelimit import RateLimiter
+from runner import pack_files, run_files
+from stub import StubClient
+
+SCHEMA = {
+    "data_fields": [{"name": "product", "description": "Product mentioned", "data_type": "String"}],
+    "confirmation_message": "ok"
+}
+
+def make_project(files):
+    project = Project("Feedback", "", "Extract the products mentioned")
+    project.schema = ResponseSchema.from_dict(SCHEMA)
+    project.files = files
+    return project
+
+def make_llm(client):
+    # A private cache and limiter, so earlier runs and other tests don't answer or slow requests
+    return LLMHelper(client=client, cache=ExtractionCache(":memory:"), rate_limiter=RateLimiter())
+
+def test_small_files_share_packs():
+    small = [TextFile(f"small{i}.txt", f"Note {i} about the kettle.") for i in range(5)]
+    large = TextFile("large.txt", "The kettle boils quickly. " * 200)
+    packs = pack_files(small[:3] + [large] + small[3:], max_tokens=600, max_files=3)
+
+    assert [[file.file_name for file in pack] for pack in packs] == [
+        ["large.txt"], ["small0.txt", "small1.txt", "small2.txt"], ["small3.txt", "small4.txt"]
+    ]
+
+def test_packing_disabled():
+    files = [TextFile(f"{i}.txt", "short") for i in range(3)]
+    assert pack_files(files, max_tokens=0) == [[file] for file in files]
+    assert pack_files(files, max_tokens=1000, max_files=1) == [[file] for file in files]
+
+def test_packed_run_gives_every_file_its_results():
+    files = [TextFile(f"note{i}.txt", f"Customer {i} asked about the blue kettle.") for i in range(6)]
+    files.append(TextFile("long.txt", "The toaster has uneven browning. " * 300))
+    project = make_project(files)
+    client = StubClient(items=2)
+
+    failed = run_files(project, max_workers=4, llm=make_llm(client), pack_tokens=1000, dedupe_threshold=0)
+
+    assert failed == []
+    # One request for the six short notes, one for the long file
+    assert client.requests == 2
+    for file in files:
+        assert file.state == FileState.FINISHED
+        assert file.results and file.run_version == project.run_version
+
+def test_unpacked_run_sends_a_request_per_file():
+    files = [TextFile(f"note{i}.txt", f"Customer {i} asked about the red kettle.") for i in range(4)]
+    project = make_project(files)
+    client = StubClient()
+
+    assert run_files(project, llm=make_llm(client), dedupe_threshold=0) == []
+    assert client.requests == 4
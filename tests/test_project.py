@@ -0,0 +1,68 @@
+import json
+from pathlib import Path
+
+from model import ResponseSchema, ResponseSchemaResults
+from project import FileState, Project, ProjectsManager, TextFile
+from store import ProjectStore
+
+EXAMPLE = Path(__file__).resolve().parent.parent / "Examples" / "Product Feedback Project.json"
+
+SCHEMA = {
+    "data_fields": [{"name": "product", "description": "Product mentioned", "data_type": "String"}],
+    "confirmation_message": "ok"
+}
+
+def finished(file_name, version=None):
+    fields = [dict(SCHEMA["data_fields"][0], value="kettle")]
+    file = TextFile(file_name, "The kettle.", [ResponseSchemaResults.from_dict({"data_fields": fields, "confirmation_message": "ok"})],
+                    FileState.FINISHED)
+    file.run_version = version
+    return file
+
+def test_prompt_and_schema_changes_make_results_stale():
+    project = Project("Feedback", "", "Extract the products mentioned")
+    project.schema = ResponseSchema.from_dict(SCHEMA)
+    current = finished("current.txt", project.run_version)
+    project.files = [current, TextFile("new.txt", "The toaster."), finished("failed.txt", project.run_version)]
+    project.files[2].state = FileState.ERROR
+    assert project.pending_files() == project.files[1:]
+
+    project.prompt = "Extract the products and their prices"
+    assert project.needs_run(current)
+    assert project.pending_files() == project.files
+
+    project.prompt = "Extract the products mentioned"
+    assert not project.needs_run(current)
+    project.schema = ResponseSchema.from_dict(dict(SCHEMA, data_fields=[dict(SCHEMA["data_fields"][0], data_type="Enum")]))
+    assert project.needs_run(current)
+
+def test_unversioned_results_match_the_current_version():
+    project = Project("Feedback", "", "Extract the products mentioned")
+    project.schema = ResponseSchema.from_dict(SCHEMA)
+    legacy = finished("legacy.txt")
+    project.stamp_run_version([legacy, TextFile("new.txt", "The toaster.")])
+    assert legacy.run_version == project.run_version
+    assert not project.needs_run(legacy)
+
+    project.prompt = "Something else"
+    assert project.needs_run(legacy)
+
+def test_example_is_up_to_date_after_loading():
+    data = json.loads(EXAMPLE.read_text(encoding="utf-8"))[0]
+    project = Project.from_dict(data)
+    assert project.files and project.pending_files() == []
+
+def test_example_is_up_to_date_after_import():
+    # The example lists its schema after the files, so the version is only known at the end
+    manager = ProjectsManager(ProjectStore(":memory:"))
+    with open(EXAMPLE, "rb") as f:
+        [project] = manager.load_from_file(f)
+    assert len(project.files) == 10
+    assert project.pending_files() == []
+
+    # The stamped versions were saved too
+    stored = [TextFile.from_row(row, manager.store) for row in manager.store.list_files(project.id)]
+    assert {file.run_version for file in stored} == {project.run_version}
+
+    project.prompt += " Include prices."
+    assert len(project.pending_files()) == 10
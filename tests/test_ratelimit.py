@@ -0,0 +1,71 @@
+import time
+
+from ratelimit import WINDOW, RateLimiter, parse_duration, retry_after
+
+def test_acquire_counts_requests_and_tokens():
+    limiter = RateLimiter(rpm=100, tpm=10000, max_concurrency=4, headroom=1.0)
+    assert limiter.acquire(300) < 1
+    limiter.acquire(200)
+    assert len(limiter._requests) == 2
+    assert limiter._token_total == 500
+    assert limiter.in_flight == 2
+
+    limiter.release()
+    limiter.release()
+    assert limiter.in_flight == 0
+    # Releasing frees a slot but the window still holds what was sent
+    assert limiter._token_total == 500
+
+def test_window_expires_old_requests():
+    limiter = RateLimiter(rpm=100, tpm=10000, headroom=1.0)
+    limiter.acquire(400)
+    limiter.release()
+    # Age the recorded request out of the window
+    limiter._requests[0] -= WINDOW
+    limiter._tokens[0] = (limiter._tokens[0][0] - WINDOW, limiter._tokens[0][1])
+    limiter._prune(time.monotonic())
+    assert len(limiter._requests) == 0
+    assert limiter._token_total == 0
+
+def test_budgets_make_requests_wait():
+    limiter = RateLimiter(rpm=2, tpm=1000, headroom=1.0)
+    limiter.acquire(100)
+    now = time.monotonic()
+    assert limiter._wait_time(800, now) == 0
+    assert limiter._wait_time(901, now) > 0
+
+    limiter.acquire(100)
+    assert limiter._wait_time(1, time.monotonic()) > 0
+
+def test_oversized_request_passes_on_empty_window():
+    limiter = RateLimiter(rpm=10, tpm=1000, headroom=1.0)
+    assert limiter._wait_time(5000, time.monotonic()) == 0
+
+def test_rate_limited_release_halves_concurrency():
+    limiter = RateLimiter(max_concurrency=8)
+    limiter.acquire(10)
+    limiter.release({"retry-after-ms": "2000"}, rate_limited=True)
+    assert limiter.concurrency == 4
+    assert limiter.throttled == 1
+    assert limiter.blocked_until > time.monotonic() + 1
+
+    # A run of successes at the current level raises the cap by one
+    limiter.blocked_until = 0
+    for _ in range(4):
+        limiter.acquire(10)
+    for _ in range(4):
+        limiter.release()
+    assert limiter.concurrency == 5
+
+def test_headers():
+    assert parse_duration("6m0s") == 360
+    assert parse_duration("20ms") == 0.02
+    assert parse_duration("") is None
+    assert retry_after({"retry-after": "3"}) == 3
+    assert retry_after({"retry-after-ms": "250"}) == 0.25
+
+    limiter = RateLimiter(rpm=500, tpm=200000)
+    limiter.update_from_headers({"x-ratelimit-limit-requests": "60", "x-ratelimit-limit-tokens": "1000",
+                                 "x-ratelimit-remaining-tokens": "0", "x-ratelimit-reset-tokens": "5s"})
+    assert (limiter.rpm, limiter.tpm) == (60, 1000)
+    assert limiter.blocked_until > time.monotonic() + 4
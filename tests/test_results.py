@@ -0,0 +1,78 @@
+from results import FILE_COLUMN, ResultsTable
+
+FIELDS = [{"name": "product", "data_type": "String"}, {"name": "rating", "data_type": "Integer"}]
+
+def rows(*ratings):
+    return [{"product": f"item {rating}", "rating": rating} for rating in ratings]
+
+def column(table, name):
+    names, columns, total = table.snapshot(include_file=True)
+    return columns[names.index(name)][:total]
+
+def test_replace_keeps_other_files_rows():
+    table = ResultsTable(FIELDS)
+    table.append(1, "a.txt", rows(1, 2))
+    table.append(2, "b.txt", rows(3))
+    table.append(3, "c.txt", rows(4, 5))
+
+    table.replace_file(2, "b.txt", rows(6, 7))
+    assert len(table) == 6
+    assert sorted(column(table, "rating")) == [1, 2, 4, 5, 6, 7]
+    assert column(table, FILE_COLUMN).count("b.txt") == 2
+
+def test_files_are_keyed_not_named():
+    # Two files with the same name are still separate files
+    table = ResultsTable(FIELDS)
+    table.append(1, "a.txt", rows(1))
+    table.append(2, "a.txt", rows(2))
+    table.drop_file(1)
+    assert column(table, "rating") == [2]
+
+def test_drop_defers_removal_until_compaction():
+    table = ResultsTable(FIELDS)
+    for key in range(4):
+        table.append(key, f"{key}.txt", rows(key))
+    table.drop_file(0)
+    assert len(table) == 3
+    # Dropped rows stay in the columns while they are a minority
+    assert table.dropped == 1 and len(table.keys) == 4
+
+    table.drop_file(1)
+    table.drop_file(2)
+    # Compacted once dropped rows outnumber live ones
+    assert table.dropped == 0 and table.keys == [3]
+    assert table.file_rows == {3: [0]}
+    assert column(table, "rating") == [3]
+
+def test_positions_stay_valid_after_compaction():
+    table = ResultsTable(FIELDS)
+    for key in range(3):
+        table.append(key, f"{key}.txt", rows(key, key * 10))
+    table.drop_file(0)
+    table.compact()
+    assert table.file_rows == {1: [0, 1], 2: [2, 3]}
+
+    table.replace_file(1, "1.txt", rows(100))
+    table.drop_file(2)
+    assert column(table, "rating") == [100]
+
+def test_snapshot_is_unaffected_by_later_changes():
+    table = ResultsTable(FIELDS)
+    table.append(1, "a.txt", rows(1))
+    table.append(2, "b.txt", rows(2))
+    names, columns, total = table.snapshot()
+
+    table.drop_file(1)
+    table.compact()
+    table.append(3, "c.txt", rows(3))
+    assert names == ["product", "rating"]
+    assert [values[:total] for values in columns] == [["item 1", "item 2"], [1, 2]]
+
+def test_dataframe_has_only_live_rows():
+    table = ResultsTable(FIELDS)
+    table.append(1, "a.txt", rows(1, 2))
+    table.append(2, "b.txt", rows(3))
+    table.drop_file(1)
+    frame = table.to_dataframe(include_file=True)
+    assert list(frame[FILE_COLUMN]) == ["b.txt"]
+    assert list(frame["rating"]) == [3]
@@ -0,0 +1,56 @@
+import pytest
+
+from validation import compile_validator, enum_coercer, to_boolean, to_date, to_integer, to_number
+
+def test_numbers():
+    assert to_number("1,234.5") == 1234.5
+    assert to_number(3) == 3.0
+    assert to_number("") is None
+    assert to_number(True) is None
+    assert to_integer("12") == 12
+    assert to_integer("12.0") == 12
+    with pytest.raises(ValueError):
+        to_integer("12.5")
+    with pytest.raises(ValueError):
+        to_number("twelve")
+
+def test_booleans():
+    assert to_boolean("Yes") is True
+    assert to_boolean(" 0 ") is False
+    assert to_boolean(False) is False
+    with pytest.raises(ValueError):
+        to_boolean("maybe")
+
+def test_dates():
+    assert to_date("2024-03-05") == "2024-03-05"
+    assert to_date("2024-03-05T10:30:00") == "2024-03-05"
+    assert to_date(" ") is None
+    with pytest.raises(ValueError):
+        to_date("March 5th")
+
+def test_enum_values_take_their_canonical_case():
+    to_enum = enum_coercer(("Positive", "Negative"))
+    assert to_enum("positive") == "Positive"
+    assert to_enum("") is None
+    with pytest.raises(ValueError):
+        to_enum("Neutral")
+
+def test_validator_coerces_rows_and_counts_invalid_values():
+    validate = compile_validator((
+        ("name", "String", None, False),
+        ("age", "Integer", None, False),
+        ("active", "Boolean", None, False),
+        ("tags", "Enum", ("a", "b"), True)
+    ))
+    rows, invalid = validate([
+        {"name": "Ann", "age": "41", "active": "yes", "tags": ["A", "b"]},
+        {"name": None, "age": "old", "active": None, "tags": ["a", "c", ""]},
+        {"age": 7, "tags": "b"}
+    ])
+    assert rows == [
+        ["Ann", 41, True, ["a", "b"]],
+        ["", None, None, ["a"]],
+        ["", 7, None, ["b"]]
+    ]
+    # "old" and "c"; the empty enum entry is dropped without counting as invalid
+    assert invalid == 2
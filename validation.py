@@ -0,0 +1,160 @@
+from datetime import date, datetime
+from functools import lru_cache
+import logging
+from typing import Any, Callable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Field types a schema may use; anything else is treated as String
+FIELD_TYPES = ("String", "Number", "Integer", "Boolean", "Date", "Enum")
+TRUE_VALUES = {"true", "yes", "y", "1"}
+FALSE_VALUES = {"false", "no", "n", "0"}
+
+# (name, data_type, enum values or None, is array)
+FieldSpec = Tuple[str, str, Tuple[str, ...] | None, bool]
+
+def normalize_type(data_type: str) -> str:
+    for field_type in FIELD_TYPES:
+        if data_type.lower() == field_type.lower():
+            return field_type
+    return "String"
+
+def field_schema(data_type: str, enum_values: Tuple[str, ...] | None = None, array: bool = False) -> dict:
+    # Strict JSON schema for one field. Typed scalars are nullable so the model can say a value
+    # is missing instead of inventing one; strings keep the original non-null behaviour.
+    data_type = normalize_type(data_type)
+    if data_type == "Number":
+        definition = {"type": "number"}
+    elif data_type == "Integer":
+        definition = {"type": "integer"}
+    elif data_type == "Boolean":
+        definition = {"type": "boolean"}
+    elif data_type == "Date":
+        definition = {"type": "string", "description": "ISO 8601 date, YYYY-MM-DD"}
+    elif data_type == "Enum" and enum_values:
+        definition = {"type": "string", "enum": list(enum_values)}
+    else:
+        definition = {"type": "string"}
+
+    if array:
+        return {"type": "array", "items": definition}
+    if data_type == "String":
+        return definition
+    nullable = dict(definition, type=[definition["type"], "null"])
+    if "enum" in nullable:
+        nullable["enum"] = nullable["enum"] + [None]
+    return nullable
+
+def to_string(value) -> str:
+    return "" if value is None else str(value)
+
+def to_number(value) -> float | None:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip().replace(",", "").replace("_", "")
+    return float(text) if text else None
+
+def to_integer(value) -> int | None:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    number = to_number(value)
+    if number is None:
+        return None
+    if not number.is_integer():
+        raise ValueError(f"{value!r} is not an integer")
+    return int(number)
+
+def to_boolean(value) -> bool | None:
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise ValueError(f"{value!r} is not a boolean")
+
+def to_date(value) -> str | None:
+    # Kept as an ISO string so results stay JSON; exports turn the column into real dates
+    text = str(value).strip()
+    if not text:
+        return None
+    try:
+        return date.fromisoformat(text[:10]).isoformat()
+    except ValueError:
+        return datetime.fromisoformat(text).date().isoformat()
+
+def enum_coercer(enum_values: Tuple[str, ...]) -> Callable[[Any], str | None]:
+    canonical = {value.casefold(): value for value in enum_values}
+
+    def to_enum(value) -> str | None:
+        text = str(value).strip()
+        if not text:
+            return None
+        if text.casefold() not in canonical:
+            raise ValueError(f"{value!r} is not one of {list(enum_values)}")
+        return canonical[text.casefold()]
+    return to_enum
+
+def scalar_coercer(data_type: str, enum_values: Tuple[str, ...] | None) -> Callable[[Any], Any]:
+    data_type = normalize_type(data_type)
+    if data_type == "Enum" and enum_values:
+        return enum_coercer(enum_values)
+    return {
+        "Number": to_number,
+        "Integer": to_integer,
+        "Boolean": to_boolean,
+        "Date": to_date
+    }.get(data_type, to_string)
+
+@lru_cache(maxsize=256)
+def compile_validator(fields: Tuple[FieldSpec, ...]) -> Callable[[List[dict]], Tuple[List[list], int]]:
+    # Builds the per-field coercion functions once per schema. The returned function turns a
+    # batch of parsed items into rows of typed values, in field order, and the number of values
+    # that failed. Those values become None (an empty list entry is dropped for arrays) and are
+    # logged once per batch.
+    coercers = []
+    for name, data_type, enum_values, array in fields:
+        coerce = scalar_coercer(data_type, enum_values)
+        is_string = coerce is to_string
+        coercers.append((name, coerce, array, is_string))
+
+    def validate(items: List[dict]) -> Tuple[List[list], int]:
+        rows = []
+        invalid = 0
+        for item in items:
+            row = []
+            for name, coerce, array, is_string in coercers:
+                value = item.get(name)
+                if array:
+                    values = value if isinstance(value, list) else ([] if value is None else [value])
+                    coerced = []
+                    for element in values:
+                        try:
+                            element = coerce(element)
+                        except (TypeError, ValueError):
+                            invalid += 1
+                            continue
+                        if element is not None:
+                            coerced.append(element)
+                    row.append(coerced)
+                elif is_string:
+                    row.append(to_string(value))
+                elif value is None:
+                    row.append(None)
+                else:
+                    try:
+                        row.append(coerce(value))
+                    except (TypeError, ValueError):
+                        invalid += 1
+                        row.append(None)
+            rows.append(row)
+        if invalid:
+            logger.warning(f"Dropped {invalid} extracted values that did not match their field type")
+        return rows, invalid
+
+    return validate